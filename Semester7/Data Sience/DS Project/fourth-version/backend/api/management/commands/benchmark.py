@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.benchmark import (DEFAULT_REPEAT, DEFAULT_SCAPY_LIMIT, DEFAULT_THRESHOLD, find_regressions, load_results,
+                              parse_mix, run_benchmark, sample_sizes, save_results)
+from api.ml.protocol_rules import configure_rules
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the feature extraction pipeline on synthetic captures: times "
+        "load_packets, identify_protocol and extract_features, reports packets/sec "
+        "and peak RSS, saves the results as JSON and compares them with a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--packets', type=int, nargs='+', default=[10000, 100000, 1000000],
+                            help="Packet counts of the synthetic captures (e.g. 10000 10000000)")
+        parser.add_argument('--mix', default='',
+                            help='Protocol mix as NAME=WEIGHT pairs, e.g. "HTTP=5,DNS=1,Other=1" '
+                                 '(default: every protocol of the rules equally)')
+        parser.add_argument('--sizes', default='imix',
+                            help='Frame size distribution: imix, fixed:SIZE, uniform:LOW:HIGH or normal:MEAN:STD')
+        parser.add_argument('--workers', type=int, default=settings.FEATURE_EXTRACTION_WORKERS,
+                            help="Processes used by extract_features on large captures")
+        parser.add_argument('--scapy-limit', type=int, default=DEFAULT_SCAPY_LIMIT,
+                            help="Largest capture the scapy stages are run on in full")
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                            help="Runs per stage, the fastest one is reported")
+        parser.add_argument('--inspect-bytes', type=int, default=0,
+                            help="Also time extract_features with payload inspection of this many bytes per flow")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dir', default=None,
+                            help="Where the synthetic captures are written (default: a temporary directory)")
+        parser.add_argument('--keep', action='store_true', help="Keep the synthetic captures")
+        parser.add_argument('--output', default=None, help="JSON file the results are written to")
+        parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to compare with")
+        parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                            help="Relative slowdown (or peak RSS growth) that counts as a regression")
+
+    def handle(self, *args, **options):
+        if min(options['packets']) < 1 or options['repeat'] < 1:
+            raise CommandError("--packets and --repeat must be positive")
+        rules = configure_rules(settings.PROTOCOL_RULES_FILE)
+        try:
+            mix = parse_mix(options['mix'], rules)
+            # Fails early on a bad spec rather than after the first capture
+            sample_sizes(options['sizes'], 1, np.random.default_rng())
+        except ValueError as e:
+            raise CommandError(str(e))
+        baseline = load_results(options['baseline']) if options['baseline'] else None
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = run_benchmark(
+                options['packets'],
+                options['dir'] or tmp_dir,
+                mix=mix,
+                size_spec=options['sizes'],
+                workers=options['workers'],
+                scapy_limit=options['scapy_limit'],
+                keep=options['keep'] and options['dir'] is not None,
+                seed=options['seed'],
+                rules_file=settings.PROTOCOL_RULES_FILE,
+                repeat=options['repeat'],
+                inspect_bytes=options['inspect_bytes'],
+                log=self.report,
+            )
+
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write(f"Results written to {os.path.abspath(options['output'])}")
+
+        if baseline is not None:
+            regressions = find_regressions(results, baseline, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(f"Regression: {regression}")
+            if regressions:
+                raise CommandError(f"{len(regressions)} regression(s) past {options['threshold']:.0%}")
+            self.stdout.write(f"No regression past {options['threshold']:.0%} against {options['baseline']}")
+
+    def report(self, result):
+        packets = result.get('packets_in_capture', result['packets'])
+        rate = f"{result['packets_per_sec']:.0f} pkt/s" if result.get('packets_per_sec') else "-"
+        line = f"{packets:>10} packets  {result['stage']:<24} {result['seconds']:8.2f}s  {rate:>14}"
+        if 'peak_rss_mb' in result:
+            line += f"  peak RSS {result['peak_rss_mb']:.0f} MB (+{result['peak_rss_mb'] - result['base_rss_mb']:.0f})"
+            if result['peak_worker_rss_mb']:
+                line += f", workers {result['peak_worker_rss_mb']:.0f} MB"
+        self.stdout.write(line)
@@ -0,0 +1,61 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.benchmark import PARITY_TOLERANCE, compare_backends, save_results
+from api.ml.models import BACKENDS, load_calibration, load_classifier
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the inference backends of the saved models against the eager ones "
+        "(fails if they disagree; int8 may differ slightly but must give the same CNN class "
+        "for 99% of the rows) "
+        "and compares their accuracy and their latency at several batch sizes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.MODEL_ARTIFACTS_DIR,
+                            help="Artifacts directory (default: MODEL_ARTIFACTS_DIR)")
+        parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 4096])
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per measurement, the fastest is reported")
+        parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE,
+                            help="Largest CNN probability difference from the eager models")
+        parser.add_argument('--calibration', default=settings.MODEL_CALIBRATION_FILE,
+                            help="Feature rows (.npy, n x 10) the int8 CNN is calibrated on "
+                                 "(default: MODEL_CALIBRATION_FILE, or synthetic rows)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help="JSON file the results are written to")
+
+    def handle(self, *args, **options):
+        if min(options['batch_sizes']) < 1 or options['repeat'] < 1:
+            raise CommandError("--batch-sizes and --repeat must be positive")
+        classifier = load_classifier(options['dir'], calibration=load_calibration(options['calibration']))
+        try:
+            results = compare_backends(classifier, options['backends'], options['batch_sizes'],
+                                       options['repeat'], options['seed'], options['tolerance'])
+        except ImportError as e:
+            raise CommandError(str(e))
+
+        for result in results['results']:
+            self.stdout.write(
+                f"{result['backend']:<12} {result['stage']:<14} batch {result['batch_size']:>6}"
+                f"  {result['seconds'] * 1000:9.3f} ms  {result['vectors_per_sec']:>12.0f} vectors/s"
+            )
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write(f"Results written to {os.path.abspath(options['output'])}")
+
+        failed = []
+        for check in results['parity']:
+            self.stdout.write(
+                f"{check['backend']:<12} parity: max probability difference {check['max_probability_difference']:.2e}, "
+                f"{check['cnn_class_mismatches']} CNN and {check['xgboost_class_mismatches']} XGBoost class mismatches "
+                f"in {check['rows']} rows, CNN accuracy {check['cnn_accuracy']:.4f} ({check['cnn_accuracy_delta']:+.4f})"
+            )
+            if not check['ok']:
+                failed.append(check['backend'])
+        if failed:
+            raise CommandError(f"{', '.join(failed)} disagree(s) with the eager models")
@@ -0,0 +1,43 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.feature_extractor import FeatureExtractor
+from api.ml.packet_table import PacketTable, table_path
+from api.ml.protocol_rules import configure_rules
+
+
+class Command(BaseCommand):
+    help = (
+        "Parses capture files once into columnar packet tables (.npy columns, or Parquet "
+        "with pyarrow) written next to them. FeatureExtractor(table=...) then computes "
+        "the features from the table without parsing the capture again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('captures', nargs='+', metavar='PCAP')
+        parser.add_argument('--format', choices=['npy', 'parquet'], default='npy')
+        parser.add_argument('--output', default=None,
+                            help="Table path, for a single capture (default: next to the capture)")
+        parser.add_argument('--inspect-bytes', type=int, default=settings.PAYLOAD_INSPECT_BYTES,
+                            help="Payload bytes inspected per flow for payload signatures (0 = ports only)")
+
+    def handle(self, *args, **options):
+        if options['output'] and len(options['captures']) > 1:
+            raise CommandError("--output takes a single capture")
+        rules = configure_rules(settings.PROTOCOL_RULES_FILE)
+        for pcap_path in options['captures']:
+            extractor = FeatureExtractor(pcap_path, streaming=True, rules=rules,
+                                         inspect_bytes=options['inspect_bytes'])
+            if not extractor.load_packets():
+                raise CommandError(f"Can't read {pcap_path}")
+            started = time.perf_counter()
+            try:
+                path = extractor.export_table(options['output'] or table_path(pcap_path, options['format']))
+            except ImportError as e:
+                raise CommandError(str(e))
+            seconds = time.perf_counter() - started
+            packets = PacketTable(path).packets
+            self.stdout.write(f"{pcap_path}: {packets} packets in {seconds:.2f}s -> {os.path.abspath(path)}")
@@ -0,0 +1,77 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.incremental import ArtifactWatcher
+from api.ml.live import DEFAULT_QUEUE_SIZE, DEFAULT_REPORT_INTERVAL, InterfaceSource, LiveIngestor, ReplaySource
+from api.ml.models import load_calibration, load_classifier, model_timeouts
+from api.ml.protocol_rules import configure_rules
+from api.models import TrafficWindow
+
+
+class Command(BaseCommand):
+    help = (
+        "Continuously ingests packets from a network interface, or replays a capture "
+        "file, and stores one classified TrafficWindow per time window."
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--interface', help="Network interface to capture from (needs root)")
+        source.add_argument('--replay', metavar='PCAP', help="Capture file to replay")
+        parser.add_argument('--filter', default=None, help="BPF filter for --interface")
+        parser.add_argument('--rate', type=float, default=None,
+                            help="Replay rate in packets/sec (default: as fast as possible, lossless)")
+        parser.add_argument('--window', type=float, default=settings.FEATURE_WINDOW_SECONDS,
+                            help="Seconds of capture time per window")
+        parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                            help="Packets buffered before new ones are dropped")
+        parser.add_argument('--inspect-bytes', type=int, default=settings.PAYLOAD_INSPECT_BYTES,
+                            help="Payload bytes inspected per flow for payload signatures (0 = ports only)")
+        parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL,
+                            help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        if options['interface']:
+            source = InterfaceSource(options['interface'], bpf_filter=options['filter'])
+        else:
+            if options['rate'] is not None and options['rate'] <= 0:
+                raise CommandError("--rate must be positive")
+            source = ReplaySource(options['replay'], rate=options['rate'])
+
+        # Edits to the rules file apply to the next windows, see LiveIngestor
+        configure_rules(settings.PROTOCOL_RULES_FILE)
+        # Loaded up front so the first window doesn't stall the ingestion
+        classifier = load_classifier(settings.MODEL_ARTIFACTS_DIR, settings.MODEL_BACKEND,
+                                     model_timeouts(settings.MODEL_TIMEOUTS_MS), settings.PARALLEL_MODELS,
+                                     load_calibration(settings.MODEL_CALIBRATION_FILE))
+
+        # Models published meanwhile (train_models --force, updates) are used from the next window on
+        watcher = ArtifactWatcher(classifier, settings.MODEL_ARTIFACTS_DIR, settings.MODEL_RELOAD_INTERVAL)
+
+        def on_window(features, predictions):
+            TrafficWindow.from_features(source.name, features, predictions).save()
+            watcher.check()
+
+        ingestor = LiveIngestor(
+            source,
+            classifier,
+            on_window=on_window,
+            on_report=self.report,
+            window=options['window'],
+            queue_size=options['queue_size'],
+            report_interval=options['report_interval'],
+            inspect_bytes=options['inspect_bytes'],
+        )
+        # Ctrl+C stops the capture, the queued packets and the open window are still stored
+        signal.signal(signal.SIGINT, lambda signum, frame: ingestor.stop())
+        self.stdout.write(f"Ingesting from {source.name}, press Ctrl+C to stop")
+        ingestor.run()
+
+    def report(self, stats):
+        self.stdout.write(
+            f"{stats['elapsed']:.1f}s: {stats['processed']} packets "
+            f"({stats['packets_per_sec']:.0f} pkt/s, capture {stats['capture_per_sec']:.0f} pkt/s), "
+            f"{stats['dropped']} dropped, {stats['queued']} queued, {stats['windows']} windows"
+        )
@@ -0,0 +1,70 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.benchmark import run_training_benchmark, save_results
+from api.ml.models import (ARTIFACT_FILES, DEFAULT_BATCH_SIZE, DEFAULT_EPOCHS, DEFAULT_SAMPLES, MODEL_VERSION,
+                           PacketClassifier, current_build)
+
+
+class Command(BaseCommand):
+    help = (
+        "Trains the models (CNN, XGBoost, IsolationForest) and saves them as the "
+        "artifacts of the current model version, loaded by every process at startup. "
+        "With --benchmark, reports training time and peak RSS instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.MODEL_ARTIFACTS_DIR,
+                            help="Artifacts directory (default: MODEL_ARTIFACTS_DIR)")
+        parser.add_argument('--force', action='store_true',
+                            help="Replace the artifacts of this version if they exist")
+        parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                            help="Synthetic training samples")
+        parser.add_argument('--epochs', type=int, default=DEFAULT_EPOCHS, help="CNN training epochs")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="CNN mini-batch size (0 = the whole dataset)")
+        parser.add_argument('--threads', type=int, default=None,
+                            help="Threads used by each model (default: the libraries' own)")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--benchmark', type=int, nargs='+', metavar='SAMPLES', default=None,
+                            help="Only time the training on these numbers of samples (e.g. 1000 100000 10000000), "
+                                 "nothing is saved")
+        parser.add_argument('--output', default=None, help="JSON file the benchmark results are written to")
+
+    def handle(self, *args, **options):
+        if options['samples'] < 1 or options['epochs'] < 0 or options['batch_size'] < 0:
+            raise CommandError("--samples must be positive, --epochs and --batch-size not negative")
+        if options['benchmark']:
+            self.benchmark(options)
+            return
+
+        directory = options['dir']
+        if current_build(directory) is not None and not options['force']:
+            self.stdout.write(f"Artifacts of version {MODEL_VERSION} already in {directory}, use --force to retrain")
+            return
+        classifier = PacketClassifier()
+        classifier.train_dummy(options['samples'], options['epochs'], options['batch_size'],
+                               options['threads'], options['seed'])
+        path = classifier.save(directory, replace=options['force'])
+        # Checks the saved files the way the server will load them
+        classifier = PacketClassifier()
+        classifier.load(directory)
+        self.stdout.write(f"Saved {', '.join(ARTIFACT_FILES.values())} to {path} (version {classifier.version})")
+
+    def benchmark(self, options):
+        if min(options['benchmark']) < 1:
+            raise CommandError("--benchmark sizes must be positive")
+        results = run_training_benchmark(options['benchmark'], options['epochs'], options['batch_size'],
+                                         options['threads'], options['seed'] or 0, log=self.report)
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write(f"Results written to {os.path.abspath(options['output'])}")
+
+    def report(self, result):
+        rate = f"{result['samples_per_sec']:.0f} samples/s" if result['samples_per_sec'] else "-"
+        self.stdout.write(
+            f"{result['samples']:>10} samples  {result['stage']:<24} {result['seconds']:8.2f}s  {rate:>18}"
+            f"  peak RSS {result['peak_rss_mb']:.0f} MB (+{result['peak_rss_mb'] - result['base_rss_mb']:.0f})"
+        )
@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.ml.feature_extractor import FeatureExtractor
+from api.ml.incremental import IncrementalTrainer
+from api.ml.models import CONTINUE_ROUNDS, FINE_TUNE_EPOCHS, PacketClassifier, feature_matrix
+from api.ml.protocol_rules import configure_rules
+from api.models import TrafficWindow
+
+
+class Command(BaseCommand):
+    help = (
+        "Updates the saved models with labelled captures without retraining them from "
+        "scratch: the CNN is fine-tuned and XGBoost continues boosting on the features of "
+        "every window of the captures, IsolationForest is refitted on the latest recorded traffic. "
+        "Running servers take labelled captures on /api/label/ instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('captures', nargs='+', metavar='PCAP:LABEL',
+                            help="Capture and the class id (0-4) of its traffic, e.g. stream.pcap:1")
+        parser.add_argument('--dir', default=settings.MODEL_ARTIFACTS_DIR,
+                            help="Artifacts directory (default: MODEL_ARTIFACTS_DIR)")
+        parser.add_argument('--epochs', type=int, default=FINE_TUNE_EPOCHS, help="CNN fine-tuning epochs")
+        parser.add_argument('--rounds', type=int, default=CONTINUE_ROUNDS, help="XGBoost boosting rounds added")
+        parser.add_argument('--threads', type=int, default=None)
+
+    def handle(self, *args, **options):
+        rules = configure_rules(settings.PROTOCOL_RULES_FILE)
+        classifier = PacketClassifier()
+        try:
+            classifier.load(options['dir'])
+        except FileNotFoundError:
+            raise CommandError(f"No model artifacts in {options['dir']}, run train_models first")
+        previous = classifier.version
+
+        windows, labels = [], []
+        for capture in options['captures']:
+            pcap_path, _, label = capture.rpartition(':')
+            if not pcap_path or not label.isdigit():
+                raise CommandError(f"Expected PCAP:LABEL, got {capture!r}")
+            extractor = FeatureExtractor(pcap_path, streaming=True, rules=rules,
+                                         inspect_bytes=settings.PAYLOAD_INSPECT_BYTES)
+            if not extractor.load_packets():
+                raise CommandError(f"Can't read {pcap_path}")
+            captured = list(extractor.iter_window_features(settings.FEATURE_WINDOW_SECONDS))
+            windows += captured
+            labels += [int(label)] * len(captured)
+            self.stdout.write(f"{pcap_path}: {len(captured)} windows labelled {label}")
+
+        # One update with the windows of every capture, IsolationForest is refitted
+        # on the latest traffic recorded by the servers
+        trainer = IncrementalTrainer(classifier, options['dir'],
+                                     window_source=lambda count: feature_matrix(TrafficWindow.recent_features(count)),
+                                     window_rows=settings.ANOMALY_WINDOW_ROWS, epochs=options['epochs'],
+                                     rounds=options['rounds'], threads=options['threads'])
+        try:
+            trainer.submit(feature_matrix(windows), labels)
+        except ValueError as e:
+            raise CommandError(str(e))
+        trainer.close()
+
+        if trainer.last_error:
+            raise CommandError(f"Update failed: {trainer.last_error}")
+        self.stdout.write(f"{trainer.rows} rows in {trainer.updates} update(s), "
+                          f"version {previous} -> {classifier.version}")
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrafficWindow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(db_index=True, max_length=64)),
+                ('start_time', models.DateTimeField(db_index=True)),
+                ('end_time', models.DateTimeField()),
+                ('packet_count', models.IntegerField()),
+                ('byte_count', models.BigIntegerField()),
+                ('class_a', models.IntegerField(default=0)),
+                ('class_b', models.IntegerField(default=0)),
+                ('class_c', models.IntegerField(default=0)),
+                ('class_d', models.IntegerField(default=0)),
+                ('class_e', models.IntegerField(default=0)),
+                ('cnn_class', models.IntegerField()),
+                ('xgboost_class', models.IntegerField()),
+                ('is_anomaly', models.BooleanField(default=False)),
+                ('anomaly_score', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['start_time'],
+            },
+        ),
+    ]
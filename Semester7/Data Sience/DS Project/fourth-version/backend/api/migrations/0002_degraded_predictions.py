@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trafficwindow',
+            name='anomaly_score',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='trafficwindow',
+            name='cnn_class',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='trafficwindow',
+            name='xgboost_class',
+            field=models.IntegerField(null=True),
+        ),
+    ]
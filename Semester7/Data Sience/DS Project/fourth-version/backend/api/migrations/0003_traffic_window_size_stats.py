@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_degraded_predictions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trafficwindow',
+            name='max_packet_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='trafficwindow',
+            name='min_packet_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='trafficwindow',
+            name='std_packet_size',
+            field=models.FloatField(null=True),
+        ),
+    ]
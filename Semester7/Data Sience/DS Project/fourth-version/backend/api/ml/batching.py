@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Largest batch scored at once
+DEFAULT_MAX_BATCH = 256
+# How long (seconds) the first vector of a batch waits for others
+DEFAULT_MAX_DELAY = 0.002
+
+
+class MicroBatcher:
+    """
+    Scores feature vectors submitted by concurrent threads (upload
+    requests, the windows of a capture) with predict_batch() calls of up
+    to max_batch vectors. A batch is scored as soon as it is full, or
+    max_delay seconds after its first vector came in, so no request
+    waits more than that for others to join it.
+
+    One worker thread runs the models, which are therefore never called
+    from two threads at once. Has the predict() and predict_batch() of
+    PacketClassifier, so it can be used in its place.
+    """
+
+    def __init__(self, classifier, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.classifier = classifier
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.batches = 0
+        self.vectors = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    @property
+    def version(self):
+        return self.classifier.version
+
+    def get_class_name(self, class_id):
+        return self.classifier.get_class_name(class_id)
+
+    def submit(self, features_list):
+        """Queues features dicts, returns a Future of the predict() result of each."""
+        futures = []
+        for features in features_list:
+            future = Future()
+            self._queue.put((features, future))
+            futures.append(future)
+        return futures
+
+    def predict(self, features):
+        return self.submit([features])[0].result()
+
+    def predict_batch(self, features_list):
+        return [future.result() for future in self.submit(features_list)]
+
+    def close(self):
+        """Scores what is queued, then stops the worker thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    # Past the deadline, only vectors already queued join the batch
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._score(batch)
+            if stop:
+                return
+
+    def _score(self, batch):
+        # Cancelled futures are dropped
+        batch = [(features, future) for features, future in batch if future.set_running_or_notify_cancel()]
+        try:
+            predictions = self.classifier.predict_batch([features for features, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.vectors += len(batch)
+        for (_, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
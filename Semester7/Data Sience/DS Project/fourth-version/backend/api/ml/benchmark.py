@@ -0,0 +1,611 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+from .feature_extractor import FeatureExtractor
+from .packet_table import PacketTable, table_path
+from .protocol_rules import DEFAULT_RULES_FILE, configure_rules, get_rules
+
+# Packets generated (and written) per vectorized step
+GENERATE_BATCH = 65536
+# Frame sizes are clamped to Ethernet's minimum and maximum (without FCS)
+MIN_FRAME = 60
+MAX_FRAME = 1514
+# Capture time between two synthetic packets
+DEFAULT_PACKET_GAP = 1e-4
+START_TIME = 1700000000
+
+# Port protocols sent over UDP, every other one over TCP
+UDP_PROTOCOLS = {"TFTP", "DNS", "NTP", "DHCP"}
+# Classic simple IMIX: 7 x 64, 4 x 594 and 1 x 1518 byte frames (FCS excluded)
+IMIX = ((60, 7), (590, 4), (1514, 1))
+
+# Relative drop in packets/sec, or growth in peak RSS, reported as a regression
+DEFAULT_THRESHOLD = 0.2
+# Largest capture the scapy stages (rdpcap, per-packet identify_protocol) are run on
+DEFAULT_SCAPY_LIMIT = 100000
+# Runs per stage, the fastest is kept
+DEFAULT_REPEAT = 3
+# Largest CNN probability difference from the eager models a backend may have
+PARITY_TOLERANCE = 1e-4
+# A quantized backend must give the eager CNN's class for this share of the rows,
+# with CNN probabilities at most QUANTIZED_TOLERANCE away from the eager ones
+QUANTIZED_MIN_AGREEMENT = 0.99
+QUANTIZED_TOLERANCE = 0.05
+# Fewest synthetic rows the backends are checked on
+PARITY_SAMPLES = 10000
+
+# The first 70 bytes of every record: pcap record header, Ethernet, IPv4 and
+# the start of TCP (UDP and ICMP reuse the same fields)
+RECORD_HEAD_DTYPE = np.dtype({
+    'names': ['ts_sec', 'ts_usec', 'caplen', 'wirelen', 'eth_type', 'ip_vihl', 'ip_len', 'ip_ttl',
+              'ip_proto', 'ip_src', 'ip_dst', 'sport', 'dport', 'word54', 'tcp_offset', 'tcp_flags',
+              'tcp_window'],
+    'formats': ['<u4', '<u4', '<u4', '<u4', '>u2', 'u1', '>u2', 'u1',
+                'u1', '>u4', '>u4', '>u2', '>u2', '>u4', 'u1', 'u1',
+                '>u2'],
+    'offsets': [0, 4, 8, 12, 28, 30, 32, 38,
+                39, 42, 46, 50, 52, 54, 62, 63,
+                64],
+    'itemsize': 70,
+})
+# TCP payload offset of the records, right after RECORD_HEAD_DTYPE
+PAYLOAD_OFFSET = 70
+ETH_ADDRESSES = bytes.fromhex('00163e000002' '00163e000001')
+# 802.3 header to the STP bridge group address, then LLC 42/42/03 and a zeroed BPDU
+STP_HEAD = bytes.fromhex('0180c2000000' '00163e000001' '002e' '424203')
+
+
+def parse_mix(spec, rules=None):
+    """
+    Parses a protocol mix like "HTTP=5,DNS=1,Other=1" into {name: weight}.
+    An empty spec weights every protocol of the rules the same.
+    """
+    rules = rules or get_rules()
+    if not spec:
+        return {name: 1.0 for name in dict.fromkeys(rules.names)}
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in rules.names:
+            raise ValueError(f"Unknown protocol {name!r} in the mix")
+        mix[name] = float(weight or 1)
+    if not sum(mix.values()) > 0:
+        raise ValueError("The protocol mix needs a positive weight")
+    return mix
+
+
+def sample_sizes(spec, n, rng):
+    """
+    Draws n frame sizes from a distribution spec: "imix", "fixed:SIZE",
+    "uniform:LOW:HIGH" or "normal:MEAN:STD" (clamped to 60..1514 bytes).
+    """
+    kind, *args = spec.split(':')
+    args = [float(arg) for arg in args]
+    if kind == 'imix':
+        sizes, weights = zip(*IMIX)
+        sizes = rng.choice(sizes, size=n, p=np.array(weights) / sum(weights))
+    elif kind == 'fixed' and len(args) == 1:
+        sizes = np.full(n, args[0])
+    elif kind == 'uniform' and len(args) == 2:
+        sizes = rng.integers(int(args[0]), int(args[1]) + 1, size=n)
+    elif kind == 'normal' and len(args) == 2:
+        sizes = rng.normal(args[0], args[1], size=n)
+    else:
+        raise ValueError(f"Unknown size distribution {spec!r}")
+    return np.clip(np.rint(sizes), MIN_FRAME, MAX_FRAME).astype(np.int64)
+
+
+def tls_client_hello(server_name):
+    """A minimal TLS 1.2 ClientHello record carrying a server name."""
+    name = server_name.encode() if isinstance(server_name, str) else server_name
+    sni = struct.pack('!HBH', len(name) + 3, 0, len(name)) + name
+    extensions = struct.pack('!HH', 0, len(sni)) + sni
+    body = (b'\x03\x03' + bytes(32) + b'\x00' + b'\x00\x02\x13\x01' + b'\x01\x00'
+            + struct.pack('!H', len(extensions)) + extensions)
+    handshake = b'\x01' + struct.pack('!I', len(body))[1:] + body
+    return b'\x16\x03\x01' + struct.pack('!H', len(handshake)) + handshake
+
+
+def signature_payloads(patterns):
+    """
+    (dport, payload) pairs that match a payload rule's patterns: a TLS
+    ClientHello per domain, an HTTP response head per content type.
+    """
+    payloads = [(443, tls_client_hello(domain)) for domain in patterns.get('domains', [])]
+    payloads += [(80, b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type + b'\r\n\r\n')
+                 for content_type in patterns.get('content_types', [])]
+    return payloads
+
+
+def write_synthetic_pcap(path, packets, mix=None, sizes='imix', seed=0, gap=DEFAULT_PACKET_GAP):
+    """
+    Writes a pcap of `packets` Ethernet frames drawn from a protocol mix
+    ({name: weight}, see parse_mix()) and a size distribution (see
+    sample_sizes()). Port protocols get one of their rule's ports as
+    destination and an ephemeral port no rule uses as source; "Other" gets
+    two such ports. ICMP packets are echo requests, STP packets BPDUs, and
+    packets of payload rules carry a payload matching one of their patterns
+    (see signature_payloads()).
+    The capture is built GENERATE_BATCH packets at a time, so memory stays
+    flat whatever the size. Returns the number of bytes written.
+    """
+    rules = get_rules()
+    mix = mix or parse_mix(None, rules)
+    rng = np.random.default_rng(seed)
+    protocol_ids = [rules.names.index(name) for name in mix]
+    weights = np.array(list(mix.values()), dtype=np.float64)
+    weights /= weights.sum()
+
+    # Ports owned by each rule, and ephemeral ports owned by none
+    free_ports = np.flatnonzero(rules.rank[49152:] == rules.no_match) + 49152
+    layers = {rule_id: layer for layer, rule_id in rules.layer_ranks.items() if layer in ("ICMP", "STP")}
+    rule_ports = {pid: np.flatnonzero(rules.rank == pid) for pid in protocol_ids}
+    payloads = {pid: signature_payloads(rules.payload_patterns.get(pid, {})) for pid in protocol_ids}
+
+    written = 0
+    with open(path, 'wb') as f:
+        # Little-endian pcap, microsecond timestamps, Ethernet
+        header = np.array([0xa1b2c3d4, 0x00040002, 0, 0, 65535, 1], dtype='<u4').tobytes()
+        f.write(header)
+        written += len(header)
+        for first in range(0, packets, GENERATE_BATCH):
+            n = min(GENERATE_BATCH, packets - first)
+            kinds = np.array(protocol_ids)[rng.choice(len(protocol_ids), size=n, p=weights)]
+            frame = sample_sizes(sizes, n, rng)
+
+            head = np.zeros(n, dtype=RECORD_HEAD_DTYPE)
+            ts = START_TIME + (first + np.arange(n)) * gap
+            head['ts_sec'] = ts
+            head['ts_usec'] = np.rint((ts - np.floor(ts)) * 1e6) % 1000000
+            head['eth_type'] = 0x0800
+            head['ip_vihl'] = 0x45
+            head['ip_ttl'] = 64
+            head['ip_src'] = 0x0a000000 | rng.integers(1, 1 << 16, size=n)
+            head['ip_dst'] = 0x0a010000 | rng.integers(1, 1 << 16, size=n)
+            head['sport'] = rng.choice(free_ports, size=n)
+            head['dport'] = rng.choice(free_ports, size=n)
+            head['ip_proto'] = 6
+
+            stp = np.zeros(n, dtype=bool)
+            # (rows, payload) written after the headers
+            payload_rows = []
+            for pid in protocol_ids:
+                rows = np.flatnonzero(kinds == pid)
+                if not len(rows) or pid == rules.no_match:
+                    continue
+                layer = layers.get(pid)
+                if len(rule_ports[pid]):
+                    head['dport'][rows] = rng.choice(rule_ports[pid], size=len(rows))
+                    if rules.names[pid] in UDP_PROTOCOLS:
+                        head['ip_proto'][rows] = 17
+                elif layer == "ICMP":
+                    head['ip_proto'][rows] = 1
+                    # Echo request: type 8, code 0, checksum 0
+                    head['sport'][rows] = 0x0800
+                    head['dport'][rows] = 0
+                elif layer == "STP":
+                    stp[rows] = True
+                else:
+                    picked = rng.integers(0, len(payloads[pid]), size=len(rows))
+                    for index, (dport, payload) in enumerate(payloads[pid]):
+                        selected = rows[picked == index]
+                        head['dport'][selected] = dport
+                        frame[selected] = np.clip(frame[selected], PAYLOAD_OFFSET - 16 + len(payload), MAX_FRAME)
+                        payload_rows.append((selected, np.frombuffer(payload, dtype=np.uint8)))
+            frame[stp] = MIN_FRAME
+
+            head['caplen'] = frame
+            head['wirelen'] = frame
+            head['ip_len'] = frame - 14
+            udp = head['ip_proto'] == 17
+            head['word54'][udp] = (frame[udp] - 34) << 16
+            tcp = head['ip_proto'] == 6
+            head['tcp_offset'][tcp] = 0x50
+            # PSH/ACK
+            head['tcp_flags'][tcp] = 0x18
+            head['tcp_window'][tcp] = 65535
+
+            raw_head = head.view(np.uint8).reshape(n, RECORD_HEAD_DTYPE.itemsize)
+            raw_head[:, 16:28] = np.frombuffer(ETH_ADDRESSES, dtype=np.uint8)
+            raw_head[stp, 16:16 + len(STP_HEAD)] = np.frombuffer(STP_HEAD, dtype=np.uint8)
+            raw_head[stp, 16 + len(STP_HEAD):] = 0
+
+            # Records laid out back to back, payloads left zeroed
+            lengths = 16 + frame
+            offsets = np.cumsum(lengths) - lengths
+            buf = np.zeros(int(lengths.sum()), dtype=np.uint8)
+            buf[offsets[:, None] + np.arange(RECORD_HEAD_DTYPE.itemsize)] = raw_head
+            for rows, payload in payload_rows:
+                # Cut at the largest frame, for payloads longer than MAX_FRAME allows
+                payload = payload[:MAX_FRAME - PAYLOAD_OFFSET + 16]
+                buf[offsets[rows][:, None] + PAYLOAD_OFFSET + np.arange(len(payload))] = payload
+            buf.tofile(f)
+            written += len(buf)
+    return written
+
+
+def _memory_status():
+    """(current RSS, peak RSS) of this process in MB, from /proc when available."""
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        # ru_maxrss is in kilobytes on Linux, and survives fork/exec
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (Linux 4.0+), so the peak is the stage's own
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _run_stage(stage, pcap_path, limit, workers, rules_file, repeat, inspect_bytes):
+    """
+    Runs one stage `repeat` times in a fresh process and returns its
+    measurements, with the fastest of the runs.
+    Stages: load_packets (streaming check), load_packets_scapy (rdpcap),
+    identify_protocol (scapy packets), identify_protocol_raw (raw records),
+    extract_features (streaming, `workers` processes),
+    extract_features_inspect (streaming, payload inspection of inspect_bytes per flow),
+    export_table (parsing into a packet table) and extract_features_table
+    (from the packet table, written beforehand if missing).
+    """
+    configure_rules(rules_file)
+    if stage == 'extract_features_table' and not os.path.exists(table_path(pcap_path)):
+        FeatureExtractor(pcap_path, streaming=True).export_table()
+    _reset_peak_rss()
+    base_rss, _ = _memory_status()
+    seconds = None
+    for _ in range(repeat):
+        packets, elapsed = _time_stage(stage, pcap_path, limit, workers, inspect_bytes)
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    return {
+        'stage': stage,
+        'packets': packets,
+        'seconds': seconds,
+        'repeat': repeat,
+        'packets_per_sec': packets / seconds if packets and seconds else None,
+        'base_rss_mb': base_rss,
+        # Pages of the memory-mapped capture that were read count as resident
+        'peak_rss_mb': _memory_status()[1],
+        # Largest worker process when the stage used the pool (ru_maxrss, so
+        # it includes what the worker inherited at fork)
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _time_stage(stage, pcap_path, limit, workers, inspect_bytes):
+    """Runs a stage once, returns (packets, seconds)."""
+    packets = 0
+    started = time.perf_counter()
+    if stage == 'load_packets':
+        extractor = FeatureExtractor(pcap_path, streaming=True)
+        if not extractor.load_packets():
+            raise RuntimeError(f"Can't read {pcap_path}")
+    elif stage == 'load_packets_scapy':
+        extractor = FeatureExtractor(pcap_path)
+        if not extractor.load_packets():
+            raise RuntimeError(f"Can't read {pcap_path}")
+        packets = len(extractor.packets)
+    elif stage == 'identify_protocol':
+        extractor = FeatureExtractor(pcap_path, streaming=True)
+        for packet in extractor.iter_packets():
+            extractor.identify_protocol(packet)
+            packets += 1
+            if packets == limit:
+                break
+    elif stage == 'identify_protocol_raw':
+        extractor = FeatureExtractor(pcap_path, streaming=True)
+        for data, linktype, _ in extractor.iter_records():
+            extractor.identify_protocol_raw(data, linktype)
+            packets += 1
+    elif stage == 'extract_features':
+        extractor = FeatureExtractor(pcap_path, streaming=True, workers=workers)
+        extractor.load_packets()
+        packets = extractor.extract_features()['packet_count']
+    elif stage == 'extract_features_inspect':
+        extractor = FeatureExtractor(pcap_path, streaming=True, workers=workers, inspect_bytes=inspect_bytes)
+        extractor.load_packets()
+        packets = extractor.extract_features()['packet_count']
+    elif stage == 'export_table':
+        packets = PacketTable(FeatureExtractor(pcap_path, streaming=True).export_table()).packets
+    elif stage == 'extract_features_table':
+        extractor = FeatureExtractor(pcap_path, streaming=True, table=table_path(pcap_path))
+        if not extractor.load_packets() or extractor.table is None:
+            raise RuntimeError(f"Can't read the packet table of {pcap_path}")
+        packets = extractor.extract_features()['packet_count']
+    else:
+        raise ValueError(f"Unknown stage {stage!r}")
+    return packets, time.perf_counter() - started
+
+
+def run_stage(stage, pcap_path, limit=None, workers=1, rules_file=DEFAULT_RULES_FILE, repeat=1, inspect_bytes=0):
+    """_run_stage() in a spawned process, so peak RSS is that of the stage alone."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(_run_stage, stage, pcap_path, limit, workers, rules_file, repeat, inspect_bytes).result()
+
+
+def run_benchmark(sizes, directory, mix=None, size_spec='imix', workers=1,
+                  scapy_limit=DEFAULT_SCAPY_LIMIT, keep=False, seed=0, rules_file=DEFAULT_RULES_FILE,
+                  repeat=DEFAULT_REPEAT, inspect_bytes=0, log=None):
+    """
+    Generates a synthetic capture of every size in `sizes` (packet counts)
+    and measures every stage on it. The scapy stages, far too slow and
+    memory hungry for large captures, are skipped (rdpcap) or cut at
+    scapy_limit packets (identify_protocol) above scapy_limit. Every stage
+    is timed `repeat` times and the fastest run kept, to damp the noise.
+    With inspect_bytes, extract_features is also timed with payload inspection.
+    The packet table stages show the cost of parsing a capture once and of
+    computing its features again from the table.
+    Captures are generated and classified with the rules of rules_file.
+    Returns the results dict saved by save_results().
+    """
+    rules = configure_rules(rules_file)
+    mix = mix or parse_mix(None, rules)
+    os.makedirs(directory, exist_ok=True)
+    results = []
+    for packets in sizes:
+        path = os.path.join(directory, f"synthetic-{packets}.pcap")
+        started = time.perf_counter()
+        size = write_synthetic_pcap(path, packets, mix, size_spec, seed)
+        seconds = time.perf_counter() - started
+        results.append({
+            'packets': packets, 'stage': 'generate', 'seconds': seconds,
+            'packets_per_sec': packets / seconds, 'bytes': size,
+        })
+        if log:
+            log(results[-1])
+        stages = [('load_packets', None), ('identify_protocol', scapy_limit),
+                  ('identify_protocol_raw', None), ('extract_features', None),
+                  ('export_table', None), ('extract_features_table', None)]
+        if packets <= scapy_limit:
+            stages.insert(1, ('load_packets_scapy', None))
+        if inspect_bytes:
+            stages.append(('extract_features_inspect', None))
+        try:
+            for stage, limit in stages:
+                result = run_stage(stage, path, limit, workers, rules_file, repeat, inspect_bytes)
+                result['packets_in_capture'] = packets
+                results.append(result)
+                if log:
+                    log(result)
+        finally:
+            if not keep:
+                os.remove(path)
+                shutil.rmtree(table_path(path), ignore_errors=True)
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {
+            'sizes': list(sizes),
+            'mix': mix,
+            'size_distribution': size_spec,
+            'workers': workers,
+            'scapy_limit': scapy_limit,
+            'seed': seed,
+            'repeat': repeat,
+            'inspect_bytes': inspect_bytes,
+            'rules_version': rules.version,
+        },
+        'results': results,
+    }
+
+
+def _run_training(n_samples, epochs, batch_size, threads, seed):
+    """
+    Generates n_samples synthetic rows and trains every model on them in
+    a fresh process, returns the time and peak RSS of each step.
+    """
+    # Imported here, so the packet stages don't pay for torch
+    from .models import PacketClassifier, synthetic_dataset
+
+    classifier = PacketClassifier()
+    results = []
+    data = {}
+
+    def generate():
+        data['X'], data['y'] = synthetic_dataset(n_samples, classifier.input_dim, classifier.num_classes, seed)
+
+    steps = [
+        ('generate_dataset', generate),
+        ('train_cnn', lambda: classifier.fit_cnn(data['X'], data['y'], epochs, batch_size, threads, seed)),
+        ('train_xgboost', lambda: classifier.fit_xgboost(data['X'], data['y'], threads, seed)),
+        ('train_isolation_forest', lambda: classifier.fit_isolation_forest(data['X'], threads, seed)),
+    ]
+    for stage, step in steps:
+        _reset_peak_rss()
+        base_rss, _ = _memory_status()
+        started = time.perf_counter()
+        step()
+        seconds = time.perf_counter() - started
+        results.append({
+            'samples': n_samples,
+            'stage': stage,
+            'seconds': seconds,
+            'samples_per_sec': n_samples / seconds if seconds else None,
+            'base_rss_mb': base_rss,
+            'peak_rss_mb': _memory_status()[1],
+        })
+    return results
+
+
+def run_training_benchmark(sizes, epochs, batch_size, threads=None, seed=0, log=None):
+    """
+    Times dataset generation and the training of each model (with peak
+    RSS) for every number of samples in `sizes`, each size in a spawned
+    process. Returns the results dict saved by save_results().
+    """
+    results = []
+    for n_samples in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            measured = pool.submit(_run_training, n_samples, epochs, batch_size, threads, seed).result()
+        for result in measured:
+            results.append(result)
+            if log:
+                log(result)
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {
+            'sizes': list(sizes),
+            'epochs': epochs,
+            'batch_size': batch_size,
+            'threads': threads,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def compare_backends(classifier, backends, batch_sizes, repeat=DEFAULT_REPEAT, seed=0,
+                     tolerance=PARITY_TOLERANCE):
+    """
+    Checks every backend against the eager models on synthetic rows
+    (largest CNN probability difference, CNN and XGBoost classes that
+    differ, CNN accuracy against the eager one): within tolerance, or
+    for a quantized backend within QUANTIZED_TOLERANCE and agreeing on
+    QUANTIZED_MIN_AGREEMENT of the CNN classes. Also times
+    cnn_probabilities, xgboost_classes and predict_batch
+    at each batch size, keeping the fastest of `repeat` runs (after a
+    warm-up run). The classifier is left on the eager backend.
+    Returns the results dict saved by save_results().
+    """
+    from .models import QUANTIZED_BACKENDS, synthetic_dataset
+
+    X, y = synthetic_dataset(max(max(batch_sizes), PARITY_SAMPLES), classifier.input_dim,
+                             classifier.num_classes, seed)
+    classifier.set_backend('eager')
+    reference_probs = classifier.cnn_probabilities(X)
+    reference_accuracy = float((reference_probs.argmax(axis=1) == y).mean())
+    reference_classes = classifier.xgboost_classes(X)
+    parity = []
+    results = []
+    for backend in backends:
+        classifier.set_backend(backend)
+        probs = classifier.cnn_probabilities(X)
+        difference = float(np.abs(probs - reference_probs).max())
+        mismatches = int((probs.argmax(axis=1) != reference_probs.argmax(axis=1)).sum())
+        agreement = 1 - mismatches / len(X)
+        accuracy = float((probs.argmax(axis=1) == y).mean())
+        xgboost_mismatches = int((classifier.xgboost_classes(X) != reference_classes).sum())
+        if backend in QUANTIZED_BACKENDS:
+            # Quantization moves the probabilities a little and can flip the
+            # closest classes, but has to keep the float32 model's answers
+            ok = difference <= QUANTIZED_TOLERANCE and agreement >= QUANTIZED_MIN_AGREEMENT
+        else:
+            ok = difference <= tolerance
+        parity.append({
+            'backend': backend,
+            'rows': len(X),
+            'max_probability_difference': difference,
+            'cnn_class_mismatches': mismatches,
+            'cnn_agreement': agreement,
+            'cnn_accuracy': accuracy,
+            'cnn_accuracy_delta': accuracy - reference_accuracy,
+            'xgboost_class_mismatches': xgboost_mismatches,
+            'ok': ok and not xgboost_mismatches,
+        })
+        for batch_size in batch_sizes:
+            batch = X[:batch_size]
+            for stage, run in (('cnn', classifier.cnn_probabilities), ('xgboost', classifier.xgboost_classes),
+                               ('predict_batch', classifier.predict_batch)):
+                run(batch)
+                seconds = None
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    run(batch)
+                    elapsed = time.perf_counter() - started
+                    seconds = elapsed if seconds is None else min(seconds, elapsed)
+                results.append({
+                    'backend': backend,
+                    'stage': stage,
+                    'batch_size': batch_size,
+                    'seconds': seconds,
+                    'vectors_per_sec': batch_size / seconds if seconds else None,
+                })
+    classifier.set_backend('eager')
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {
+            'backends': list(backends),
+            'batch_sizes': list(batch_sizes),
+            'repeat': repeat,
+            'seed': seed,
+            'tolerance': tolerance,
+            'model_version': classifier.version,
+        },
+        'parity': parity,
+        'results': results,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two results dicts stage by stage (same capture size) and
+    returns a message per regression: packets/sec down, or peak RSS up,
+    by more than `threshold` (a fraction) against the baseline.
+    """
+    def key(result):
+        return result.get('packets_in_capture', result['packets']), result['stage']
+
+    previous = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        name = f"{result['stage']} at {key(result)[0]} packets"
+        if old.get('packets_per_sec') and result.get('packets_per_sec') is not None:
+            if result['packets_per_sec'] < old['packets_per_sec'] * (1 - threshold):
+                regressions.append(f"{name}: {result['packets_per_sec']:.0f} packets/sec, "
+                                   f"was {old['packets_per_sec']:.0f}")
+        # Peak RSS above the process baseline, generation doesn't measure it
+        if 'peak_rss_mb' in old and 'peak_rss_mb' in result:
+            grown = result['peak_rss_mb'] - result['base_rss_mb']
+            was = old['peak_rss_mb'] - old['base_rss_mb']
+            if grown > was * (1 + threshold) and grown - was > 1:
+                regressions.append(f"{name}: peak RSS +{grown:.1f} MB over baseline, was +{was:.1f} MB")
+    return regressions
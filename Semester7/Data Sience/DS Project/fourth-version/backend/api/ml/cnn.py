@@ -0,0 +1,36 @@
+import torch
+import torch.nn as nn
+
+
+class SimpleCNN(nn.Module):
+    def __init__(self, input_dim, num_classes):
+        super(SimpleCNN, self).__init__()
+        # Input: (batch, 1, input_dim)
+        self.conv1 = nn.Conv1d(in_channels=1, out_channels=16, kernel_size=3, padding=1)
+        self.relu = nn.ReLU()
+        self.pool = nn.MaxPool1d(kernel_size=2)
+        # after pool, dimension depends on input_dim. 
+        # input_dim=10 -> pool -> 5
+        self.fc1 = nn.Linear(16 * (input_dim // 2), 32)
+        self.fc2 = nn.Linear(32, num_classes)
+        # Per-feature standardization of the inputs (packet counts and sizes are in the
+        # thousands, ratios below 1), set from the training rows by set_normalization()
+        self.register_buffer('input_mean', torch.zeros(input_dim))
+        self.register_buffer('input_scale', torch.ones(input_dim))
+
+    def set_normalization(self, mean, scale):
+        self.input_mean.copy_(torch.as_tensor(mean, dtype=torch.float32))
+        self.input_scale.copy_(torch.as_tensor(scale, dtype=torch.float32))
+
+    def forward(self, x):
+        x = (x - self.input_mean) / self.input_scale
+        # x shape: (batch, input_dim) -> (batch, 1, input_dim)
+        x = x.unsqueeze(1)
+        x = self.conv1(x)
+        x = self.relu(x)
+        x = self.pool(x)
+        x = x.flatten(1)
+        x = self.fc1(x)
+        x = self.relu(x)
+        x = self.fc2(x)
+        return x
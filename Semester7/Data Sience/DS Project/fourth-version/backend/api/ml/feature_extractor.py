@@ -1,21 +1,317 @@
+import atexit
+import os
+import socket
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import scapy.all as scapy
 import numpy as np
-from collections import Counter
+
+from .flows import DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_FLOWS, FlowTable, flow_key
+from .packet_decoder import decode_flow, decode_headers, dissect
+from .packet_table import PacketTable, PacketTableWriter, address_keys, table_path, unpack_address
+from .pcap_io import (MappedCapture, RECORD_HEADER_DTYPE, detect_compression, open_capture, open_decompressed,
+                      read_format)
+from .protocol_rules import get_rules
+from .signatures import PayloadInspector
+from .sketches import TalkerSketch
+from .stats import RunningStats, normal_quantile, proportion_interval
+
+# Captures smaller than this are not worth splitting across processes
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+# More chunks than workers so a slow chunk doesn't hold up the others
+CHUNKS_PER_WORKER = 4
+# Seconds of capture time per window in the windowed feature series
+DEFAULT_WINDOW = 5.0
+
+# One process pool per worker count, kept for the lifetime of the server
+# process and shut down when it exits
+_pools = {}
+
+
+def get_pool(workers):
+    if workers not in _pools:
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[workers]
+
+
+def shutdown_pools():
+    """Shuts down the process pools, waiting for their workers to exit."""
+    while _pools:
+        _, pool = _pools.popitem()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_pools)
+
+
+class CaptureAggregate:
+    """
+    Aggregates of (part of) a capture: size statistics and per-protocol counts.
+    Aggregates of separate chunks merge exactly into the aggregate of the whole,
+    as long as they were classified with the same protocol rules.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else get_rules()
+        self.sizes = RunningStats()
+        self.protocol_totals = np.zeros(len(self.rules.protocols), dtype=np.int64)
+
+    def add_batch(self, sizes, sports, dports, layer_ranks):
+        """
+        Adds a batch of packets, classified in one vectorized lookup.
+        Takes array('I')/array('H') buffers.
+        """
+        protocol_ids = self.rules.classify(
+            np.frombuffer(sports, dtype=np.uint16),
+            np.frombuffer(dports, dtype=np.uint16),
+            np.frombuffer(layer_ranks, dtype=np.uint16),
+        )
+        self.add_classified(np.frombuffer(sizes, dtype=np.uint32), protocol_ids)
+
+    def add_classified(self, sizes, protocol_ids):
+        """Adds a batch of packets already classified, as numpy arrays."""
+        self.sizes.push_many(sizes)
+        self.protocol_totals += self.rules.count(protocol_ids)
+
+    def merge(self, other):
+        if other.rules.version != self.rules.version:
+            raise ValueError("Can't merge aggregates classified with different protocol rules")
+        self.sizes.merge(other.sizes)
+        self.protocol_totals += other.protocol_totals
+        return self
+
+    def to_features(self):
+        """Builds the features dict, None if no packet was seen."""
+        size_stats = self.sizes
+        protocol_stats, count_map = self.rules.summarize(self.protocol_totals)
+
+        total_packets = size_stats.count
+        if not total_packets:
+            return None
+        
+        # Feature vector (numeric)
+        # We add class ratios as features to help the model "cheat" correctly
+        features = {
+            'avg_packet_size': size_stats.mean,
+            'std_packet_size': size_stats.std,
+            'min_packet_size': size_stats.min,
+            'max_packet_size': size_stats.max,
+            'packet_count': total_packets,
+            
+            # Key features for our "perfect" classifier
+            'ratio_A': count_map[0] / total_packets if total_packets else 0,
+            'ratio_B': count_map[1] / total_packets if total_packets else 0,
+            'ratio_C': count_map[2] / total_packets if total_packets else 0,
+            'ratio_D': count_map[3] / total_packets if total_packets else 0,
+            'ratio_E': count_map[4] / total_packets if total_packets else 0,
+            
+            # Rich stats for frontend (not necessarily used by model)
+            'protocol_counts': protocol_stats,
+            'class_counts': count_map
+        }
+        
+        return features
+
+
+class WindowSeries:
+    """
+    Splits classified packets into fixed windows of capture time.
+
+    Window i covers [i * window, (i + 1) * window) seconds since the epoch,
+    so windows computed separately (e.g. chunks of one capture) line up.
+    Packets are expected in time order, a late packet is counted in the
+    window open when it arrives. A window is closed and queued in
+    self.closed as (window_id, CaptureAggregate) as soon as a packet of a
+    later window arrives, so only one window is held at a time.
+    protocol_ids must come from `rules` (a PortRuleTable, the current one by default).
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, rules=None):
+        self.window = window
+        self.rules = rules if rules is not None else get_rules()
+        self.current = None
+        self.aggregate = None
+        self.closed = deque()
+
+    def add_batch(self, timestamps, sizes, protocol_ids):
+        """Adds numpy arrays of timestamps, sizes and protocol ids."""
+        if not len(timestamps):
+            return
+        window_ids = np.floor_divide(timestamps, self.window).astype(np.int64)
+        if self.current is not None:
+            window_ids[0] = max(window_ids[0], self.current)
+        # Late packets stay in the open window
+        np.maximum.accumulate(window_ids, out=window_ids)
+
+        cuts = (np.flatnonzero(np.diff(window_ids)) + 1).tolist()
+        for lo, hi in zip([0] + cuts, cuts + [len(window_ids)]):
+            window_id = int(window_ids[lo])
+            # A window flushed early is reopened by its late packets
+            if window_id != self.current or self.aggregate is None:
+                self.flush()
+                self.current = window_id
+                self.aggregate = CaptureAggregate(self.rules)
+            self.aggregate.add_classified(sizes[lo:hi], protocol_ids[lo:hi])
+
+    def flush(self):
+        """Closes the open window."""
+        if self.aggregate is not None:
+            self.closed.append((self.current, self.aggregate))
+            self.aggregate = None
+
+
+def window_features(window_id, aggregate, window):
+    """
+    Features dict of a closed window: the same features as extract_features()
+    plus window_start and window_end (epoch seconds) and byte_count.
+    """
+    features = aggregate.to_features()
+    features['window_start'] = window_id * window
+    features['window_end'] = (window_id + 1) * window
+    features['byte_count'] = aggregate.sizes.total
+    return features
+
+
+def _extract_chunk(pcap_path, start, end, resync=True, window=None, talkers=False, rules=None):
+    """
+    Worker side of FeatureExtractor.aggregate_parallel().
+    Aggregates the records starting in [start, end) and returns
+    (aggregate, windows, talkers, first record offset, offset after the last record, section_change),
+    where windows is the list of (window_id, CaptureAggregate) if window is set
+    and talkers the TalkerSketch of the range if talkers is set.
+    With resync, start is any byte offset and the first record is searched for.
+    rules is the PortRuleTable of the parent, so that a reload never splits a capture.
+    """
+    extractor = FeatureExtractor(pcap_path, streaming=True, talkers=talkers, rules=rules)
+    with MappedCapture(pcap_path) as capture:
+        if resync and start != capture.format.data_offset:
+            start = capture.find_record_start(start)
+        state = {}
+        if window is None:
+            aggregate = extractor.aggregate_mapped(capture, start, end, state)
+            windows = None
+        else:
+            aggregate = CaptureAggregate(extractor.rules)
+            series = WindowSeries(window, extractor.rules)
+            for table, protocol_ids in extractor.classify_mapped(capture, start, end, state):
+                series.add_batch(table['ts'], table['caplen'], protocol_ids)
+            series.flush()
+            windows = list(series.closed)
+            for _, window_aggregate in windows:
+                aggregate.merge(window_aggregate)
+    return aggregate, windows, extractor.talkers, start, state["stop"], state["section_change"]
+
 
 class FeatureExtractor:
-    def __init__(self, pcap_path):
+    # Packets classified per vectorized lookup
+    BATCH_SIZE = 65536
+
+    def __init__(self, pcap_path, streaming=False, workers=1, talkers=False, rules=None, inspect_bytes=0,
+                 table=None):
         self.pcap_path = pcap_path
+        # In streaming mode packets are never held in memory, they are
+        # read one at a time from the capture (pcap or pcapng) by iter_packets().
+        self.streaming = streaming
+        # Processes used to extract large captures in streaming mode
+        self.workers = workers
         self.packets = None
+        self.capture_format = None
+        # Top hosts, ports and conversations, updated by every pass over the
+        # packets when enabled (see TalkerSketch)
+        self.talkers = TalkerSketch() if talkers else None
+        # Protocol rules (PortRuleTable) used for the lifetime of the
+        # extractor, even if the rules file is reloaded meanwhile
+        self.rules = rules if rules is not None else get_rules()
+        # Payload signatures (TLS SNI, HTTP Host/Content-Type) looked for in the
+        # first inspect_bytes of every flow; 0, or rules without payload
+        # patterns, leaves the classification to ports and layers
+        self.inspector = None
+        if inspect_bytes and self.rules.signatures is not None:
+            self.inspector = PayloadInspector(self.rules, inspect_bytes)
+        # Packet table of the capture (see packet_table) to compute the
+        # features from instead of parsing the capture, if it is up to date
+        self.table_path = table
+        self.table = None
 
     def load_packets(self):
-        """Reads the pcap file."""
+        """
+        Reads the pcap file.
+        In streaming mode this only checks that the capture can be opened.
+        With an up-to-date packet table nothing is read from the capture.
+        """
+        if self.table_path is not None and self.load_table():
+            return True
         try:
-            self.packets = scapy.rdpcap(self.pcap_path)
+            if self.streaming:
+                # Detects pcap or pcapng (compressed or not) from the magic numbers
+                with open_capture(self.pcap_path) as capture:
+                    self.capture_format = capture.format
+            else:
+                with self.open_scapy_source() as source:
+                    self.packets = scapy.rdpcap(source)
             return True
         except Exception as e:
             print(f"Error reading pcap: {e}")
             return False
 
+    def load_table(self):
+        """
+        Opens the packet table passed as table=, if it was written from the
+        capture as it is now with compatible rules. Returns True if it will be used.
+        """
+        if not os.path.exists(self.table_path):
+            return False
+        try:
+            table = PacketTable(self.table_path)
+        except Exception as e:
+            print(f"Error reading packet table: {e}")
+            return False
+        if not table.is_fresh(self.pcap_path) or not table.is_usable(self.rules, self.inspect_bytes()):
+            return False
+        self.table = table
+        return True
+
+    def inspect_bytes(self):
+        """Payload bytes inspected per flow, 0 when not inspecting."""
+        return self.inspector.max_bytes if self.inspector is not None else 0
+
+    def has_packets(self):
+        return self.table is not None or self.streaming or bool(self.packets)
+
+    def open_scapy_source(self):
+        """The capture file opened for scapy, decompressing it on the fly if compressed."""
+        compression = detect_compression(self.pcap_path)
+        if compression is None:
+            return open(self.pcap_path, 'rb')
+        return open_decompressed(self.pcap_path, compression)
+
+    def iter_packets(self):
+        """
+        Yields packets one at a time, either from the loaded list or
+        straight from the capture file when streaming.
+        """
+        if self.packets is not None:
+            yield from self.packets
+            return
+
+        with self.open_scapy_source() as source, scapy.PcapReader(source) as reader:
+            for packet in reader:
+                yield packet
+
+    def iter_records(self):
+        """
+        Yields (raw_bytes, linktype, timestamp) for every record of the
+        capture without dissecting it. Works for pcap and pcapng.
+        raw_bytes is a memoryview into the memory-mapped capture, not a copy
+        (into the decompressed bytes for a compressed capture).
+        """
+        with open_capture(self.pcap_path) as capture:
+            # pcapng records carry their interface linktype, pcap has one per file
+            for _, data, linktype, timestamp, _ in capture.records():
+                yield data, linktype, timestamp
+
     def identify_protocol(self, packet):
         """
         Identifies the protocol and maps it to a class.
@@ -26,11 +322,26 @@ class FeatureExtractor:
         2: Class C (File Transfer)
         3: Class D (Messaging)
         4: Class E (System / Other)
+        The rules themselves are defined in the protocol rules file, see protocol_rules.
+        """
+        layer, sport, dport = self.read_headers(packet)
+        return self.rules.lookup(sport, dport, layer)
+
+    def identify_protocol_raw(self, data, linktype):
+        """Same as identify_protocol() but for a raw capture record."""
+        layer, sport, dport = self.decode_record(data, linktype)
+        return self.rules.lookup(sport, dport, layer)
+
+    def read_headers(self, packet):
         """
-        # Checks for layers first
+        Returns (layer, sport, dport) of a scapy packet, where layer is
+        "ICMP", "STP" or None (see protocol_rules.LAYERS). Payload
+        signatures are only looked for by read_packet() and decode_record().
+        """
+        # ICMP packets have no ports (quoted headers are TCPerror/UDPerror)
         if packet.haslayer(scapy.ICMP):
-            return "ICMP", 4
-        
+            return "ICMP", 0, 0
+
         # Check ports for TCP/UDP
         sport = 0
         dport = 0
@@ -40,89 +351,618 @@ class FeatureExtractor:
         elif packet.haslayer(scapy.UDP):
             sport = packet[scapy.UDP].sport
             dport = packet[scapy.UDP].dport
-        
-        # Class A: Web (HTTP, HTTPS)
-        if 80 in [sport, dport]: return "HTTP", 0
-        if 443 in [sport, dport]: return "HTTPS", 0 # Also WSS, TLS/SSL
-        if 8443 in [sport, dport]: return "HTTPS-Alt", 0
-
-        # Class B: Streaming (RTMP)
-        if 1935 in [sport, dport]: return "RTMP", 1
-        # HLS/MPEG often use 80/443, so hard to distinguish solely by port without deep inspection.
-        # We'll assume high throughput on 80/443 could be streaming, but for now map core ports.
-        
-        # Class C: File Transfer (FTP, SFTP, TFTP)
-        if 20 in [sport, dport] or 21 in [sport, dport]: return "FTP", 2
-        if 990 in [sport, dport]: return "FTPS", 2
-        if 22 in [sport, dport]: return "SFTP", 2 # SSH/SFTP
-        if 69 in [sport, dport]: return "TFTP", 2
-
-        # Class D: Messaging (XMPP, STP? -> Spanning Tree usually layer 2, but user asked for it in Messaging?)
-        # WSS is usually 443 (HTTPS). exact distinction requires payload analysis.
-        if 5222 in [sport, dport] or 5223 in [sport, dport]: return "XMPP", 3
-        
-        # STP - Spanning Tree Protocol (Layer 2)
-        # scapy.layers.l2.STP might be present
-        # but the user listed it under messaging, which is odd. 
-        # Assuming they might mean STOMP (61613)? 
-        # Or just standard STP (L2). I will check for STP layer.
-        # if packet.haslayer(scapy.STP): return "STP", 4  <-- STP is usually system/infra, but user said Class D.
-        # Let's check for standard STP layer but map it to D as requested.
+
+        # STP - Spanning Tree Protocol (Layer 2), always part of scapy.layers.l2
+        layer = "STP" if packet.haslayer(scapy.STP) else None
+        return layer, sport, dport
+
+    def read_flow(self, packet):
+        """
+        Returns (layer, sport, dport, proto, src, dst) of a scapy packet,
+        the same tuple as packet_decoder.decode_flow().
+        """
+        layer, sport, dport = self.read_headers(packet)
+        proto, src, dst = 0, b'', b''
+        if packet.haslayer(scapy.IP):
+            ip = packet[scapy.IP]
+            proto = ip.proto
+            src = socket.inet_pton(socket.AF_INET, ip.src)
+            dst = socket.inet_pton(socket.AF_INET, ip.dst)
+        elif packet.haslayer(scapy.IPv6):
+            ip = packet[scapy.IPv6]
+            proto = ip.nh
+            src = socket.inet_pton(socket.AF_INET6, ip.src)
+            dst = socket.inet_pton(socket.AF_INET6, ip.dst)
+        # The ports may come from a layer behind extension headers or a tunnel
+        if packet.haslayer(scapy.TCP):
+            proto = 6
+        elif packet.haslayer(scapy.UDP):
+            proto = 17
+        return (layer, sport, dport, proto, src, dst)
+
+    def decode_record(self, data, linktype):
+        """
+        Same as read_headers() but reads the headers straight from the raw record.
+        Only records the fast decoder can't handle (exotic link types, tunnels,
+        truncated headers) are dissected with scapy.
+        When talkers are tracked the record is also counted in self.talkers,
+        and with payload inspection a flow that matched a signature gets the
+        signature's rule name as layer.
+        """
+        if self.talkers is not None or self.inspector is not None:
+            layer, sport, dport, proto, src, dst = self.inspect_flow_record(data, linktype)
+            if self.talkers is not None:
+                self.talkers.add(src, dst, sport, dport)
+            return layer, sport, dport
+        decoded = decode_headers(data, linktype)
+        if decoded is None:
+            return self.read_headers(dissect(data, linktype))
+        return decoded
+
+    def decode_flow_record(self, data, linktype):
+        """Same as read_flow() for a raw record."""
+        decoded = decode_flow(data, linktype)
+        if decoded is None:
+            return self.read_flow(dissect(data, linktype))
+        return decoded
+
+    def inspect_flow_record(self, data, linktype):
+        """
+        decode_flow_record(), with the rule name of the payload signature
+        its flow matched as layer when inspecting.
+        """
+        layer, sport, dport, proto, src, dst = self.decode_flow_record(data, linktype)
+        if self.inspector is not None and layer is None and sport:
+            layer = self.inspector.inspect_record(data, linktype, sport, dport, proto, src, dst)
+        return layer, sport, dport, proto, src, dst
+
+    def inspect_flow(self, packet):
+        """Same as inspect_flow_record() for a scapy packet."""
+        layer, sport, dport, proto, src, dst = self.read_flow(packet)
+        if self.inspector is not None and layer is None and sport:
+            l4 = packet[scapy.TCP] if packet.haslayer(scapy.TCP) else packet[scapy.UDP]
+            layer = self.inspector.inspect_payload(bytes(l4.payload), sport, dport, proto, src, dst)
+        return layer, sport, dport, proto, src, dst
+
+    def read_packet(self, packet):
+        """
+        read_headers(), also counting the packet in self.talkers when tracked
+        and looking for payload signatures when inspecting (see decode_record()).
+        """
+        if self.talkers is not None or self.inspector is not None:
+            layer, sport, dport, proto, src, dst = self.inspect_flow(packet)
+            if self.talkers is not None:
+                self.talkers.add(src, dst, sport, dport)
+            return layer, sport, dport
+        return self.read_headers(packet)
+
+    def iter_headers(self):
+        """Yields (size, layer, sport, dport) for every packet of the capture."""
+        if self.streaming:
+            # Streaming decodes headers from the raw bytes instead of full scapy packets
+            for data, linktype, _ in self.iter_records():
+                yield (len(data),) + self.decode_record(data, linktype)
+        else:
+            for p in self.iter_packets():
+                yield (len(p),) + self.read_packet(p)
+
+    def iter_flow_headers(self):
+        """Yields (timestamp, size, layer, sport, dport, proto, src, dst) for every packet."""
+        if self.table is not None:
+            layers = self.table.layers
+            names = ['ts', 'length', 'layer', 'sport', 'dport', 'proto', 'src', 'dst']
+            for batch in self.table.iter_batches(names):
+                src = [unpack_address(address) for address in map(bytes, batch['src'])]
+                dst = [unpack_address(address) for address in map(bytes, batch['dst'])]
+                layer = [layers[code] for code in batch['layer'].tolist()]
+                yield from zip(batch['ts'].tolist(), batch['length'].tolist(), layer, batch['sport'].tolist(),
+                               batch['dport'].tolist(), batch['proto'].tolist(), src, dst)
+            return
+        if self.streaming:
+            for data, linktype, timestamp in self.iter_records():
+                yield (timestamp, len(data)) + self.inspect_flow_record(data, linktype)
+        else:
+            for p in self.iter_packets():
+                yield (float(p.time), len(p)) + self.inspect_flow(p)
+
+    def iter_flow_features(self, max_flows=DEFAULT_MAX_FLOWS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Flow-level mode: yields one features dict per (src, dst, sport, dport, proto)
+        flow as soon as the flow closes (idle timeout, eviction or end of capture).
+        Flows are tracked in a FlowTable capped at max_flows, so memory stays
+        bounded even for a port scan with millions of one-packet flows.
+        """
+        table = FlowTable(max_flows=max_flows, idle_timeout=idle_timeout)
+        expired = table.expired
+        for timestamp, size, layer, sport, dport, proto, src, dst in self.iter_flow_headers():
+            class_id = self.rules.lookup(sport, dport, layer)[1]
+            table.add(flow_key(src, dst, sport, dport, proto), timestamp, size, class_id)
+            while expired:
+                yield expired.popleft()
+        table.close_all()
+        while expired:
+            yield expired.popleft()
+
+    def extract_flow_features(self, max_flows=DEFAULT_MAX_FLOWS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """List version of iter_flow_features(), for captures with a manageable number of flows."""
+        return list(self.iter_flow_features(max_flows=max_flows, idle_timeout=idle_timeout))
+
+    def aggregate(self, headers):
+        """
+        Folds (size, layer, sport, dport) tuples into a CaptureAggregate.
+        Sizes and ports are buffered BATCH_SIZE packets at a time, so memory
+        does not grow with the capture.
+        """
+        aggregate = CaptureAggregate(self.rules)
+        sizes, sports, dports, layer_ranks = array('I'), array('H'), array('H'), array('H')
+        for size, layer, sport, dport in headers:
+            sizes.append(size)
+            sports.append(sport)
+            dports.append(dport)
+            layer_ranks.append(self.rules.layer_rank(layer))
+            if len(sizes) == self.BATCH_SIZE:
+                aggregate.add_batch(sizes, sports, dports, layer_ranks)
+                del sizes[:], sports[:], dports[:], layer_ranks[:]
+        if sizes:
+            aggregate.add_batch(sizes, sports, dports, layer_ranks)
+        return aggregate
+
+    def classify_mapped(self, capture, start=None, end=None, state=None):
+        """
+        Yields (header_table, protocol_ids) for the records starting in
+        [start, end) of a MappedCapture (or StreamedCapture), BATCH_SIZE records at a time.
+        Only the protocol lookup looks at the records one by one.
+        state works as in MappedCapture.header_table(), except that
+        state["section_change"] covers all the batches.
+        """
+        if start is None:
+            start = capture.format.data_offset
+        if state is None:
+            state = {}
+        section_change = False
+        while True:
+            table = capture.header_table(start, end, state, limit=self.BATCH_SIZE)
+            section_change = section_change or state["section_change"]
+            if not len(table):
+                break
+            yield table, self.classify_table(capture, table)
+            start = state["stop"]
+        state["section_change"] = section_change
+
+    def classify_table(self, capture, table):
+        """Protocol ids of the records of a header table (or a selection of its rows)."""
+        view = capture.view
+        return self.classify_records(
+            (view[data_offset:data_offset + caplen], linktype) for data_offset, caplen, linktype in zip(
+                table['data'].tolist(), table['caplen'].tolist(), table['linktype'].tolist()))
+
+    def classify_records(self, records):
+        """Protocol ids of (raw_bytes, linktype) records."""
+        sports, dports, layer_ranks = array('H'), array('H'), array('H')
+        for data, linktype in records:
+            layer, sport, dport = self.decode_record(data, linktype)
+            sports.append(sport)
+            dports.append(dport)
+            layer_ranks.append(self.rules.layer_rank(layer))
+        return self.rules.classify(
+            np.frombuffer(sports, dtype=np.uint16),
+            np.frombuffer(dports, dtype=np.uint16),
+            np.frombuffer(layer_ranks, dtype=np.uint16),
+        )
+
+    def aggregate_mapped(self, capture, start=None, end=None, state=None):
+        """
+        Same as aggregate() for the records starting in [start, end) of a
+        MappedCapture. Size statistics are computed from the header table in numpy.
+        """
+        aggregate = CaptureAggregate(self.rules)
+        for table, protocol_ids in self.classify_mapped(capture, start, end, state):
+            aggregate.add_classified(table['caplen'], protocol_ids)
+        return aggregate
+
+    def iter_batches(self):
+        """
+        Yields (timestamps, sizes, protocol_ids) numpy arrays for the whole
+        capture, BATCH_SIZE packets at a time (more from a packet table).
+        """
+        if self.table is not None:
+            for batch in self.iter_table(['ts', 'length']):
+                yield batch['ts'], batch['length'], batch['protocol_ids']
+            return
+        if self.streaming:
+            with open_capture(self.pcap_path) as capture:
+                for table, protocol_ids in self.classify_mapped(capture):
+                    yield table['ts'], table['caplen'], protocol_ids
+            return
+
+        packets = iter(self.iter_packets())
+        while True:
+            timestamps, sizes, sports, dports, layer_ranks = array('d'), array('I'), array('H'), array('H'), array('H')
+            for p in packets:
+                layer, sport, dport = self.read_packet(p)
+                timestamps.append(float(p.time))
+                sizes.append(len(p))
+                sports.append(sport)
+                dports.append(dport)
+                layer_ranks.append(self.rules.layer_rank(layer))
+                if len(sizes) == self.BATCH_SIZE:
+                    break
+            if not sizes:
+                return
+            protocol_ids = self.rules.classify(
+                np.frombuffer(sports, dtype=np.uint16),
+                np.frombuffer(dports, dtype=np.uint16),
+                np.frombuffer(layer_ranks, dtype=np.uint16),
+            )
+            yield np.frombuffer(timestamps), np.frombuffer(sizes, dtype=np.uint32), protocol_ids
+
+    def aggregate_capture(self):
+        """
+        Aggregates the whole memory-mapped capture in a single pass,
+        decompressing it on the way if it is compressed.
+        """
+        with open_capture(self.pcap_path) as capture:
+            return self.aggregate_mapped(capture)
+
+    def iter_table(self, names):
+        """
+        Yields batches of the packet table: dicts of the columns `names` plus
+        'protocol_ids' under self.rules. Packets are counted in self.talkers
+        when tracked, a batch at a time.
+        """
+        table = self.table
+        columns = list(names) + [name for name in table.classify_columns(self.rules) if name not in names]
+        if self.talkers is not None:
+            columns += [name for name in ('src', 'dst', 'sport', 'dport') if name not in columns]
+        for batch in table.iter_batches(columns):
+            batch['protocol_ids'] = table.classify(batch, self.rules)
+            if self.talkers is not None:
+                self.add_table_talkers(batch)
+            yield batch
+
+    def add_table_talkers(self, batch):
+        src, is_ip, ipv6 = address_keys(batch['src'])
+        dst, _, dst_ipv6 = address_keys(batch['dst'])
+        ipv6.update(dst_ipv6)
+        # Ports in packet order, as TalkerSketch.add() buffers them
+        ports = np.stack([batch['sport'], batch['dport']], axis=1).ravel()
+        self.talkers.add_keys(src[is_ip], dst[is_ip], ports[ports != 0], ipv6)
+
+    def aggregate_table(self):
+        """Aggregates the packet table, in numpy only."""
+        aggregate = CaptureAggregate(self.rules)
+        for batch in self.iter_table(['length']):
+            aggregate.add_classified(batch['length'], batch['protocol_ids'])
+        return aggregate
+
+    def export_table(self, path=None, fmt='npy'):
+        """
+        Parses the capture once into a packet table (see packet_table),
+        written next to the capture unless path is given (the format then
+        follows the extension, .parquet or not). The table records the
+        classification with self.rules and payload inspection, if on.
+        Later extractors given table=path compute their features from it
+        without parsing the capture. Returns the path.
+        """
+        path = path or table_path(self.pcap_path, fmt)
+        writer = PacketTableWriter(path, self.pcap_path, self.rules, self.inspect_bytes())
         try:
-            if packet.haslayer(scapy.STP): return "STP", 3
-        except:
-            pass # STP might not be loaded in standard scapy import without load_contrib
+            for timestamps, sizes, flows in self.iter_flow_batches():
+                writer.add(timestamps, sizes, flows)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.close()
+
+    def iter_flow_batches(self):
+        """
+        Yields (timestamps, sizes, flows) for the whole capture, BATCH_SIZE
+        packets at a time, flows being the inspect_flow_record() tuples.
+        """
+        if self.streaming:
+            with open_capture(self.pcap_path) as capture:
+                start = capture.format.data_offset
+                state = {}
+                while True:
+                    table = capture.header_table(start, None, state, limit=self.BATCH_SIZE)
+                    if not len(table):
+                        break
+                    view = capture.view
+                    flows = [self.inspect_flow_record(view[data_offset:data_offset + caplen], linktype)
+                             for data_offset, caplen, linktype in zip(
+                                 table['data'].tolist(), table['caplen'].tolist(), table['linktype'].tolist())]
+                    yield table['ts'], table['caplen'], flows
+                    start = state["stop"]
+            return
 
-        # Class E: System (DNS, NTP, DHCP)
-        if 53 in [sport, dport]: return "DNS", 4
-        if 123 in [sport, dport]: return "NTP", 4
-        if 67 in [sport, dport] or 68 in [sport, dport]: return "DHCP", 4
+        packets = iter(self.iter_packets())
+        while True:
+            timestamps, sizes, flows = array('d'), array('I'), []
+            for p in packets:
+                timestamps.append(float(p.time))
+                sizes.append(len(p))
+                flows.append(self.inspect_flow(p))
+                if len(sizes) == self.BATCH_SIZE:
+                    break
+            if not sizes:
+                return
+            yield np.frombuffer(timestamps), np.frombuffer(sizes, dtype=np.uint32), flows
 
-        return "Other", 4 # Default to System/Other or just unknown
+    def use_pool(self):
+        """
+        Whether the capture is large enough to be split across processes.
+        Never with payload inspection, which follows flows across the whole
+        capture, nor with a packet table, which needs no parsing, nor for a
+        compressed capture, which can only be read from the start.
+        """
+        return (self.streaming and self.workers > 1 and self.inspector is None and self.table is None
+                and os.path.getsize(self.pcap_path) >= PARALLEL_MIN_BYTES
+                and detect_compression(self.pcap_path) is None)
+
+    def iter_chunks(self, window=None):
+        """
+        Splits the capture into byte ranges, extracts every range in the
+        process pool and yields (aggregate, windows) per range, in file order
+        (see _extract_chunk()).
+
+        Workers find the first record of their range with a heuristic, so the
+        ranges are checked to chain exactly (each one starts where the
+        previous one stopped). A range that doesn't is extracted again from
+        where the previous one stopped. If a pcapng capture changes section
+        midway, the rest of the capture is extracted in a single pass, since
+        the later ranges were parsed with the wrong interfaces.
+        """
+        capture_format = self.capture_format
+        if capture_format is None:
+            with open(self.pcap_path, 'rb') as f:
+                capture_format = read_format(f)
+
+        size = os.path.getsize(self.pcap_path)
+        n_chunks = self.workers * CHUNKS_PER_WORKER
+        chunk_size = max(1, -(-(size - capture_format.data_offset) // n_chunks))
+        bounds = list(range(capture_format.data_offset, size, chunk_size)) + [size]
+        n_ranges = len(bounds) - 1
+
+        results = get_pool(self.workers).map(
+            _extract_chunk,
+            [self.pcap_path] * n_ranges,
+            bounds[:-1],
+            bounds[1:],
+            [True] * n_ranges,
+            [window] * n_ranges,
+            [self.talkers is not None] * n_ranges,
+            [self.rules] * n_ranges,
+        )
+
+        expected = capture_format.data_offset
+        tracking = self.talkers is not None
+        for end, (aggregate, windows, talkers, first, stop, section_change) in zip(bounds[1:], results):
+            if first != expected:
+                aggregate, windows, talkers, first, stop, section_change = _extract_chunk(
+                    self.pcap_path, expected, end, False, window, tracking, self.rules)
+            if section_change:
+                aggregate, windows, talkers, _, _, _ = _extract_chunk(
+                    self.pcap_path, expected, size, False, window, tracking, self.rules)
+                if tracking:
+                    self.talkers.merge(talkers)
+                yield aggregate, windows
+                return
+            if tracking:
+                self.talkers.merge(talkers)
+            yield aggregate, windows
+            expected = stop
+
+    def aggregate_parallel(self):
+        """Aggregates the capture in the process pool, see iter_chunks()."""
+        total = CaptureAggregate(self.rules)
+        for aggregate, _ in self.iter_chunks():
+            total.merge(aggregate)
+        return total
+
+    def iter_windows(self, window=DEFAULT_WINDOW):
+        """
+        Yields (window_id, CaptureAggregate) for every window of capture
+        time that has packets, in one pass (see WindowSeries). Large
+        captures are split across processes; the windows of consecutive
+        ranges are merged exactly as if the capture was read in one go.
+        """
+        if self.use_pool():
+            last_id, last = None, None
+            for _, windows in self.iter_chunks(window):
+                for window_id, aggregate in windows:
+                    if last is not None and window_id <= last_id:
+                        # Same window, or late packets counted in the open one
+                        last.merge(aggregate)
+                        continue
+                    if last is not None:
+                        yield last_id, last
+                    last_id, last = window_id, aggregate
+            if last is not None:
+                yield last_id, last
+            return
+
+        series = WindowSeries(window, self.rules)
+        closed = series.closed
+        for timestamps, sizes, protocol_ids in self.iter_batches():
+            series.add_batch(timestamps, sizes, protocol_ids)
+            while closed:
+                yield closed.popleft()
+        series.flush()
+        while closed:
+            yield closed.popleft()
+
+    def iter_window_features(self, window=DEFAULT_WINDOW, total=None):
+        """
+        Yields one features dict per window of `window` seconds of capture
+        time (see window_features()). Windows are built incrementally, only
+        the open one is kept in memory.
+
+        If total is a CaptureAggregate every window is merged into it, so
+        total.to_features() gives the features of the whole capture
+        without a second pass.
+        """
+        for window_id, aggregate in self.iter_windows(window):
+            if total is not None:
+                total.merge(aggregate)
+            yield window_features(window_id, aggregate, window)
 
     def extract_features(self):
         """
         Extracts features for classification.
+        The capture is walked once, large captures are split across
+        self.workers processes.
         """
-        if not self.packets:
+        if not self.has_packets():
             return None
 
-        # Basic stats
-        packet_sizes = [len(p) for p in self.packets]
-        
-        count_map = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
-        protocol_stats = Counter()
-        
-        for p in self.packets:
-            proto, class_id = self.identify_protocol(p)
-            count_map[class_id] += 1
-            protocol_stats[proto] += 1
+        if self.table is not None:
+            aggregate = self.aggregate_table()
+        elif self.use_pool():
+            aggregate = self.aggregate_parallel()
+        elif self.streaming:
+            aggregate = self.aggregate_capture()
+        else:
+            aggregate = self.aggregate(self.iter_headers())
+        return aggregate.to_features()
 
-        total_packets = len(self.packets)
-        
-        # Feature vector (numeric)
-        # We add class ratios as features to help the model "cheat" correctly
-        features = {
-            'avg_packet_size': np.mean(packet_sizes) if packet_sizes else 0,
-            'std_packet_size': np.std(packet_sizes) if packet_sizes else 0,
-            'min_packet_size': np.min(packet_sizes) if packet_sizes else 0,
-            'max_packet_size': np.max(packet_sizes) if packet_sizes else 0,
-            'packet_count': total_packets,
-            
-            # Key features for our "perfect" classifier
-            'ratio_A': count_map[0] / total_packets if total_packets else 0,
-            'ratio_B': count_map[1] / total_packets if total_packets else 0,
-            'ratio_C': count_map[2] / total_packets if total_packets else 0,
-            'ratio_D': count_map[3] / total_packets if total_packets else 0,
-            'ratio_E': count_map[4] / total_packets if total_packets else 0,
-            
-            # Rich stats for frontend (not necessarily used by model)
-            'protocol_counts': dict(protocol_stats),
-            'class_counts': count_map
+    def extract_sampled_features(self, every=None, reservoir=None, confidence=0.95, seed=0):
+        """
+        Triage mode: classifies only a sample of the packets, either every
+        `every`-th packet (deterministic 1-in-N) or a uniform reservoir
+        sample of `reservoir` packets (seeded, so repeatable).
+
+        Every record header is still walked (packet_count is exact), but only
+        the sampled records are decoded and classified. The ratios and size
+        statistics are estimated from the sample and come with confidence
+        intervals in features['confidence_intervals']; min/max are those of
+        the sample. features['sampling'] reports the rate actually used.
+        1-in-N is treated as a simple random sample for the intervals.
+        """
+        if (every is None) == (reservoir is None):
+            raise ValueError("Pass exactly one of every and reservoir")
+        if (every or reservoir) < 1:
+            raise ValueError("The sample size must be positive")
+        if not self.has_packets():
+            return None
+
+        rng = np.random.default_rng(seed)
+        if self.table is not None:
+            sample, total = self._sample_table(every, reservoir, rng)
+        elif self.streaming:
+            sample, total = self._sample_mapped(every, reservoir, rng)
+        else:
+            sample, total = self._sample_packets(every, reservoir, rng)
+
+        features = sample.to_features()
+        if features is None:
+            return None
+        n = sample.sizes.count
+        z = normal_quantile(confidence)
+        count_map = features['class_counts']
+        features['packet_count'] = total
+        features['confidence_intervals'] = {
+            'avg_packet_size': list(sample.sizes.mean_interval(z, total)),
+            'std_packet_size': list(sample.sizes.std_interval(z, total)),
+        }
+        for class_id, letter in enumerate("ABCDE"):
+            features['confidence_intervals']['ratio_' + letter] = list(
+                proportion_interval(count_map[class_id], n, z, total))
+        features['sampling'] = {
+            'mode': 'every' if every else 'reservoir',
+            'every': every,
+            'reservoir': reservoir,
+            'rate': n / total,
+            'sampled_packets': n,
+            'total_packets': total,
+            'confidence': confidence,
         }
-        
         return features
 
+    def _sample_mapped(self, every, reservoir, rng):
+        """
+        Returns (CaptureAggregate of the sample, total packet count) of the
+        mapped capture (or of the compressed capture, decompressed on the way).
+        """
+        sample = CaptureAggregate(self.rules)
+        total = 0
+        with open_capture(self.pcap_path) as capture:
+            if reservoir:
+                slots = np.empty(reservoir, dtype=RECORD_HEADER_DTYPE)
+                # A compressed capture can't be read again, the bytes of the records in the slots are kept
+                kept = None if capture.random_access else [None] * reservoir
+            state = {}
+            start = capture.format.data_offset
+            while True:
+                table = capture.header_table(start, None, state, limit=self.BATCH_SIZE)
+                if not len(table):
+                    break
+                index = np.arange(total, total + len(table))
+                if every:
+                    picked = table[index % every == 0]
+                    sample.add_classified(picked['caplen'], self.classify_table(capture, picked))
+                else:
+                    # Algorithm R, vectorized: the first `reservoir` records fill
+                    # the slots, record t then replaces a random slot with
+                    # probability reservoir / (t + 1).
+                    filling = index < reservoir
+                    slots[index[filling]] = table[filling]
+                    slot = rng.integers(0, index + 1)
+                    replace = np.flatnonzero(~filling & (slot < reservoir))
+                    # A slot hit twice in the batch keeps the later record, as in the sequential algorithm
+                    _, last = np.unique(slot[replace][::-1], return_index=True)
+                    replace = replace[len(replace) - 1 - last]
+                    slots[slot[replace]] = table[replace]
+                    if kept is not None:
+                        view = capture.view
+                        for slot_id, row in zip(np.concatenate([index[filling], slot[replace]]).tolist(),
+                                                np.concatenate([np.flatnonzero(filling), replace]).tolist()):
+                            data_offset = int(table['data'][row])
+                            kept[slot_id] = bytes(view[data_offset:data_offset + int(table['caplen'][row])])
+                total += len(table)
+                start = state["stop"]
+
+            if reservoir and total:
+                picked = slots[:min(total, reservoir)]
+                if kept is None:
+                    protocol_ids = self.classify_table(capture, picked)
+                else:
+                    protocol_ids = self.classify_records(zip(kept, picked['linktype'].tolist()))
+                sample.add_classified(picked['caplen'], protocol_ids)
+        return sample, total
+
+    def _sample_table(self, every, reservoir, rng):
+        """
+        Same as _sample_mapped() for the packet table. The table was classified
+        in full, so sampled packets keep the payload signatures their flow
+        matched even if the matching packet wasn't sampled.
+        """
+        table = self.table
+        total = table.packets
+        if every:
+            indices = np.arange(0, total, every)
+        else:
+            indices = np.sort(rng.choice(total, size=min(total, reservoir), replace=False))
+        names = ['length'] + table.classify_columns(self.rules)
+        if self.talkers is not None:
+            # Only the sampled packets are counted, as when sampling the capture
+            names += [name for name in ('src', 'dst', 'sport', 'dport') if name not in names]
+        picked = {name: column[indices] for name, column in table.read(names).items()}
+        if self.talkers is not None:
+            self.add_table_talkers(picked)
+        sample = CaptureAggregate(self.rules)
+        sample.add_classified(picked['length'], table.classify(picked, self.rules))
+        return sample, total
+
+    def _sample_packets(self, every, reservoir, rng):
+        """Same as _sample_mapped() for the packets loaded by load_packets()."""
+        total = len(self.packets)
+        if every:
+            indices = range(0, total, every)
+        else:
+            indices = np.sort(rng.choice(total, size=min(total, reservoir), replace=False)).tolist()
+        headers = ((len(self.packets[i]),) + self.read_packet(self.packets[i]) for i in indices)
+        return self.aggregate(headers), total
+
     def get_dummy_features(self):
         """Returns dummy features for testing if pcap fails or for demo."""
         # Represents a mix, mainly Class A (Web)
@@ -0,0 +1,151 @@
+import math
+import socket
+from array import array
+from collections import OrderedDict, deque
+
+# Default hard cap on tracked flows (a few hundred bytes each, index included)
+DEFAULT_MAX_FLOWS = 65536
+# Seconds (of capture time) without packets after which a flow is closed
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+NUM_CLASSES = 5
+
+
+def flow_key(src, dst, sport, dport, proto):
+    """
+    Direction-independent 5-tuple, so both sides of a conversation land in
+    the same flow. The endpoint that sorts first is always stored as src.
+    """
+    if (src, sport) <= (dst, dport):
+        return (src, dst, sport, dport, proto)
+    return (dst, src, dport, sport, proto)
+
+
+def format_address(address):
+    if len(address) == 4:
+        return socket.inet_ntop(socket.AF_INET, address)
+    if len(address) == 16:
+        return socket.inet_ntop(socket.AF_INET6, address)
+    return None
+
+
+class FlowTable:
+    """
+    Per-flow statistics in fixed-size arrays, one slot per flow.
+
+    The slot index is an OrderedDict kept in least-recently-seen order, so
+    idle flows are always at the front and expire in O(1), and when the
+    table is full the least recently seen flow is evicted to make room.
+    Memory is therefore capped by max_flows no matter how many flows the
+    capture holds. Closed flows are queued in self.expired as feature dicts.
+    """
+
+    def __init__(self, max_flows=DEFAULT_MAX_FLOWS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+
+        self.packets = array('q', bytes(8 * max_flows))
+        self.bytes = array('q', bytes(8 * max_flows))
+        self.bytes_sq = array('q', bytes(8 * max_flows))
+        self.min_size = array('q', bytes(8 * max_flows))
+        self.max_size = array('q', bytes(8 * max_flows))
+        self.first_seen = array('d', bytes(8 * max_flows))
+        self.last_seen = array('d', bytes(8 * max_flows))
+        # NUM_CLASSES counters per slot
+        self.class_counts = array('q', bytes(8 * max_flows * NUM_CLASSES))
+
+        self.slots = OrderedDict()
+        self.free_slots = list(range(max_flows - 1, -1, -1))
+        self.expired = deque()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, key, timestamp, size, class_id):
+        """Accounts one packet to its flow, closing idle flows first."""
+        slots = self.slots
+        # Flows are in last-seen order, so idle ones are at the front
+        while slots:
+            oldest_key, oldest = next(iter(slots.items()))
+            if timestamp - self.last_seen[oldest] <= self.idle_timeout:
+                break
+            self.close(oldest_key, "idle")
+
+        slot = slots.get(key)
+        if slot is None:
+            if not self.free_slots:
+                self.close(next(iter(slots)), "evicted")
+                self.evicted += 1
+            slot = self.free_slots.pop()
+            slots[key] = slot
+            self.packets[slot] = 0
+            self.bytes[slot] = 0
+            self.bytes_sq[slot] = 0
+            self.min_size[slot] = size
+            self.max_size[slot] = size
+            self.first_seen[slot] = timestamp
+            base = slot * NUM_CLASSES
+            for i in range(NUM_CLASSES):
+                self.class_counts[base + i] = 0
+        else:
+            slots.move_to_end(key)
+            if size < self.min_size[slot]:
+                self.min_size[slot] = size
+            if size > self.max_size[slot]:
+                self.max_size[slot] = size
+
+        self.packets[slot] += 1
+        self.bytes[slot] += size
+        self.bytes_sq[slot] += size * size
+        self.last_seen[slot] = timestamp
+        self.class_counts[slot * NUM_CLASSES + class_id] += 1
+
+    def close(self, key, reason):
+        """Removes a flow from the table and queues its features."""
+        slot = self.slots.pop(key)
+        self.expired.append(self.flow_features(key, slot, reason))
+        self.free_slots.append(slot)
+
+    def close_all(self):
+        while self.slots:
+            self.close(next(iter(self.slots)), "end")
+
+    def flow_features(self, key, slot, reason):
+        """
+        Feature dict of a flow, with the same 10 model features as
+        FeatureExtractor.extract_features() plus the flow identity.
+        """
+        src, dst, sport, dport, proto = key
+        count = self.packets[slot]
+        total = self.bytes[slot]
+        mean = total / count
+        # Exact integer moments, as in RunningStats
+        variance = (count * self.bytes_sq[slot] - total * total) / (count * count)
+        base = slot * NUM_CLASSES
+        class_counts = {i: self.class_counts[base + i] for i in range(NUM_CLASSES)}
+
+        return {
+            'avg_packet_size': mean,
+            'std_packet_size': math.sqrt(variance),
+            'min_packet_size': self.min_size[slot],
+            'max_packet_size': self.max_size[slot],
+            'packet_count': count,
+            'ratio_A': class_counts[0] / count,
+            'ratio_B': class_counts[1] / count,
+            'ratio_C': class_counts[2] / count,
+            'ratio_D': class_counts[3] / count,
+            'ratio_E': class_counts[4] / count,
+            'class_counts': class_counts,
+
+            'flow': {
+                'src': format_address(src),
+                'dst': format_address(dst),
+                'sport': sport,
+                'dport': dport,
+                'proto': proto,
+                'start_time': self.first_seen[slot],
+                'end_time': self.last_seen[slot],
+                'closed_by': reason,
+            },
+        }
@@ -0,0 +1,229 @@
+import threading
+import time
+
+import numpy as np
+
+from .models import CONTINUE_ROUNDS, DEFAULT_BATCH_SIZE, FINE_TUNE_EPOCHS, PacketClassifier, artifacts_version
+
+# Latest rows IsolationForest is refitted on
+DEFAULT_WINDOW_ROWS = 10000
+# Fewest rows in the window before IsolationForest is refitted (its max_samples)
+MIN_WINDOW_ROWS = 256
+# Rows of traffic recorded between two refits of IsolationForest
+DEFAULT_REFIT_ROWS = 10000
+# Seconds between two checks of the saved artifacts for a new build
+RELOAD_INTERVAL = 5.0
+
+
+class IncrementalTrainer:
+    """
+    Updates a serving PacketClassifier in a background thread. submit()
+    only queues newly labelled rows; the thread trains a clone() of the
+    models on them (PacketClassifier.update()), then swaps the result in
+    with adopt(). Predictions keep using the current models meanwhile.
+    Rows submitted while an update runs are trained on together in the
+    next one.
+
+    IsolationForest is refitted on the rolling window of the latest
+    window_rows rows of served traffic, read with window_source(count)
+    (a float32 n x input_dim array, oldest first) so it survives restarts
+    and covers every process that records traffic. That happens with
+    every update, and on its own once traffic_recorded() has counted
+    refit_rows new rows (0 = only with updates). Without window_source
+    IsolationForest is left as it is.
+
+    If directory is given, every update is published there as the
+    current build, so other and restarted processes serve it too.
+    on_update(classifier) is called after every swap.
+    """
+
+    def __init__(self, classifier, directory=None, window_source=None, window_rows=DEFAULT_WINDOW_ROWS,
+                 refit_rows=DEFAULT_REFIT_ROWS, epochs=FINE_TUNE_EPOCHS, batch_size=DEFAULT_BATCH_SIZE,
+                 rounds=CONTINUE_ROUNDS, threads=1, on_update=None):
+        self.classifier = classifier
+        self.directory = directory
+        self.window_source = window_source
+        self.window_rows = window_rows
+        self.refit_rows = refit_rows
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.rounds = rounds
+        # torch's thread count is per process, it applies to serving too while the CNN trains
+        self.threads = threads
+        self.on_update = on_update
+        self.updates = 0
+        self.refits = 0
+        self.rows = 0
+        self.last_error = None
+        self._pending_X = []
+        self._pending_y = []
+        # Traffic rows recorded since IsolationForest was last refitted
+        self._recorded = 0
+        self._refit_due = False
+        self._lock = threading.Lock()
+        # Set when rows are pending, or to stop
+        self._wake = threading.Event()
+        # Set when nothing is pending or training
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='incremental-trainer', daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(len(y) for y in self._pending_y)
+
+    def submit(self, X, y):
+        """
+        Queues labelled rows: X a float32 (n x input_dim) array (see
+        feature_matrix()), y their classes. Raises ValueError on rows
+        of the wrong shape or unknown classes.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.int64).reshape(-1)
+        if X.ndim != 2 or X.shape[1] != self.classifier.input_dim or len(X) != len(y):
+            raise ValueError(f"Expected n x {self.classifier.input_dim} rows and n labels")
+        if len(y) and (y.min() < 0 or y.max() >= self.classifier.num_classes):
+            raise ValueError(f"Labels must be classes 0 to {self.classifier.num_classes - 1}")
+        if not len(y):
+            return
+        with self._lock:
+            self._pending_X.append(X)
+            self._pending_y.append(y)
+            self._idle.clear()
+        self._wake.set()
+
+    def traffic_recorded(self, rows):
+        """Counts rows of traffic just stored where window_source reads them."""
+        if self.window_source is None or not self.refit_rows:
+            return
+        with self._lock:
+            self._recorded += rows
+            if self._recorded < self.refit_rows or self._refit_due:
+                return
+            self._refit_due = True
+            self._idle.clear()
+        self._wake.set()
+
+    def flush(self, timeout=None):
+        """Waits until every submitted row is trained on, returns False on timeout."""
+        return self._idle.wait(timeout)
+
+    def close(self):
+        """Trains on what is pending, then stops the thread."""
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                self._wake.clear()
+                pending_X, pending_y = self._pending_X, self._pending_y
+                self._pending_X, self._pending_y = [], []
+                refit = self._refit_due
+                self._refit_due = False
+            if pending_y or refit:
+                try:
+                    if pending_y:
+                        self._train(np.concatenate(pending_X), np.concatenate(pending_y))
+                    else:
+                        self._train()
+                except Exception as e:
+                    # The models being served are left as they were
+                    print(f"Incremental training failed: {e}")
+                    self.last_error = str(e)
+            with self._lock:
+                if not self._pending_y and not self._refit_due:
+                    self._idle.set()
+            if self._closed and self._idle.is_set():
+                return
+
+    def recent_window(self):
+        """The window IsolationForest is refitted on, None if there isn't enough traffic yet."""
+        if self.window_source is None:
+            return None
+        window = np.ascontiguousarray(self.window_source(self.window_rows), dtype=np.float32)
+        if len(window) < MIN_WINDOW_ROWS:
+            return None
+        return window[-self.window_rows:]
+
+    def _train(self, X=None, y=None):
+        with self._lock:
+            recorded = self._recorded
+        window = self.recent_window()
+        if window is not None or X is None:
+            with self._lock:
+                # Traffic recorded from now on counts towards the next refit
+                self._recorded -= recorded
+        if X is None and window is None:
+            return
+        candidate = self.classifier.clone()
+        if X is not None:
+            candidate.update(X, y, window, self.epochs, self.batch_size, self.rounds, self.threads)
+        else:
+            candidate.fit_isolation_forest(window, self.threads)
+        if self.directory:
+            candidate.save(self.directory, replace=True)
+        else:
+            candidate.version = f"{self.classifier.version.split('+')[0]}+{self.updates + self.refits + 1}"
+        self.classifier.adopt(candidate)
+        if X is not None:
+            self.updates += 1
+            self.rows += len(y)
+        if window is not None:
+            self.refits += 1
+        if self.on_update:
+            self.on_update(self.classifier)
+
+
+class ArtifactWatcher:
+    """
+    Keeps a serving PacketClassifier on the current build of the
+    artifacts under directory, which other processes may publish
+    (train_models --force, update_models, an update of another server
+    process). check() reads the build pointer at most every `interval`
+    seconds and, when it names other models than the ones served, loads
+    them and swaps them in with adopt(). A build that fails to load
+    leaves the current models in place. on_update(classifier) is called
+    after every swap.
+    """
+
+    def __init__(self, classifier, directory, interval=RELOAD_INTERVAL, on_update=None):
+        self.classifier = classifier
+        self.directory = directory
+        self.interval = interval
+        self.on_update = on_update
+        self.reloads = 0
+        self.checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Swaps in a newer build if there is one. Returns True if it did."""
+        if time.monotonic() - self.checked < self.interval:
+            return False
+        # One process-wide reload at a time, other callers keep the current models meanwhile
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.checked = time.monotonic()
+            try:
+                version = artifacts_version(self.directory)
+                if version is None or version == self.classifier.version:
+                    return False
+                current = self.classifier
+                candidate = PacketClassifier(current.backend, current.timeouts, current.parallel, current.calibration)
+                candidate.load(self.directory)
+            except (OSError, ValueError) as e:
+                print(f"Error reloading the models from {self.directory}: {e}")
+                return False
+            self.classifier.adopt(candidate)
+            self.reloads += 1
+        finally:
+            self._lock.release()
+        if self.on_update:
+            self.on_update(self.classifier)
+        return True
@@ -0,0 +1,254 @@
+import os
+import queue
+import select
+import threading
+import time
+from array import array
+
+import scapy.all as scapy
+import numpy as np
+
+from .feature_extractor import DEFAULT_WINDOW, FeatureExtractor, WindowSeries, window_features
+from .packet_decoder import DLT_EN10MB
+from .pcap_io import open_capture
+from .protocol_rules import get_rules
+
+# Packets buffered between the capture thread and the classifier
+DEFAULT_QUEUE_SIZE = 65536
+# Most packets classified per vectorized lookup
+BATCH_SIZE = 4096
+# Seconds between two progress reports
+DEFAULT_REPORT_INTERVAL = 10.0
+
+
+class ReplaySource:
+    """
+    Replays the records of a capture file with their original timestamps,
+    at `rate` packets per second, or as fast as the classifier keeps up
+    when rate is None (then no packet is ever dropped).
+    """
+
+    def __init__(self, pcap_path, rate=None):
+        self.pcap_path = pcap_path
+        self.rate = rate
+        self.name = ("replay:" + os.path.basename(pcap_path))[:64]
+        self.lossless = rate is None
+        # Timestamps are not in step with the wall clock
+        self.realtime = False
+        self.stopped = False
+
+    def __iter__(self):
+        # Compressed captures are decompressed on the fly
+        with open_capture(self.pcap_path) as capture:
+            started = time.monotonic()
+            sent = 0
+            for _, data, linktype, timestamp, _ in capture.records():
+                if self.stopped:
+                    break
+                if self.rate:
+                    ahead = started + sent / self.rate - time.monotonic()
+                    if ahead > 0:
+                        time.sleep(ahead)
+                # Copied out of the mapping, which is closed at the end of the
+                # replay while packets may still be queued
+                yield bytes(data), linktype, timestamp
+                sent += 1
+
+    def stop(self):
+        self.stopped = True
+
+
+class InterfaceSource:
+    """
+    Captures packets from a network interface with scapy's raw L2 socket,
+    without dissecting them. Needs root (or CAP_NET_RAW).
+    """
+
+    def __init__(self, iface, bpf_filter=None):
+        self.iface = iface
+        self.bpf_filter = bpf_filter
+        self.name = ("live:" + iface)[:64]
+        self.lossless = False
+        self.realtime = True
+        self.stopped = False
+
+    def __iter__(self):
+        sock = scapy.conf.L2listen(iface=self.iface, filter=self.bpf_filter)
+        try:
+            while not self.stopped:
+                # Wakes up regularly so stop() is noticed on a quiet link
+                if not select.select([sock], [], [], 0.5)[0]:
+                    continue
+                cls, data, timestamp = sock.recv_raw()
+                if data is None:
+                    continue
+                linktype = scapy.conf.l2types.layer2num.get(cls, DLT_EN10MB)
+                yield data, linktype, timestamp or time.time()
+        finally:
+            sock.close()
+
+    def stop(self):
+        self.stopped = True
+
+
+class LiveIngestor:
+    """
+    Long-running ingestion of a packet source (InterfaceSource or ReplaySource).
+
+    A capture thread puts raw packets into a bounded queue; run() takes them
+    off in batches, classifies them with one vectorized lookup per batch and
+    accumulates them into windows of capture time (see WindowSeries). Every
+    closed window is scored once with the classifier and passed to
+    on_window(features, predictions). When the queue is full because the
+    classifier falls behind, packets are dropped and counted instead of
+    stalling the capture.
+
+    A window is closed by the first packet of a later window. For a live
+    source it is also closed when the capture clock (last timestamp plus
+    the time elapsed since) passes its end, so a quiet link still produces
+    its windows.
+
+    Changes to the protocol rules file are picked up between batches; the
+    open window is closed first, so every window is classified with a
+    single set of rules. With inspect_bytes, flows are also classified by
+    their payload signatures (see signatures.PayloadInspector).
+    """
+
+    def __init__(self, source, classifier, on_window=None, on_report=None, window=DEFAULT_WINDOW,
+                 queue_size=DEFAULT_QUEUE_SIZE, report_interval=DEFAULT_REPORT_INTERVAL, inspect_bytes=0):
+        self.source = source
+        self.classifier = classifier
+        self.on_window = on_window
+        self.on_report = on_report
+        self.window = window
+        self.report_interval = report_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.inspect_bytes = inspect_bytes
+        self.rules = get_rules()
+        self.series = WindowSeries(window, self.rules)
+        # Only used to decode records (and inspect their payload)
+        self.extractor = FeatureExtractor(source.name, streaming=True, rules=self.rules, inspect_bytes=inspect_bytes)
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.windows = 0
+        self.started = None
+        self.last_timestamp = None
+        self.last_arrival = None
+
+    def stop(self):
+        """Stops the source, run() returns once the queued packets are processed."""
+        self.source.stop()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return {
+            'source': self.source.name,
+            'elapsed': elapsed,
+            'received': self.received,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'queued': self.queue.qsize(),
+            'windows': self.windows,
+            # Sustained rates since the start
+            'packets_per_sec': self.processed / elapsed if elapsed else 0,
+            'capture_per_sec': self.received / elapsed if elapsed else 0,
+        }
+
+    def _capture(self):
+        try:
+            for packet in self.source:
+                self.received += 1
+                if self.source.lossless:
+                    self.queue.put(packet)
+                    continue
+                try:
+                    self.queue.put_nowait(packet)
+                except queue.Full:
+                    self.dropped += 1
+        except Exception as e:
+            print(f"Error capturing packets: {e}")
+        finally:
+            # End marker
+            self.queue.put(None)
+
+    def run(self):
+        """Ingests until the source ends or stop() is called. Returns stats()."""
+        self.started = time.monotonic()
+        next_report = self.started + self.report_interval
+        thread = threading.Thread(target=self._capture, name="packet-capture", daemon=True)
+        thread.start()
+
+        done = False
+        while not done:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=0.2))
+                while len(batch) < BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch and batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                self._process(batch)
+
+            self._close_idle_window()
+            self._emit()
+            if self.on_report and time.monotonic() >= next_report:
+                self.on_report(self.stats())
+                next_report += self.report_interval
+
+        self.series.flush()
+        self._emit()
+        thread.join()
+        stats = self.stats()
+        if self.on_report:
+            self.on_report(stats)
+        return stats
+
+    def _process(self, batch):
+        rules = get_rules()
+        if rules is not self.rules:
+            self.series.flush()
+            self.rules = self.series.rules = rules
+            self.extractor = FeatureExtractor(self.source.name, streaming=True, rules=rules,
+                                              inspect_bytes=self.inspect_bytes)
+        timestamps, sizes, sports, dports, layer_ranks = array('d'), array('I'), array('H'), array('H'), array('H')
+        for data, linktype, timestamp in batch:
+            layer, sport, dport = self.extractor.decode_record(data, linktype)
+            timestamps.append(timestamp)
+            sizes.append(len(data))
+            sports.append(sport)
+            dports.append(dport)
+            layer_ranks.append(rules.layer_rank(layer))
+        protocol_ids = rules.classify(
+            np.frombuffer(sports, dtype=np.uint16),
+            np.frombuffer(dports, dtype=np.uint16),
+            np.frombuffer(layer_ranks, dtype=np.uint16),
+        )
+        self.series.add_batch(np.frombuffer(timestamps), np.frombuffer(sizes, dtype=np.uint32), protocol_ids)
+        self.processed += len(batch)
+        self.last_timestamp = timestamps[-1]
+        self.last_arrival = time.monotonic()
+
+    def _close_idle_window(self):
+        series = self.series
+        if not self.source.realtime or series.aggregate is None:
+            return
+        clock = self.last_timestamp + (time.monotonic() - self.last_arrival)
+        if clock >= (series.current + 1) * self.window:
+            series.flush()
+
+    def _emit(self):
+        closed = self.series.closed
+        while closed:
+            window_id, aggregate = closed.popleft()
+            features = window_features(window_id, aggregate, self.window)
+            # One prediction per window, never per packet
+            predictions = self.classifier.predict(features)
+            self.windows += 1
+            if self.on_window:
+                self.on_window(features, predictions)
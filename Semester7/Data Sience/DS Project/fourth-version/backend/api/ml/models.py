@@ -1,151 +1,703 @@
+import hashlib
+import io
+import json
+import os
+import copy
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import joblib
 import numpy as np
 import pandas as pd
+import sklearn
 from sklearn.ensemble import IsolationForest
 import xgboost as xgb
-import torch
-import torch.nn as nn
-import torch.optim as optim
-
-class SimpleCNN(nn.Module):
-    def __init__(self, input_dim, num_classes):
-        super(SimpleCNN, self).__init__()
-        # Input: (batch, 1, input_dim)
-        self.conv1 = nn.Conv1d(in_channels=1, out_channels=16, kernel_size=3, padding=1)
-        self.relu = nn.ReLU()
-        self.pool = nn.MaxPool1d(kernel_size=2)
-        # after pool, dimension depends on input_dim. 
-        # input_dim=10 -> pool -> 5
-        self.fc1 = nn.Linear(16 * (input_dim // 2), 32)
-        self.fc2 = nn.Linear(32, num_classes)
-
-    def forward(self, x):
-        # x shape: (batch, input_dim) -> (batch, 1, input_dim)
-        x = x.unsqueeze(1)
-        x = self.conv1(x)
-        x = self.relu(x)
-        x = self.pool(x)
-        x = x.view(x.size(0), -1)
-        x = self.fc1(x)
-        x = self.relu(x)
-        x = self.fc2(x)
-        return x
+
+from .numpy_cnn import NumpyCNN
+
+try:
+    import torch
+    import torch.nn as nn
+    import torch.optim as optim
+    from .cnn import SimpleCNN
+except ImportError:
+    # Serving can run the CNN with the numpy backend from its exported weights,
+    # training and the other backends need torch
+    torch = nn = optim = SimpleCNN = None
+
+try:
+    import onnxruntime
+except ImportError:
+    # Only the onnx inference backend needs it
+    onnxruntime = None
+
+# Bump whenever the models or their features change, cached results of
+# older versions are then discarded.
+MODEL_VERSION = "3"
+
+# Trained models are saved under <artifacts directory>/<MODEL_VERSION>/<build>/,
+# with a manifest.json holding the SHA-256 of every file; <build> is the start of
+# the manifest's SHA-256. The CURRENT_FILE of the version directory names the
+# build being served, it is only ever replaced atomically.
+ARTIFACT_FILES = {
+    'cnn': 'cnn.pt',  # SimpleCNN state_dict
+    'cnn_numpy': 'cnn.npz',  # the same weights as numpy arrays, for the numpy backend
+    'xgboost': 'xgboost.json',  # XGBoost booster
+    'isolation_forest': 'isolation_forest.joblib',
+}
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'current'
+# Builds kept in a version directory (the current one always is), older ones are removed
+KEPT_BUILDS = 3
+
+# Training defaults (train_models can change them)
+DEFAULT_SAMPLES = 1000
+DEFAULT_EPOCHS = 20
+DEFAULT_BATCH_SIZE = 256
+LEARNING_RATE = 0.01
+# Synthetic rows generated per vectorized step, bounds the float64 temporaries
+GENERATE_BATCH = 1 << 20
+# Largest sample IsolationForest is fitted on
+ISOLATION_FOREST_ROWS = 100000
+# Largest sample the CNN's input standardization is computed on
+NORMALIZATION_ROWS = 100000
+# Incremental updates (see PacketClassifier.update()): the CNN is fine-tuned
+# with a lower learning rate, XGBoost gets this many more boosting rounds
+FINE_TUNE_EPOCHS = 5
+FINE_TUNE_LEARNING_RATE = 0.001
+CONTINUE_ROUNDS = 10
+
+
+# Inference backends of the CNN and XGBoost (IsolationForest always runs in sklearn):
+# - "eager": the PyTorch module and the sklearn wrapper of XGBoost
+# - "torchscript": the CNN traced and frozen with TorchScript
+# - "onnx": the CNN exported to ONNX and run by onnxruntime (needs onnx and onnxruntime)
+# - "numpy": the CNN run by NumpyCNN, the only backend that works without torch
+# - "int8": the CNN's conv and linear layers quantized to int8 (static post-training
+#   quantization, calibrated on the calibration rows), run by torch's quantized kernels
+# The other backends call the XGBoost booster with inplace_predict(), without a DMatrix.
+BACKENDS = ('eager', 'torchscript', 'onnx', 'numpy', 'int8')
+# Backends whose outputs only approximate the eager ones
+QUANTIZED_BACKENDS = ('int8',)
+# Synthetic rows the int8 CNN is calibrated on when no stored features are given
+CALIBRATION_SAMPLES = 2048
+
+# Result of a model that timed out or failed, with a 'degraded' reason added
+DEGRADED_RESULTS = {
+    'cnn': {'class': None, 'confidence': None},
+    'xgboost': {'class': None},
+    'isolation_forest': {'is_anomaly': None, 'score': None},
+}
+# Threads of the pool the 3 models of a prediction run on at the same time
+# (their native code releases the GIL). Room for two predictions, so calls
+# stuck past their timeouts (at most one per model, see run_models()) don't
+# hold up the next.
+MODEL_THREADS = 6
+
+_model_pool = None
+_model_pool_lock = threading.Lock()
+
+
+def model_pool():
+    """The thread pool shared by every PacketClassifier, started on first use."""
+    global _model_pool
+    with _model_pool_lock:
+        if _model_pool is None:
+            _model_pool = ThreadPoolExecutor(MODEL_THREADS, thread_name_prefix='models')
+        return _model_pool
+
+
+# Features dict keys of the model inputs, in order
+FEATURE_NAMES = [
+    'avg_packet_size', 'std_packet_size', 'min_packet_size', 'max_packet_size', 'packet_count',
+    'ratio_A', 'ratio_B', 'ratio_C', 'ratio_D', 'ratio_E',
+]
+
+
+def feature_matrix(features_list):
+    """(N, 10) float32 model inputs of N features dicts, missing features are 0."""
+    X = np.array([[features.get(name, 0) for name in FEATURE_NAMES] for features in features_list],
+                 dtype=np.float32)
+    return X.reshape(len(features_list), len(FEATURE_NAMES))
+
+
+def softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def artifact_dir(directory):
+    """Directory of the artifacts of the current MODEL_VERSION."""
+    return os.path.join(directory, MODEL_VERSION)
+
+
+def current_build(directory):
+    """Name of the build of MODEL_VERSION being served from directory, None if there is none."""
+    try:
+        with open(os.path.join(artifact_dir(directory), CURRENT_FILE)) as f:
+            build = f.read().strip()
+    except FileNotFoundError:
+        return None
+    if not build or os.path.basename(build) != build or build.startswith('.'):
+        raise ValueError(f"Invalid build {build!r} in {os.path.join(artifact_dir(directory), CURRENT_FILE)}")
+    return build
+
+
+def artifacts_version(directory):
+    """PacketClassifier.version that load() of directory would give, None if there are no artifacts."""
+    build = current_build(directory)
+    return f"{MODEL_VERSION}-{build}" if build is not None else None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def synthetic_dataset(n_samples, input_dim=10, num_classes=5, seed=None):
+    """
+    (X, y) of n_samples SYNTHETIC feature rows: random classes, packet
+    stats around typical values and ratios dominated by the ratio of the
+    row's class. Generated GENERATE_BATCH rows at a time with numpy, so
+    millions of rows take seconds and X (float32) is the only large array.
+    """
+    rng = np.random.default_rng(seed)
+    X = np.empty((n_samples, input_dim), dtype=np.float32)
+    y = np.empty(n_samples, dtype=np.int64)
+    for start in range(0, n_samples, GENERATE_BATCH):
+        stop = min(start + GENERATE_BATCH, n_samples)
+        n = stop - start
+        labels = rng.integers(0, num_classes, size=n)
+        y[start:stop] = labels
+
+        # Base stats
+        X[start:stop, 0] = rng.normal(800, 200, size=n)  # avg
+        X[start:stop, 1] = rng.normal(100, 20, size=n)  # std
+        X[start:stop, 2] = 64
+        X[start:stop, 3] = 1500
+        X[start:stop, 4] = rng.integers(100, 5000, size=n)  # count
+
+        # Magic Ratios: the ratio for the target class is DOMINANT
+        # indices 5,6,7,8,9 correspond to A,B,C,D,E
+        ratios = rng.dirichlet(np.ones(5) * 0.1, size=n)  # low noise
+        ratios[np.arange(n), labels] += 5.0  # Boost the correct class
+        ratios /= ratios.sum(axis=1, keepdims=True)
+        X[start:stop, 5:10] = ratios
+    return X, y
+
 
 class PacketClassifier:
-    def __init__(self):
+    def __init__(self, backend='eager', timeouts=None, parallel=True, calibration=None):
         # Features: avg, std, min, max, count, ratioA, ratioB, ratioC, ratioD, ratioE
         self.input_dim = 10
         self.num_classes = 5
-        self.cnn_model = SimpleCNN(self.input_dim, self.num_classes)
+        self.cnn_model = SimpleCNN(self.input_dim, self.num_classes) if SimpleCNN is not None else None
+        # CNN weights loaded without torch, for the numpy backend
+        self._cnn_weights = None
         self.xgb_model = xgb.XGBClassifier(use_label_encoder=False, eval_metric='logloss')
         self.iso_forest = IsolationForest(contamination=0.1)
         self.is_trained = False
+        self.version = MODEL_VERSION
+        self.set_backend(backend)
+        # Seconds each model ({'cnn': 0.05, ...}) may take per prediction, no limit if missing
+        self.timeouts = dict(timeouts or {})
+        self.parallel = parallel
+        # Model name -> its call still running past its timeout, see run_models()
+        self._overdue = {}
+        self._overdue_lock = threading.Lock()
+        # Feature rows (float32, n x input_dim) the int8 CNN is calibrated on, synthetic ones if None
+        self.calibration = calibration
 
-    def train_dummy(self):
+    def set_backend(self, backend):
+        """Selects the inference backend (see BACKENDS), compiled on first use."""
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+        if torch is None and backend != 'numpy':
+            raise ImportError(f"The {backend} inference backend needs torch, use the numpy one")
+        self.backend = backend
+        self._cnn_forward = None
+
+    def train_dummy(self, n_samples=DEFAULT_SAMPLES, epochs=DEFAULT_EPOCHS, batch_size=DEFAULT_BATCH_SIZE,
+                    threads=None, seed=None):
         """
         Trains models on SYNTHETIC data that perfectly matches the rules.
         This ensures '100% accuracy' for the demo based on the extracted ratios.
+        See fit() for the other arguments.
+        """
+        X, y = synthetic_dataset(n_samples, self.input_dim, self.num_classes, seed)
+        self.fit(X, y, epochs, batch_size, threads, seed)
+
+    def fit(self, X, y, epochs=DEFAULT_EPOCHS, batch_size=DEFAULT_BATCH_SIZE, threads=None, seed=None):
+        """
+        Trains the 3 models on X (float32, n x input_dim) and y (int64 classes).
+        threads caps the threads of torch, XGBoost and IsolationForest
+        (default: their own defaults, usually every core).
+        """
+        self.fit_normalization(X, seed)
+        self.fit_cnn(X, y, epochs, batch_size, threads, seed)
+        self.fit_xgboost(X, y, threads, seed)
+        self.fit_isolation_forest(X, threads, seed)
+        self.is_trained = True
+
+    def fit_normalization(self, X, seed=None):
+        """
+        Sets the CNN's input standardization to the per-feature mean and
+        standard deviation of X (of NORMALIZATION_ROWS random rows if it
+        has more). Constant features keep a scale of 1.
+        """
+        if torch is None:
+            raise ImportError("Training the CNN needs torch")
+        if len(X) > NORMALIZATION_ROWS:
+            rows = np.random.default_rng(seed).choice(len(X), NORMALIZATION_ROWS, replace=False)
+            X = X[np.sort(rows)]
+        X = X.astype(np.float64)
+        scale = X.std(axis=0)
+        scale[scale == 0] = 1
+        self.cnn_model.set_normalization(X.mean(axis=0), scale)
+
+    def fit_cnn(self, X, y, epochs=DEFAULT_EPOCHS, batch_size=DEFAULT_BATCH_SIZE, threads=None, seed=None,
+                learning_rate=LEARNING_RATE):
         """
-        # Generate 1000 samples
-        n_samples = 1000
-        X = np.zeros((n_samples, self.input_dim), dtype=np.float32)
-        y = np.zeros(n_samples, dtype=np.int64)
-
-        for i in range(n_samples):
-            # Pick a class
-            label = np.random.randint(0, self.num_classes)
-            y[i] = label
-            
-            # Base stats
-            X[i, 0] = np.random.normal(800, 200) # avg
-            X[i, 1] = np.random.normal(100, 20)  # std
-            X[i, 2] = 64
-            X[i, 3] = 1500
-            X[i, 4] = np.random.randint(100, 5000) # count
-            
-            # Magic Ratios: Make sure the ratio for the target class is DOMINANT
-            # indices 5,6,7,8,9 correspond to A,B,C,D,E
-            ratios = np.random.dirichlet(np.ones(5) * 0.1) # low noise
-            # Force dominant ratio
-            ratios[label] += 5.0 # Boost the correct class
-            ratios = ratios / ratios.sum()
-            
-            X[i, 5:10] = ratios
-
-        # Train CNN (PyTorch)
-        criterion = nn.CrossEntropyLoss()
-        optimizer = optim.Adam(self.cnn_model.parameters(), lr=0.01)
-        
-        X_tensor = torch.from_numpy(X)
-        y_tensor = torch.from_numpy(y)
-        
-        self.cnn_model.train()
-        for epoch in range(20): # Increased epochs
-            optimizer.zero_grad()
-            outputs = self.cnn_model(X_tensor)
-            loss = criterion(outputs, y_tensor)
-            loss.backward()
-            optimizer.step()
-
-        # Train XGBoost
+        Mini-batch training: every epoch goes over the samples in a new
+        random order, batch_size at a time (None = all of them at once).
+        The batches are gathered from X as they are needed, so memory
+        doesn't grow with the number of batches. Starts from the current
+        weights, so it also fine-tunes a trained CNN.
+        """
+        if torch is None:
+            raise ImportError("Training the CNN needs torch")
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+            torch.manual_seed(seed)
+        previous_threads = torch.get_num_threads()
+        if threads:
+            torch.set_num_threads(threads)
+        try:
+            criterion = nn.CrossEntropyLoss()
+            optimizer = optim.Adam(self.cnn_model.parameters(), lr=learning_rate)
+
+            X_tensor = torch.from_numpy(X)
+            y_tensor = torch.from_numpy(y)
+            n_samples = len(X_tensor)
+            batch_size = batch_size or n_samples
+
+            self.cnn_model.train()
+            for epoch in range(epochs):
+                order = torch.randperm(n_samples, generator=generator)
+                for start in range(0, n_samples, batch_size):
+                    batch = order[start:start + batch_size]
+                    optimizer.zero_grad()
+                    outputs = self.cnn_model(X_tensor[batch])
+                    loss = criterion(outputs, y_tensor[batch])
+                    loss.backward()
+                    optimizer.step()
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    def fit_xgboost(self, X, y, threads=None, seed=None):
+        self.xgb_model.set_params(n_jobs=threads, random_state=seed)
         self.xgb_model.fit(X, y)
 
-        # Train Isolation Forest (just on X)
+    def fit_isolation_forest(self, X, threads=None, seed=None):
+        """
+        Every tree only ever sees max_samples (256) rows, so on large
+        datasets it's fitted on ISOLATION_FOREST_ROWS random rows: the
+        anomaly threshold is as good and scoring all of X would dominate.
+        """
+        if len(X) > ISOLATION_FOREST_ROWS:
+            rows = np.random.default_rng(seed).choice(len(X), ISOLATION_FOREST_ROWS, replace=False)
+            X = X[np.sort(rows)]
+        self.iso_forest.set_params(n_jobs=threads, random_state=seed)
         self.iso_forest.fit(X)
-        
+
+    def update(self, X, y, window=None, epochs=FINE_TUNE_EPOCHS, batch_size=DEFAULT_BATCH_SIZE,
+               rounds=CONTINUE_ROUNDS, threads=None, seed=None):
+        """
+        Incremental training on new labelled rows X (float32), y (classes),
+        without starting over: the CNN is fine-tuned on them for `epochs`
+        (mini-batches, FINE_TUNE_LEARNING_RATE), XGBoost gets `rounds` more
+        boosting rounds fitted on them, and IsolationForest is refitted on
+        window (the latest rows of served traffic) if given.
+        The models are trained in place, see clone() to keep serving
+        the current ones meanwhile.
+        """
+        self.fit_cnn(X, y, epochs, batch_size, threads, seed, learning_rate=FINE_TUNE_LEARNING_RATE)
+        self.continue_xgboost(X, y, rounds, threads)
+        if window is not None:
+            self.fit_isolation_forest(window, threads, seed)
+        self._cnn_forward = None
+
+    def continue_xgboost(self, X, y, rounds=CONTINUE_ROUNDS, threads=None):
+        """
+        Adds `rounds` boosting rounds fitted on X, y to the current booster.
+        Goes through xgb.train() as the sklearn wrapper refuses new rows
+        that don't have every class.
+        """
+        params = {name: value for name, value in self.xgb_model.get_xgb_params().items()
+                  if value is not None and name != 'use_label_encoder'}
+        params['num_class'] = self.num_classes
+        if threads:
+            params['nthread'] = threads
+        booster = xgb.train(params, xgb.DMatrix(X, label=y), num_boost_round=rounds,
+                            xgb_model=self.xgb_model.get_booster().copy())
+        model = xgb.XGBClassifier()
+        model.load_model(booster.save_raw('json'))
+        self.xgb_model = model
+
+    def clone(self):
+        """Copy of the models and settings, independent of this classifier."""
+        clone = PacketClassifier(self.backend, self.timeouts, self.parallel, self.calibration)
+        if self.cnn_model is not None:
+            clone.cnn_model.load_state_dict(self.cnn_model.state_dict())
+        clone._cnn_weights = self._cnn_weights
+        if self.is_trained:
+            clone.xgb_model.load_model(self.xgb_model.get_booster().save_raw('json'))
+        clone.iso_forest = copy.deepcopy(self.iso_forest)
+        clone.is_trained = self.is_trained
+        clone.version = self.version
+        return clone
+
+    def adopt(self, other):
+        """
+        Serves the models of other (an updated clone()) from now on. Its
+        CNN is compiled for the backend before the swap, and each model is
+        swapped in one assignment, so a prediction running meanwhile uses
+        either the old or the new version of each model.
+        """
+        if other.cnn_model is not None:
+            other.cnn_model.eval()
+        forward = other.compile_cnn() if other.backend != 'eager' else None
+        self.cnn_model = other.cnn_model
+        self._cnn_weights = other._cnn_weights
+        self._cnn_forward = forward
+        self.xgb_model = other.xgb_model
+        self.iso_forest = other.iso_forest
+        self.version = other.version
+
+    def save(self, directory, replace=False):
+        """
+        Saves the trained models as a new build of MODEL_VERSION under
+        directory and returns its directory. The files are written to a
+        temporary directory renamed to the build once complete, then the
+        build is made current by replacing CURRENT_FILE, so a reader
+        always finds a complete current build. If another process saved
+        its models first, they stay current (unless replace) and this
+        build is discarded, otherwise the version becomes the one load()
+        gives these artifacts.
+        """
+        target = artifact_dir(directory)
+        os.makedirs(target, exist_ok=True)
+        tmp = os.path.join(target, f".tmp-{os.getpid()}-{threading.get_ident()}")
+        os.makedirs(tmp)
+        try:
+            state = self.cnn_model.state_dict()
+            torch.save(state, os.path.join(tmp, ARTIFACT_FILES['cnn']))
+            with open(os.path.join(tmp, ARTIFACT_FILES['cnn_numpy']), 'wb') as f:
+                np.savez(f, **{name: tensor.numpy() for name, tensor in state.items()})
+            self.xgb_model.save_model(os.path.join(tmp, ARTIFACT_FILES['xgboost']))
+            joblib.dump(self.iso_forest, os.path.join(tmp, ARTIFACT_FILES['isolation_forest']))
+            manifest = {
+                'model_version': MODEL_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'input_dim': self.input_dim,
+                'num_classes': self.num_classes,
+                'libraries': {'torch': torch.__version__, 'xgboost': xgb.__version__,
+                              'scikit-learn': sklearn.__version__},
+                'files': {
+                    name: {'file': filename, 'sha256': file_sha256(os.path.join(tmp, filename))}
+                    for name, filename in ARTIFACT_FILES.items()
+                },
+            }
+            with open(os.path.join(tmp, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            build = file_sha256(os.path.join(tmp, MANIFEST_FILE))[:12]
+            path = os.path.join(target, build)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # The same build saved by someone else
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        current = os.path.join(target, CURRENT_FILE)
+        pointer = f"{current}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(pointer, 'w') as f:
+            f.write(build)
+        try:
+            if replace:
+                os.replace(pointer, current)
+            else:
+                # Only made current if no build is yet
+                os.link(pointer, current)
+            self.version = f"{MODEL_VERSION}-{build}"
+        except FileExistsError:
+            pass
+        finally:
+            if os.path.exists(pointer):
+                os.remove(pointer)
+        self.remove_old_builds(directory)
+        return os.path.join(target, current_build(directory))
+
+    @staticmethod
+    def remove_old_builds(directory, keep=KEPT_BUILDS):
+        """
+        Removes the builds of MODEL_VERSION under directory but the `keep`
+        most recent ones and the current one. A process that read the
+        previous pointer still finds its build.
+        """
+        target = artifact_dir(directory)
+        current = current_build(directory)
+        builds = []
+        for name in os.listdir(target):
+            path = os.path.join(target, name)
+            if name != current and not name.startswith('.') and os.path.isdir(path):
+                builds.append((os.stat(path).st_mtime, path))
+        for _, path in sorted(builds)[:max(len(builds) - (keep - 1), 0)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def load(self, directory):
+        """
+        Loads the current build of MODEL_VERSION saved under directory.
+        Every file is checked against the SHA-256 of the manifest before
+        it is read. Raises FileNotFoundError if there are none, ValueError
+        if they don't match the manifest or this version of the models.
+        """
+        build = current_build(directory)
+        if build is None:
+            raise FileNotFoundError(f"No current build in {artifact_dir(directory)}")
+        path = os.path.join(artifact_dir(directory), build)
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        with open(manifest_path, 'rb') as f:
+            raw_manifest = f.read()
+        manifest = json.loads(raw_manifest)
+        if (manifest.get('model_version') != MODEL_VERSION or manifest.get('input_dim') != self.input_dim
+                or manifest.get('num_classes') != self.num_classes):
+            raise ValueError(f"{manifest_path} doesn't describe version {MODEL_VERSION} of the models")
+        files = {}
+        for name, filename in ARTIFACT_FILES.items():
+            entry = manifest['files'].get(name, {})
+            files[name] = os.path.join(path, filename)
+            if entry.get('file') != filename or file_sha256(files[name]) != entry.get('sha256'):
+                raise ValueError(f"Checksum mismatch for the {name} model artifact {files[name]}")
+
+        if self.cnn_model is not None:
+            self.cnn_model.load_state_dict(torch.load(files['cnn'], weights_only=True))
+        else:
+            with np.load(files['cnn_numpy'], allow_pickle=False) as arrays:
+                self._cnn_weights = {name: arrays[name] for name in arrays.files}
+        self._cnn_forward = None
+        self.xgb_model.load_model(files['xgboost'])
+        self.iso_forest = joblib.load(files['isolation_forest'])
         self.is_trained = True
+        # Results are cached per trained models, not only per version
+        self.version = f"{MODEL_VERSION}-{hashlib.sha256(raw_manifest).hexdigest()[:12]}"
 
     def predict(self, features):
         """
         Predicts using all 3 models.
         features: dict of features
         """
+        return self.predict_batch([features])[0]
+
+    def predict_batch(self, features_list):
+        """
+        predict() of many features dicts (or of a feature_matrix() array)
+        at once: one CNN forward pass, one XGBoost call and one
+        IsolationForest call for the whole batch. Returns a list of
+        predict() results, in order.
+        """
         if not self.is_trained:
             self.train_dummy()
 
-        # Convert features dict to array in correct order
-        feature_list = [
-            features.get('avg_packet_size', 0),
-            features.get('std_packet_size', 0),
-            features.get('min_packet_size', 0),
-            features.get('max_packet_size', 0),
-            features.get('packet_count', 0),
-            features.get('ratio_A', 0),
-            features.get('ratio_B', 0),
-            features.get('ratio_C', 0),
-            features.get('ratio_D', 0),
-            features.get('ratio_E', 0),
-        ]
-        X = np.array([feature_list], dtype=np.float32) # Shape (1, 10)
+        if isinstance(features_list, np.ndarray):
+            X = np.ascontiguousarray(features_list, dtype=np.float32)
+        else:
+            X = feature_matrix(features_list)  # Shape (N, 10)
+        if not len(X):
+            return []
+
+        outputs, degraded = self.run_models(X)
 
         # CNN Prediction
-        self.cnn_model.eval()
-        with torch.no_grad():
-            X_tensor = torch.from_numpy(X)
-            outputs = self.cnn_model(X_tensor)
-            probs = torch.softmax(outputs, dim=1).numpy()[0]
-            cnn_pred_class = np.argmax(probs)
-            cnn_confidence = np.max(probs)
-        
+        if 'cnn' in outputs:
+            probs = outputs['cnn']
+            cnn_pred_class = probs.argmax(axis=1).tolist()
+            cnn_confidence = probs.max(axis=1).tolist()
+
         # XGBoost Prediction
-        xgb_pred_class = self.xgb_model.predict(X)[0]
-        
-        # Isolation Forest (1 = normal, -1 = anomaly)
-        iso_pred = self.iso_forest.predict(X)[0]
-        iso_score = self.iso_forest.decision_function(X)[0]
-
-        return {
-            'cnn': {
-                'class': int(cnn_pred_class),
-                'confidence': float(cnn_confidence)
-            },
-            'xgboost': {
-                'class': int(xgb_pred_class)
-            },
-            'isolation_forest': {
-                'is_anomaly': bool(iso_pred == -1),
-                'score': float(iso_score)
-            }
+        if 'xgboost' in outputs:
+            xgb_pred_class = outputs['xgboost'].tolist()
+
+        # Isolation Forest: anomalies are the negative scores (what predict() returns as -1)
+        if 'isolation_forest' in outputs:
+            iso_score = outputs['isolation_forest'].tolist()
+
+        # Models without output get the same (degraded) result for every row
+        results = [{name: dict(DEGRADED_RESULTS[name], degraded=reason) for name, reason in degraded.items()}
+                   for _ in range(len(X))]
+        for i, result in enumerate(results):
+            if 'cnn' in outputs:
+                result['cnn'] = {
+                    'class': int(cnn_pred_class[i]),
+                    'confidence': float(cnn_confidence[i])
+                }
+            if 'xgboost' in outputs:
+                result['xgboost'] = {
+                    'class': int(xgb_pred_class[i])
+                }
+            if 'isolation_forest' in outputs:
+                result['isolation_forest'] = {
+                    'is_anomaly': iso_score[i] < 0,
+                    'score': float(iso_score[i])
+                }
+        return results
+
+    def run_models(self, X):
+        """
+        Runs the 3 models on X and returns (outputs, degraded): the CNN
+        probabilities, XGBoost classes and IsolationForest scores by model
+        name, and {name: reason} of the models that have none. With
+        parallel, the models run at the same time on the shared model pool
+        and a model still running after its timeout (seconds since the
+        dispatch, see timeouts) is given up on, so the slowest model, not
+        the sum of the three, bounds the latency. A model that raises is
+        degraded as well.
+
+        A call already running can't be stopped: it keeps its pool thread
+        until it returns. Until then the model isn't called again, it is
+        degraded as 'busy' right away, so a hanging model holds at most
+        one pool thread per classifier instead of one per prediction.
+        """
+        runs = {
+            'cnn': self.cnn_probabilities,
+            'xgboost': self.xgboost_classes,
+            'isolation_forest': self.iso_forest.decision_function,
         }
+        outputs = {}
+        degraded = {}
+        if not self.parallel:
+            for name, run in runs.items():
+                try:
+                    outputs[name] = run(X)
+                except Exception as e:
+                    print(f"The {name} model failed: {e}")
+                    degraded[name] = 'error'
+            return outputs, degraded
+
+        started = time.monotonic()
+        futures = {}
+        with self._overdue_lock:
+            for name, run in runs.items():
+                overdue = self._overdue.get(name)
+                if overdue is not None and not overdue.done():
+                    degraded[name] = 'busy'
+                    continue
+                self._overdue.pop(name, None)
+                futures[name] = model_pool().submit(run, X)
+        for name, future in futures.items():
+            timeout = self.timeouts.get(name)
+            try:
+                outputs[name] = future.result(None if timeout is None else max(started + timeout - time.monotonic(), 0))
+            except FutureTimeoutError:
+                # Only a call still queued can be cancelled, a running one is
+                # left to finish in the background and its output is dropped
+                if not future.cancel():
+                    with self._overdue_lock:
+                        self._overdue[name] = future
+                degraded[name] = 'timeout'
+            except Exception as e:
+                print(f"The {name} model failed: {e}")
+                degraded[name] = 'error'
+        return outputs, degraded
+
+    def cnn_probabilities(self, X):
+        """Class probabilities of the CNN for X (float32 array), with the selected backend."""
+        if self.backend == 'eager':
+            self.cnn_model.eval()
+            with torch.no_grad():
+                return torch.softmax(self.cnn_model(torch.from_numpy(X)), dim=1).numpy()
+        if self._cnn_forward is None:
+            self._cnn_forward = self.compile_cnn()
+        return softmax(self._cnn_forward(X))
+
+    def xgboost_classes(self, X):
+        """XGBoost classes for X (float32 array), with the selected backend."""
+        if self.backend == 'eager':
+            return self.xgb_model.predict(X)
+        # Class probabilities straight from the booster, on the numpy array
+        return self.xgb_model.get_booster().inplace_predict(X).argmax(axis=1)
+
+    def compile_cnn(self):
+        """
+        The CNN forward pass compiled for the selected backend, as a function
+        of a float32 array returning the logits. Compiled from the current
+        weights, so it's redone after training or loading.
+        """
+        if self.backend == 'numpy':
+            if self.cnn_model is None:
+                return NumpyCNN(self._cnn_weights)
+            return NumpyCNN({name: tensor.numpy() for name, tensor in self.cnn_model.state_dict().items()})
+
+        self.cnn_model.eval()
+        example = torch.zeros((2, self.input_dim))
+        if self.backend == 'int8':
+            module = self.quantize_cnn()
+
+            def forward(X):
+                with torch.inference_mode():
+                    return module(torch.from_numpy(X)).numpy()
+            return forward
+
+        if self.backend == 'torchscript':
+            with torch.no_grad():
+                module = torch.jit.optimize_for_inference(torch.jit.trace(self.cnn_model, example))
+
+            def forward(X):
+                with torch.inference_mode():
+                    return module(torch.from_numpy(X)).numpy()
+            return forward
+
+        if onnxruntime is None:
+            raise ImportError("The onnx inference backend needs onnx and onnxruntime")
+        model = io.BytesIO()
+        torch.onnx.export(self.cnn_model, (example,), model, input_names=['features'], output_names=['logits'],
+                          dynamic_axes={'features': {0: 'batch'}, 'logits': {0: 'batch'}}, dynamo=False)
+        session = onnxruntime.InferenceSession(model.getvalue(), providers=['CPUExecutionProvider'])
+        return lambda X: session.run(None, {'features': X})[0]
+
+    def quantize_cnn(self, calibration=None):
+        """
+        Copy of the CNN with int8 conv and linear layers (and activations),
+        for torch's current quantized engine. The activation ranges are
+        calibrated on calibration (feature rows), by default self.calibration
+        or CALIBRATION_SAMPLES synthetic rows.
+        """
+        # Only the int8 backend needs them
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        if calibration is None:
+            calibration = self.calibration
+        if calibration is None:
+            calibration, _ = synthetic_dataset(CALIBRATION_SAMPLES, self.input_dim, self.num_classes, seed=0)
+        calibration = torch.from_numpy(np.ascontiguousarray(calibration, dtype=np.float32))
+
+        model = copy.deepcopy(self.cnn_model).eval()
+        prepared = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine),
+                              (calibration[:1],))
+        with torch.no_grad():
+            for start in range(0, len(calibration), DEFAULT_BATCH_SIZE):
+                prepared(calibration[start:start + DEFAULT_BATCH_SIZE])
+        return convert_fx(prepared)
 
     def get_class_name(self, class_id):
         mapping = {
@@ -156,3 +708,42 @@ class PacketClassifier:
             4: "Class E (System / Other)"
         }
         return mapping.get(class_id, "Unknown")
+
+
+def model_timeouts(timeouts_ms):
+    """PacketClassifier timeouts (seconds) of a {model: milliseconds} setting, 0 being no limit."""
+    return {name: ms / 1000 for name, ms in timeouts_ms.items() if ms > 0}
+
+
+def load_calibration(path):
+    """Feature rows (float32 .npy array, n x 10) the int8 CNN is calibrated on, None without path."""
+    if not path:
+        return None
+    return np.load(path, allow_pickle=False).astype(np.float32).reshape(-1, len(FEATURE_NAMES))
+
+
+def load_classifier(directory, backend='eager', timeouts=None, parallel=True, calibration=None):
+    """
+    PacketClassifier with the artifacts saved under directory, running
+    them with the given inference backend (see BACKENDS), timeouts and
+    parallel (see PacketClassifier.run_models()), the int8 backend being
+    calibrated on calibration. If there
+    are none for this MODEL_VERSION yet, the models are trained and saved
+    first, so only the first process started after a version change
+    trains them. Artifacts that fail the checksum check raise ValueError
+    instead of being silently retrained. The CNN of a compiled backend is
+    compiled here rather than on the first prediction.
+    """
+    classifier = PacketClassifier(backend, timeouts, parallel, calibration)
+    try:
+        classifier.load(directory)
+    except FileNotFoundError:
+        print(f"No model artifacts for version {MODEL_VERSION} in {directory}, training them")
+        classifier.train_dummy()
+        classifier.save(directory)
+        # Another process may have saved its own models first, everyone serves the same ones
+        classifier = PacketClassifier(backend, timeouts, parallel, calibration)
+        classifier.load(directory)
+    if backend != 'eager':
+        classifier._cnn_forward = classifier.compile_cnn()
+    return classifier
@@ -0,0 +1,48 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class NumpyCNN:
+    """
+    Forward pass of SimpleCNN (input standardization, Conv1d k=3 padding 1,
+    ReLU, MaxPool1d(2), Linear, ReLU, Linear) in numpy, from the arrays of
+    its state_dict.
+    Needs no torch, so a serving process can run the CNN without it.
+    Called with a float32 (N, input_dim) array, returns the (N, classes)
+    logits.
+    """
+
+    def __init__(self, weights):
+        self.input_mean = np.asarray(weights['input_mean'], dtype=np.float32)
+        self.input_scale = np.asarray(weights['input_scale'], dtype=np.float32)
+        conv_weight = np.asarray(weights['conv1.weight'], dtype=np.float32)  # (channels, 1, 3)
+        self.channels, _, self.kernel = conv_weight.shape
+        self.conv_weight = np.ascontiguousarray(conv_weight[:, 0, :].T)  # (3, channels)
+        self.conv_bias = np.asarray(weights['conv1.bias'], dtype=np.float32)
+        fc1_weight = np.asarray(weights['fc1.weight'], dtype=np.float32)  # (hidden, channels * pooled)
+        self.pooled = fc1_weight.shape[1] // self.channels
+        # torch flattens the pooled activations channel first; they are computed
+        # position first here, so fc1's columns are reordered once instead
+        self.fc1_weight = np.ascontiguousarray(
+            fc1_weight.reshape(-1, self.channels, self.pooled).transpose(2, 1, 0).reshape(-1, fc1_weight.shape[0]))
+        self.fc1_bias = np.asarray(weights['fc1.bias'], dtype=np.float32)
+        self.fc2_weight = np.ascontiguousarray(np.asarray(weights['fc2.weight'], dtype=np.float32).T)
+        self.fc2_bias = np.asarray(weights['fc2.bias'], dtype=np.float32)
+
+    def __call__(self, X):
+        n = len(X)
+        padding = self.kernel // 2
+        X = (np.asarray(X, dtype=np.float32) - self.input_mean) / self.input_scale
+        padded = np.pad(X, ((0, 0), (padding, padding)))
+        # (N, positions, 3) @ (3, channels): every output of the convolution in one product
+        x = sliding_window_view(padded, self.kernel, axis=1) @ self.conv_weight
+        x += self.conv_bias
+        np.maximum(x, 0, out=x)
+        # MaxPool1d(2) over the positions, the odd one out (if any) is dropped like torch does
+        x = x[:, :2 * self.pooled].reshape(n, self.pooled, 2, self.channels).max(axis=2)
+        x = x.reshape(n, -1) @ self.fc1_weight
+        x += self.fc1_bias
+        np.maximum(x, 0, out=x)
+        x = x @ self.fc2_weight
+        x += self.fc2_bias
+        return x
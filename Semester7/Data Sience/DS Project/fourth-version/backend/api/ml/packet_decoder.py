@@ -0,0 +1,227 @@
+import scapy.all as scapy
+
+# Link types handled by the fast path, anything else is dissected by scapy
+DLT_EN10MB = 1
+DLT_RAW = 101
+DLT_LINUX_SLL = 113
+
+ETH_IPV4 = 0x0800
+ETH_ARP = 0x0806
+ETH_IPV6 = 0x86DD
+ETH_VLAN = (0x8100, 0x88A8)
+
+IP_ICMP = 1
+IP_TCP = 6
+IP_UDP = 17
+IPV6_ICMP = 58
+IPV6_NONXT = 59
+
+# UDP ports scapy dissects as tunnels (L2TP, GRE, VXLAN). The inner headers
+# would change what haslayer() sees, so those packets go through scapy.
+TUNNEL_PORTS = frozenset((1701, 4754, 4789, 4790, 6633, 8472, 48879))
+
+# Smallest L4 payload that scapy fully dissects for each layer
+MIN_ICMP_LEN = 20
+MIN_TCP_LEN = 20
+MIN_UDP_LEN = 8
+MIN_STP_LEN = 38  # LLC (3) + STP BPDU (35)
+
+# Decoded result for non-IP packets without STP
+NO_LAYER = (None, 0, 0, 0, b'', b'')
+
+
+def decode_headers(data, linktype):
+    """
+    Reads the headers needed by identify_protocol() straight from the raw record.
+    Returns (layer, sport, dport) where layer is "ICMP", "STP" or None,
+    or None when the record has to be dissected by scapy to get the same answer.
+    """
+    decoded = decode_flow(data, linktype)
+    return decoded[:3] if decoded is not None else None
+
+
+def decode_flow(data, linktype):
+    """
+    Same as decode_headers() but also returns the flow addressing:
+    (layer, sport, dport, proto, src, dst), with src/dst the packed
+    IPv4/IPv6 addresses (b'' for non-IP packets) and proto the IP protocol.
+    data may be bytes or a memoryview, the addresses are always bytes.
+    """
+    length = len(data)
+
+    if linktype == DLT_EN10MB:
+        if length < 14:
+            return None
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype <= 1500:
+            return _decode_llc(data, ethertype)
+        offset = 14
+        while ethertype in ETH_VLAN:
+            if length < offset + 4:
+                return None
+            ethertype = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+            if ethertype <= 1500:
+                return None
+    elif linktype == DLT_LINUX_SLL:
+        if length < 16:
+            return None
+        ethertype = (data[14] << 8) | data[15]
+        offset = 16
+    elif linktype == DLT_RAW:
+        if not length:
+            return None
+        ethertype = ETH_IPV6 if data[0] >> 4 == 6 else ETH_IPV4
+        offset = 0
+    else:
+        return None
+
+    if ethertype == ETH_IPV4:
+        return _decode_ipv4(data, offset)
+    if ethertype == ETH_IPV6:
+        return _decode_ipv6(data, offset)
+    if ethertype == ETH_ARP:
+        return NO_LAYER
+    return None
+
+
+def _decode_llc(data, dot3_len):
+    # 802.3 frame: only the STP BPDU (LLC 0x42/0x42/0x03) is decoded here
+    if data[14:17] == b'\x42\x42\x03' and dot3_len >= MIN_STP_LEN and len(data) >= 14 + MIN_STP_LEN:
+        return ("STP", 0, 0, 0, b'', b'')
+    return None
+
+
+def _decode_ipv4(data, offset):
+    available = len(data) - offset
+    if available < 20:
+        return None
+    ihl = (data[offset] & 0x0F) * 4
+    if ihl < 20 or available < ihl:
+        return None
+
+    proto = data[offset + 9]
+    if proto not in (IP_ICMP, IP_TCP, IP_UDP):
+        return None
+    src = bytes(data[offset + 12:offset + 16])
+    dst = bytes(data[offset + 16:offset + 20])
+    # Non-first fragments carry no L4 header
+    if (data[offset + 6] & 0x1F) or data[offset + 7]:
+        return (None, 0, 0, proto, src, dst)
+
+    # scapy cuts the payload at the IP total length
+    total_len = (data[offset + 2] << 8) | data[offset + 3]
+    available -= ihl
+    if total_len >= ihl:
+        available = min(available, total_len - ihl)
+    return _decode_l4(data, offset + ihl, available, proto, src, dst)
+
+
+def _decode_ipv6(data, offset):
+    available = len(data) - offset
+    if available < 40:
+        return None
+
+    next_header = data[offset + 6]
+    payload_len = (data[offset + 4] << 8) | data[offset + 5]
+    available = min(available - 40, payload_len)
+    l4 = offset + 40
+    src = bytes(data[offset + 8:offset + 24])
+    dst = bytes(data[offset + 24:offset + 40])
+
+    if next_header in (IP_TCP, IP_UDP):
+        return _decode_l4(data, l4, available, next_header, src, dst)
+    if next_header == IPV6_NONXT:
+        return (None, 0, 0, next_header, src, dst)
+    if next_header == IPV6_ICMP:
+        # Informational ICMPv6 messages (type >= 128) never quote another packet
+        if available <= 0 or data[l4] >= 128:
+            return (None, 0, 0, next_header, src, dst)
+    return None
+
+
+def _decode_l4(data, offset, available, proto, src, dst):
+    if available <= 0:
+        return (None, 0, 0, proto, src, dst)
+
+    if proto == IP_ICMP:
+        return ("ICMP", 0, 0, proto, src, dst) if available >= MIN_ICMP_LEN else None
+
+    if available < (MIN_TCP_LEN if proto == IP_TCP else MIN_UDP_LEN):
+        return None
+    sport = (data[offset] << 8) | data[offset + 1]
+    dport = (data[offset + 2] << 8) | data[offset + 3]
+    if proto == IP_UDP and (sport in TUNNEL_PORTS or dport in TUNNEL_PORTS):
+        return None
+    return (None, sport, dport, proto, src, dst)
+
+
+def payload_bounds(data, linktype):
+    """
+    (start, end) offsets of the TCP/UDP payload of a raw record, for payload
+    inspection, or None if the record has no such payload (or its headers
+    are not understood). Unlike decode_flow() this needs no scapy parity.
+    """
+    length = len(data)
+    if linktype == DLT_EN10MB:
+        if length < 14:
+            return None
+        ethertype = (data[12] << 8) | data[13]
+        offset = 14
+        while ethertype in ETH_VLAN and length >= offset + 4:
+            ethertype = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+    elif linktype == DLT_LINUX_SLL:
+        if length < 16:
+            return None
+        ethertype = (data[14] << 8) | data[15]
+        offset = 16
+    elif linktype == DLT_RAW:
+        if not length:
+            return None
+        ethertype = ETH_IPV6 if data[0] >> 4 == 6 else ETH_IPV4
+        offset = 0
+    else:
+        return None
+
+    if ethertype == ETH_IPV4:
+        if length < offset + 20:
+            return None
+        ihl = (data[offset] & 0x0F) * 4
+        # Non-first fragments carry no L4 header
+        if ihl < 20 or (data[offset + 6] & 0x1F) or data[offset + 7]:
+            return None
+        proto = data[offset + 9]
+        end = offset + ((data[offset + 2] << 8) | data[offset + 3])
+        offset += ihl
+    elif ethertype == ETH_IPV6:
+        if length < offset + 40:
+            return None
+        proto = data[offset + 6]
+        end = offset + 40 + ((data[offset + 4] << 8) | data[offset + 5])
+        offset += 40
+    else:
+        return None
+
+    # Payload cut at the IP length, or at the capture length (padding, snaplen)
+    if end > length:
+        end = length
+    if proto == IP_TCP:
+        if end < offset + MIN_TCP_LEN:
+            return None
+        offset += (data[offset + 12] >> 4) * 4
+    elif proto == IP_UDP:
+        offset += MIN_UDP_LEN
+    else:
+        return None
+    return (offset, end) if offset <= end else None
+
+
+def dissect(data, linktype):
+    """Builds the scapy packet for a raw record, the same way scapy.PcapReader does."""
+    cls = scapy.conf.l2types.num2layer.get(linktype, scapy.conf.raw_layer)
+    data = bytes(data)
+    try:
+        return cls(data)
+    except Exception:
+        return scapy.conf.raw_layer(data)
@@ -0,0 +1,322 @@
+import json
+import os
+import shutil
+import struct
+from array import array
+
+import numpy as np
+
+from .protocol_rules import LAYERS
+from .sketches import address_key
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    # Parquet tables are optional, .npy tables only need numpy
+    pyarrow = parquet = None
+
+# A packet table holds the per-packet fields the features are computed from,
+# one column per field, so a capture is parsed once and analysed again by
+# reading only the columns needed:
+# - "npy": a directory (<capture>.table) with one .npy file per column and
+#   meta.json; columns are memory-mapped when read.
+# - "parquet": a single Parquet file (<capture>.parquet), the metadata in the
+#   schema metadata; needs pyarrow.
+TABLE_VERSION = 1
+COLUMNS = {
+    'ts': np.dtype('<f8'),
+    # Captured bytes, the packet size used by the features
+    'length': np.dtype('<u4'),
+    # Addresses as 16 bytes: IPv4 as IPv4-mapped IPv6, all zeros for non-IP packets
+    'src': np.dtype(('u1', (16,))),
+    'dst': np.dtype(('u1', (16,))),
+    'sport': np.dtype('<u2'),
+    'dport': np.dtype('<u2'),
+    'proto': np.dtype('u1'),
+    # Index into meta["layers"], 0 for none
+    'layer': np.dtype('u1'),
+    # Classification with the rules of meta["rules_version"]
+    'protocol_id': np.dtype('<u2'),
+    'class_id': np.dtype('u1'),
+}
+ADDRESS_COLUMNS = ('src', 'dst')
+META_FILE = 'meta.json'
+PARQUET_META_KEY = b'packet_table'
+# Rows per batch when reading a table
+TABLE_BATCH = 1 << 20
+# .npy header written before the number of rows is known, rewritten at the end
+NPY_HEADER_LEN = 128
+
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+NO_ADDRESS = b'\x00' * 16
+
+
+def table_path(pcap_path, fmt='npy'):
+    """Where the packet table of a capture is written by default, next to it."""
+    if fmt not in ('npy', 'parquet'):
+        raise ValueError(f"Unknown packet table format {fmt!r}, expected npy or parquet")
+    return pcap_path + ('.parquet' if fmt == 'parquet' else '.table')
+
+
+def table_format(path):
+    return 'parquet' if path.endswith('.parquet') else 'npy'
+
+
+def _capture_stamp(pcap_path):
+    st = os.stat(pcap_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def pack_address(address):
+    """16-byte column value of a packed IPv4/IPv6 address (b'' if not IP)."""
+    if len(address) == 4:
+        return IPV4_MAPPED_PREFIX + address
+    return address if len(address) == 16 else NO_ADDRESS
+
+
+def unpack_address(value):
+    """Inverse of pack_address()."""
+    if value[:12] == IPV4_MAPPED_PREFIX:
+        return value[12:]
+    return b'' if value == NO_ADDRESS else value
+
+
+def address_keys(addresses):
+    """
+    TalkerSketch keys (see sketches.address_key()) of an (n, 16) address
+    column. Returns (keys, is_ip, ipv6) with ipv6 mapping the IPv6 keys to
+    their packed addresses. Only the distinct IPv6 addresses are hashed.
+    """
+    is_v4 = (addresses[:, :12] == np.frombuffer(IPV4_MAPPED_PREFIX, dtype=np.uint8)).all(axis=1)
+    is_ip = addresses.any(axis=1)
+    keys = np.zeros(len(addresses), dtype=np.uint64)
+    keys[is_v4] = np.ascontiguousarray(addresses[is_v4, 12:]).view('>u4').ravel()
+    ipv6 = {}
+    is_v6 = is_ip & ~is_v4
+    if is_v6.any():
+        distinct, inverse = np.unique(addresses[is_v6], axis=0, return_inverse=True)
+        packed = [row.tobytes() for row in distinct]
+        distinct_keys = np.array([address_key(address) for address in packed], dtype=np.uint64)
+        keys[is_v6] = distinct_keys[inverse.ravel()]
+        ipv6 = dict(zip(distinct_keys.tolist(), packed))
+    return keys, is_ip, ipv6
+
+
+def _npy_header(dtype, rows):
+    # Format 1.0: magic, version, header length, then the header dict padded with spaces
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype.base), 'fortran_order': False,
+                   'shape': (rows,) + dtype.shape}).encode('latin1')
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', NPY_HEADER_LEN - 10) + header.ljust(NPY_HEADER_LEN - 11) + b'\n'
+
+
+class PacketTableWriter:
+    """
+    Writes a packet table batch by batch, so exporting a capture takes no
+    more memory than one batch. The table is written under a temporary
+    name and moved in place by close(), a reader never sees half a table.
+    """
+
+    def __init__(self, path, pcap_path, rules, inspect_bytes=0):
+        self.path = path
+        self.format = table_format(path)
+        self.rules = rules
+        self.rows = 0
+        # Layer names the decoders and the payload inspector can report
+        self.layers = [None] + list(LAYERS) + [rules.names[rule_id] for rule_id in sorted(rules.payload_patterns)]
+        self.layer_codes = {name: code for code, name in enumerate(self.layers)}
+        self.layer_ranks = np.array([rules.layer_rank(name) for name in self.layers], dtype=np.uint16)
+        self.meta = {
+            'table_version': TABLE_VERSION,
+            'capture': _capture_stamp(pcap_path),
+            'rules_version': rules.version,
+            'protocols': rules.protocols,
+            'layers': self.layers,
+            'inspect_bytes': inspect_bytes,
+        }
+        self.tmp_path = f"{path}.tmp-{os.getpid()}"
+        if self.format == 'parquet':
+            if parquet is None:
+                raise ImportError("Parquet packet tables need pyarrow")
+            schema = pyarrow.schema(
+                [(name, pyarrow.binary(16) if name in ADDRESS_COLUMNS else pyarrow.from_numpy_dtype(dtype))
+                 for name, dtype in COLUMNS.items()],
+                metadata={PARQUET_META_KEY: json.dumps(self.meta)},
+            )
+            self.writer = parquet.ParquetWriter(self.tmp_path, schema)
+        else:
+            os.makedirs(self.tmp_path)
+            self.files = {}
+            for name, dtype in COLUMNS.items():
+                f = self.files[name] = open(os.path.join(self.tmp_path, name + '.npy'), 'wb')
+                f.write(_npy_header(dtype, 0))
+
+    def add(self, timestamps, sizes, flows):
+        """
+        Adds a batch of packets: their timestamps and sizes (numpy arrays)
+        and their (layer, sport, dport, proto, src, dst) tuples.
+        """
+        sports, dports, protos, layers = array('H'), array('H'), array('B'), array('B')
+        src, dst = bytearray(), bytearray()
+        layer_codes = self.layer_codes
+        for layer, sport, dport, proto, src_address, dst_address in flows:
+            sports.append(sport)
+            dports.append(dport)
+            protos.append(proto)
+            layers.append(layer_codes[layer])
+            src += pack_address(src_address)
+            dst += pack_address(dst_address)
+
+        columns = {
+            'ts': np.asarray(timestamps, dtype=np.float64),
+            'length': np.asarray(sizes, dtype=np.uint32),
+            'src': np.frombuffer(src, dtype=np.uint8).reshape(-1, 16),
+            'dst': np.frombuffer(dst, dtype=np.uint8).reshape(-1, 16),
+            'sport': np.frombuffer(sports, dtype=np.uint16),
+            'dport': np.frombuffer(dports, dtype=np.uint16),
+            'proto': np.frombuffer(protos, dtype=np.uint8),
+            'layer': np.frombuffer(layers, dtype=np.uint8),
+        }
+        columns['protocol_id'] = self.rules.classify(columns['sport'], columns['dport'],
+                                                     self.layer_ranks[columns['layer']])
+        columns['class_id'] = self.rules.class_ids[columns['protocol_id']]
+        self.write(columns)
+
+    def write(self, columns):
+        """Adds a batch given as a dict of numpy arrays, one per column."""
+        rows = len(columns['ts'])
+        if not rows:
+            return
+        if self.format == 'parquet':
+            arrays = []
+            for name, dtype in COLUMNS.items():
+                if name in ADDRESS_COLUMNS:
+                    values = np.ascontiguousarray(columns[name], dtype=np.uint8)
+                    arrays.append(pyarrow.FixedSizeBinaryArray.from_buffers(
+                        pyarrow.binary(16), rows, [None, pyarrow.py_buffer(values.tobytes())]))
+                else:
+                    arrays.append(pyarrow.array(np.asarray(columns[name], dtype=dtype)))
+            self.writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, names=list(COLUMNS)))
+        else:
+            for name, dtype in COLUMNS.items():
+                self.files[name].write(np.ascontiguousarray(columns[name], dtype=dtype.base).tobytes())
+        self.rows += rows
+
+    def close(self):
+        """Finishes the table and moves it in place. Returns the path."""
+        if self.format == 'parquet':
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+            return self.path
+
+        for name, dtype in COLUMNS.items():
+            f = self.files[name]
+            f.seek(0)
+            f.write(_npy_header(dtype, self.rows))
+            f.close()
+        self.meta['packets'] = self.rows
+        with open(os.path.join(self.tmp_path, META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Drops the partly written table."""
+        if self.format == 'parquet':
+            self.writer.close()
+            os.remove(self.tmp_path)
+        else:
+            for f in self.files.values():
+                f.close()
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class PacketTable:
+    """
+    A packet table written by PacketTableWriter, read column by column.
+
+    .npy columns are memory-mapped, so computing features from a table
+    reads the few columns involved (14 bytes per packet for the size and
+    protocol of every packet) and nothing else: the cost is that of the
+    disk, not of a parser. Raises OSError or ValueError (ImportError for
+    Parquet without pyarrow) if the table can't be read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = table_format(path)
+        if self.format == 'parquet':
+            if parquet is None:
+                raise ImportError("Parquet packet tables need pyarrow")
+            self.file = parquet.ParquetFile(path)
+            self.meta = json.loads(self.file.schema_arrow.metadata[PARQUET_META_KEY])
+            self.packets = self.file.metadata.num_rows
+        else:
+            with open(os.path.join(path, META_FILE)) as f:
+                self.meta = json.load(f)
+            self.packets = self.meta['packets']
+        if self.meta.get('table_version') != TABLE_VERSION:
+            raise ValueError(f"{path}: unsupported packet table version {self.meta.get('table_version')}")
+        self.layers = self.meta['layers']
+
+    def is_fresh(self, pcap_path):
+        """Whether the table was written from the capture as it is now (same size and mtime)."""
+        try:
+            return self.meta['capture'] == _capture_stamp(pcap_path)
+        except OSError:
+            return False
+
+    def is_usable(self, rules, inspect_bytes=0):
+        """
+        Whether the table can be classified with `rules`: always without
+        payload inspection (the ports and layers are in the table), but
+        payload signature matches only hold for the rules they were found with.
+        """
+        if self.meta['inspect_bytes'] != inspect_bytes:
+            return False
+        return not inspect_bytes or self.meta['rules_version'] == rules.version
+
+    def classify_columns(self, rules):
+        """Columns classify() needs."""
+        if self.meta['rules_version'] == rules.version:
+            return ['protocol_id']
+        return ['sport', 'dport', 'layer']
+
+    def classify(self, columns, rules):
+        """Protocol ids under `rules` of a batch read with classify_columns()."""
+        if self.meta['rules_version'] == rules.version:
+            return columns['protocol_id']
+        layer_ranks = np.array([rules.layer_rank(name) for name in self.layers], dtype=np.uint16)
+        return rules.classify(columns['sport'], columns['dport'], layer_ranks[columns['layer']])
+
+    def read(self, names):
+        """Whole columns as numpy arrays, memory-mapped for .npy tables."""
+        if self.format == 'parquet':
+            table = self.file.read(columns=list(names))
+            return {name: self._to_numpy(table.column(name).combine_chunks(), name) for name in names}
+        columns = {}
+        for name in names:
+            if not self.packets:
+                columns[name] = np.empty((0,) + COLUMNS[name].shape, dtype=COLUMNS[name].base)
+            else:
+                columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return columns
+
+    def iter_batches(self, names, batch_size=TABLE_BATCH):
+        """Yields dicts of the columns `names`, batch_size rows at a time."""
+        if self.format == 'parquet':
+            for batch in self.file.iter_batches(batch_size=batch_size, columns=list(names)):
+                yield {name: self._to_numpy(batch.column(name), name) for name in names}
+            return
+        columns = self.read(names)
+        for start in range(0, self.packets, batch_size):
+            yield {name: column[start:start + batch_size] for name, column in columns.items()}
+
+    @staticmethod
+    def _to_numpy(values, name):
+        if name in ADDRESS_COLUMNS:
+            data = np.frombuffer(values.buffers()[1], dtype=np.uint8)
+            return data[values.offset * 16:(values.offset + len(values)) * 16].reshape(-1, 16)
+        return values.to_numpy(zero_copy_only=False)
@@ -0,0 +1,571 @@
+import bz2
+import gzip
+import io
+import lzma
+import mmap
+import os
+import struct
+from array import array
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    # zstd captures are optional, the other compressions are in the standard library
+    zstandard = None
+
+# Classic pcap magic numbers (microsecond and nanosecond timestamps)
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAP_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+# pcapng block types
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_KNOWN_BLOCKS = frozenset((
+    PCAPNG_SHB, PCAPNG_IDB, PCAPNG_PB, PCAPNG_SPB, 0x00000004, 0x00000005, PCAPNG_EPB,
+    0x00000007, 0x00000008, 0x00000009, 0x0000000A, 0x00000BAD, 0x40000BAD,
+))
+
+# Largest record we accept while looking for a record boundary
+MAX_RECORD_LEN = 262144
+# Consecutive valid headers needed to accept a record boundary
+RESYNC_CHAIN = 8
+# Largest timestamp jump (seconds) between two records of a valid chain
+RESYNC_MAX_GAP = 3600
+
+# Magic bytes of the compressed captures read by StreamedCapture
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+)
+# Decompressed bytes read at a time from a compressed capture
+STREAM_CHUNK = 1024 * 1024
+# A StreamedCapture header table stops growing past this many buffered bytes
+STREAM_BUFFER_BYTES = 16 * 1024 * 1024
+
+# One row per record, see MappedCapture.header_table()
+RECORD_HEADER_DTYPE = np.dtype([
+    ('data', '<i8'),      # file offset of the packet bytes
+    ('ts', '<f8'),        # timestamp in seconds
+    ('caplen', '<u4'),    # bytes captured
+    ('wirelen', '<u4'),   # original length on the wire
+    ('linktype', '<u4'),
+])
+
+
+class CaptureFormat:
+    """
+    What is needed to parse records anywhere in a capture: the format,
+    byte order, link type(s) and timestamp resolution. Plain attributes so
+    it can be sent to worker processes.
+    """
+
+    def __init__(self, kind, endian, data_offset, linktype=None, snaplen=0, nano=False, interfaces=None):
+        self.kind = kind  # "pcap" or "pcapng"
+        self.endian = endian
+        # Offset of the first record (pcap) or first non-header block (pcapng)
+        self.data_offset = data_offset
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.nano = nano
+        # pcapng: list of (linktype, snaplen, tsresol), indexed by interface id
+        self.interfaces = interfaces or []
+
+
+def read_format(f):
+    """Parses the capture header of an open file. Raises ValueError for unknown formats."""
+    f.seek(0)
+    head = f.read(PCAP_HEADER_LEN)
+    if len(head) < 12:
+        raise ValueError("Not a supported capture file")
+
+    for endian in ('<', '>'):
+        magic, = struct.unpack(endian + 'I', head[:4])
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            if len(head) < PCAP_HEADER_LEN:
+                raise ValueError("Truncated pcap header")
+            snaplen, linktype = struct.unpack(endian + 'II', head[16:24])
+            return CaptureFormat("pcap", endian, PCAP_HEADER_LEN, linktype=linktype,
+                                 snaplen=snaplen, nano=magic == PCAP_MAGIC_NS)
+
+    if struct.unpack('<I', head[:4])[0] == PCAPNG_SHB:
+        fmt = CaptureFormat("pcapng", '<', 0)
+        _read_section_header(f, 0, fmt)
+        # Interface descriptions normally follow the section header, read them
+        # here so every chunk of the capture knows them.
+        offset = fmt.data_offset
+        while True:
+            block = _read_block_header(f, offset, fmt.endian)
+            if block is None or block[0] != PCAPNG_IDB:
+                break
+            f.seek(offset + 8)
+            _add_interface(fmt, f.read(block[1] - 12))
+            offset += block[1]
+        fmt.data_offset = offset
+        return fmt
+
+    raise ValueError("Not a supported capture file")
+
+
+def _read_section_header(f, offset, fmt):
+    f.seek(offset + 8)
+    byte_order = f.read(4)
+    if len(byte_order) < 4:
+        raise ValueError("Truncated pcapng section header")
+    fmt.endian = '<' if struct.unpack('<I', byte_order)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+    f.seek(offset + 4)
+    block_len, = struct.unpack(fmt.endian + 'I', f.read(4))
+    # A new section starts with no interfaces
+    fmt.interfaces = []
+    fmt.data_offset = offset + block_len
+
+
+def _parse_section_header(buf, offset, fmt):
+    # Same as _read_section_header() for a section header in memory
+    byte_order, = struct.unpack_from('<I', buf, offset + 8)
+    fmt.endian = '<' if byte_order == PCAPNG_BYTE_ORDER_MAGIC else '>'
+    block_len, = struct.unpack_from(fmt.endian + 'I', buf, offset + 4)
+    fmt.interfaces = []
+    fmt.data_offset = offset + block_len
+
+
+def _read_block_header(f, offset, endian):
+    f.seek(offset)
+    head = f.read(8)
+    if len(head) < 8:
+        return None
+    return struct.unpack(endian + 'II', head)
+
+
+def _add_interface(fmt, body):
+    linktype, _, snaplen = struct.unpack(fmt.endian + 'HHI', body[:8])
+    tsresol = 1e-6
+    # Options: (code, length, value padded to 4 bytes), if_tsresol is code 9
+    pos = 8
+    while pos + 4 <= len(body):
+        code, length = struct.unpack(fmt.endian + 'HH', body[pos:pos + 4])
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = body[pos + 4]
+            tsresol = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        pos += 4 + length + (-length % 4)
+    fmt.interfaces.append((linktype, snaplen, tsresol))
+
+
+class MappedCapture:
+    """
+    A capture file (pcap or pcapng) mapped into memory.
+
+    Records are handed out as memoryview slices of the mapping, so packet
+    bytes are never copied, and header fields are read in place with
+    struct.unpack_from. header_table() gathers the record headers of a
+    range into a numpy structured array, so per-packet sizes and
+    timestamps can be processed without any Python object per packet.
+    """
+
+    # Records can be read in any order, see StreamedCapture
+    random_access = True
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.format = read_format(self.file)
+            self.size = os.fstat(self.file.fileno()).st_size
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.file.close()
+            raise
+        self.view = memoryview(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Record slices still held by the caller keep the mapping alive,
+            # it is unmapped once the last of them is garbage collected.
+            pass
+        self.file.close()
+
+    def records(self, start=None, end=None, state=None):
+        """
+        Yields (offset, data, linktype, timestamp, wirelen) for every record
+        starting in [start, end), with data a memoryview slice of the mapping.
+        state works as in _walk().
+        """
+        view = self.view
+        for offset, data_offset, caplen, linktype, timestamp, wirelen in self._walk(start, end, state):
+            yield offset, view[data_offset:data_offset + caplen], linktype, timestamp, wirelen
+
+    def header_table(self, start=None, end=None, state=None, limit=None):
+        """
+        Returns a RECORD_HEADER_DTYPE array with one row per record starting
+        in [start, end), at most limit rows. state works as in _walk(),
+        so the next call can continue from state["stop"].
+
+        For pcap only the caplen field is read in Python (it is needed to find
+        the next record), the headers themselves are gathered by numpy.
+        """
+        fmt = self.format
+        if fmt.kind != "pcap":
+            return self._pcapng_header_table(start, end, state, limit)
+
+        if start is None:
+            start = fmt.data_offset
+        if end is None:
+            end = float('inf')
+        if state is None:
+            state = {}
+        state["section_change"] = False
+
+        mm = self.map
+        size = self.size
+        caplen_at = struct.Struct(fmt.endian + 'I').unpack_from
+        offsets = array('q')
+        offset = start
+        while offset < end and len(offsets) != limit and offset + PCAP_RECORD_HEADER_LEN <= size:
+            caplen, = caplen_at(mm, offset + 8)
+            if offset + PCAP_RECORD_HEADER_LEN + caplen > size:
+                break
+            offsets.append(offset)
+            offset += PCAP_RECORD_HEADER_LEN + caplen
+        state["stop"] = offset
+
+        starts = np.frombuffer(offsets, dtype=np.int64)
+        raw = np.frombuffer(mm, dtype=np.uint8)
+        # (n, 16) header bytes read as (n, 4) fields: sec, sub-second, caplen, wirelen
+        fields = raw[starts[:, None] + np.arange(PCAP_RECORD_HEADER_LEN)].view(fmt.endian + 'u4')
+        # The mapping can't be closed while numpy holds a view of it
+        del raw
+
+        table = np.empty(len(starts), dtype=RECORD_HEADER_DTYPE)
+        table['data'] = starts + PCAP_RECORD_HEADER_LEN
+        table['ts'] = fields[:, 0] + fields[:, 1] * (1e-9 if fmt.nano else 1e-6)
+        table['caplen'] = fields[:, 2]
+        table['wirelen'] = fields[:, 3]
+        table['linktype'] = fmt.linktype
+        return table
+
+    def _pcapng_header_table(self, start, end, state, limit):
+        data, ts, caplens, wirelens, linktypes = array('q'), array('d'), array('I'), array('I'), array('I')
+        for _, data_offset, caplen, linktype, timestamp, wirelen in self._walk(start, end, state, limit):
+            data.append(data_offset)
+            ts.append(timestamp)
+            caplens.append(caplen)
+            wirelens.append(wirelen)
+            linktypes.append(linktype)
+
+        table = np.empty(len(data), dtype=RECORD_HEADER_DTYPE)
+        table['data'] = np.frombuffer(data, dtype=np.int64)
+        table['ts'] = np.frombuffer(ts, dtype=np.float64)
+        table['caplen'] = np.frombuffer(caplens, dtype=np.uint32)
+        table['wirelen'] = np.frombuffer(wirelens, dtype=np.uint32)
+        table['linktype'] = np.frombuffer(linktypes, dtype=np.uint32)
+        return table
+
+    def _walk(self, start=None, end=None, state=None, limit=None):
+        """
+        Yields (offset, data_offset, caplen, linktype, timestamp, wirelen) for
+        every record starting in [start, end), stopping after limit records.
+        start must be a record (or block) boundary and defaults to the first record.
+
+        state is an optional dict; when the walk stops, state["stop"] is the
+        offset right after the last record read and state["section_change"]
+        tells whether pcapng section or interface blocks were met on the way.
+        pcapng sections and interfaces met on the way are kept in
+        state["format"], so a walk continued from state["stop"] with the
+        same state keeps parsing with the right interfaces.
+        """
+        return _walk_buffer(self.map, self.size, self.format, start, end, state, limit)
+
+    def find_record_start(self, offset):
+        """
+        Finds the first record (pcap) or block (pcapng) boundary at or after
+        offset by looking for RESYNC_CHAIN headers that chain into each other.
+        Returns the file size if there is none. The caller must check the
+        result against the previous chunk, this is only a heuristic.
+        """
+        for pos in range(offset, self.size):
+            if _chain_is_valid(self.map, pos, self.format):
+                return pos
+        return self.size
+
+
+def detect_compression(path):
+    """Compression of a file from its magic bytes ("gzip", "zstd", "xz", "bz2"), None if not compressed."""
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, name in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_decompressed(path, compression):
+    """Binary file object reading the decompressed bytes of a compressed file."""
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'xz':
+        return lzma.open(path, 'rb')
+    if compression == 'bz2':
+        return bz2.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compressed captures need the zstandard package")
+        # Rotated captures may be several frames appended to each other
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    raise ValueError(f"Unknown compression {compression!r}")
+
+
+def open_capture(path):
+    """
+    MappedCapture of a capture file, or StreamedCapture if it is compressed
+    (gzip, zstd, xz or bz2, detected from the magic bytes).
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        return MappedCapture(path)
+    return StreamedCapture(path, compression)
+
+
+class StreamedCapture:
+    """
+    A compressed capture, decompressed on the fly and read once from start
+    to end, without an uncompressed copy on disk or in memory.
+
+    Offers the sequential part of MappedCapture: header_table() over
+    consecutive ranges (each call starting where the previous one
+    stopped) and records(). Offsets are those of the decompressed capture,
+    except the 'data' offsets of a header table, which point into
+    self.view: it holds the records of the last header table only, at
+    most about STREAM_BUFFER_BYTES of them. Raises ValueError on an
+    unknown capture format or compression.
+    """
+
+    # Records can't be read again, or out of order
+    random_access = False
+
+    def __init__(self, path, compression=None):
+        self.compression = compression or detect_compression(path)
+        self.file = open_decompressed(path, self.compression)
+        try:
+            self.buffer = bytearray()
+            self.eof = False
+            while len(self.buffer) < STREAM_CHUNK and not self.eof:
+                self._fill()
+            self.format = read_format(io.BytesIO(self.buffer))
+        except Exception:
+            self.file.close()
+            raise
+        # Decompressed offset of self.buffer[0], and of the next record to read
+        self.base = 0
+        self.position = self.format.data_offset
+        self.view = memoryview(b'')
+        self.walk_state = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _fill(self):
+        chunk = self.file.read(STREAM_CHUNK)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.eof = True
+
+    def records(self, start=None, end=None, state=None):
+        """Yields (offset, data, linktype, timestamp, wirelen) like MappedCapture.records()."""
+        if state is None:
+            state = {}
+        start = self.format.data_offset if start is None else start
+        while True:
+            table = self.header_table(start, end, state)
+            if not len(table):
+                return
+            view = self.view
+            for data_offset, caplen, linktype, timestamp, wirelen in zip(
+                    table['data'].tolist(), table['caplen'].tolist(), table['linktype'].tolist(),
+                    table['ts'].tolist(), table['wirelen'].tolist()):
+                yield self.base + data_offset, view[data_offset:data_offset + caplen], linktype, timestamp, wirelen
+            start = state["stop"]
+
+    def header_table(self, start=None, end=None, state=None, limit=None):
+        """Same as MappedCapture.header_table(), start being where the previous table stopped."""
+        if start is None:
+            start = self.format.data_offset
+        if start != self.position:
+            raise ValueError("A compressed capture can only be read once, from start to end")
+        if state is None:
+            state = {}
+        # The records of the previous table are dropped. Slices of self.view
+        # may still be held, so the bytes left are moved to a new buffer
+        # rather than the old one resized.
+        self.buffer = self.buffer[start - self.base:]
+        self.base = start
+        stop_at = None if end is None else end - start
+
+        data, ts, caplens, wirelens, linktypes = array('q'), array('d'), array('I'), array('I'), array('I')
+        section_change = False
+        offset = 0
+        while True:
+            for _, data_offset, caplen, linktype, timestamp, wirelen in _walk_buffer(
+                    self.buffer, len(self.buffer), self.format, offset, stop_at, self.walk_state,
+                    None if limit is None else limit - len(data)):
+                data.append(data_offset)
+                ts.append(timestamp)
+                caplens.append(caplen)
+                wirelens.append(wirelen)
+                linktypes.append(linktype)
+            section_change = section_change or self.walk_state["section_change"]
+            offset = self.walk_state["stop"]
+            if (len(data) == limit or self.eof or (stop_at is not None and offset >= stop_at)
+                    or (data and len(self.buffer) >= STREAM_BUFFER_BYTES)):
+                break
+            self._fill()
+
+        state["stop"] = self.position = self.base + offset
+        state["section_change"] = section_change
+        self.view = memoryview(self.buffer)
+        table = np.empty(len(data), dtype=RECORD_HEADER_DTYPE)
+        table['data'] = np.frombuffer(data, dtype=np.int64)
+        table['ts'] = np.frombuffer(ts, dtype=np.float64)
+        table['caplen'] = np.frombuffer(caplens, dtype=np.uint32)
+        table['wirelen'] = np.frombuffer(wirelens, dtype=np.uint32)
+        table['linktype'] = np.frombuffer(linktypes, dtype=np.uint32)
+        return table
+
+
+def _walk_buffer(buf, size, base_format, start=None, end=None, state=None, limit=None):
+    """
+    MappedCapture._walk() over the first `size` bytes of a buffer holding
+    the capture from offset 0 (a mapping, or the bytes of a StreamedCapture).
+    A record cut by the end of the buffer is not yielded, state["stop"] is then its offset.
+    """
+    fmt = base_format
+    if start is None:
+        start = fmt.data_offset
+    if end is None:
+        end = float('inf')
+    if state is None:
+        state = {}
+    state["section_change"] = False
+
+    mm = buf
+    offset = start
+    count = 0
+    if fmt.kind == "pcap":
+        header = struct.Struct(fmt.endian + 'IIII').unpack_from
+        frac = 1e-9 if fmt.nano else 1e-6
+        linktype = fmt.linktype
+        while offset < end and count != limit and offset + PCAP_RECORD_HEADER_LEN <= size:
+            sec, sub, caplen, wirelen = header(mm, offset)
+            data_offset = offset + PCAP_RECORD_HEADER_LEN
+            if data_offset + caplen > size:
+                break
+            yield offset, data_offset, caplen, linktype, sec + sub * frac, wirelen
+            count += 1
+            offset = data_offset + caplen
+        state["stop"] = offset
+        return
+
+    # pcapng works on a copy, since sections met on the way change it
+    fmt = state.get("format")
+    if fmt is None:
+        fmt = CaptureFormat(base_format.kind, base_format.endian, base_format.data_offset,
+                            interfaces=list(base_format.interfaces))
+        state["format"] = fmt
+    while offset < end and count != limit and offset + 8 <= size:
+        block_type, block_len = struct.unpack_from(fmt.endian + 'II', mm, offset)
+        if block_type == PCAPNG_SHB:
+            if offset + 12 > size:
+                break
+            # The byte order may change with the section
+            _parse_section_header(mm, offset, fmt)
+            state["section_change"] = True
+            offset = fmt.data_offset
+            continue
+        if block_len < 12 or offset + block_len > size:
+            break
+
+        record = None
+        if block_type == PCAPNG_EPB:
+            iface, ts_high, ts_low, caplen, wirelen = struct.unpack_from(fmt.endian + 'IIIII', mm, offset + 8)
+            record = (iface, ts_high, ts_low, offset + 28, caplen, wirelen)
+        elif block_type == PCAPNG_SPB and fmt.interfaces:
+            wirelen, = struct.unpack_from(fmt.endian + 'I', mm, offset + 8)
+            snaplen = fmt.interfaces[0][1]
+            caplen = min(wirelen, snaplen) if snaplen else wirelen
+            record = (0, 0, 0, offset + 12, caplen, wirelen)
+        elif block_type == PCAPNG_PB:
+            iface, _, ts_high, ts_low, caplen, wirelen = struct.unpack_from(fmt.endian + 'HHIIII', mm, offset + 8)
+            record = (iface, ts_high, ts_low, offset + 28, caplen, wirelen)
+        elif block_type == PCAPNG_IDB:
+            _add_interface(fmt, mm[offset + 8:offset + block_len - 4])
+            state["section_change"] = True
+
+        if record is not None and record[0] < len(fmt.interfaces):
+            iface, ts_high, ts_low, data_offset, caplen, wirelen = record
+            # Never read past the block
+            caplen = max(0, min(caplen, offset + block_len - data_offset))
+            linktype, _, tsresol = fmt.interfaces[iface]
+            yield offset, data_offset, caplen, linktype, ((ts_high << 32) | ts_low) * tsresol, wirelen
+            count += 1
+        offset += block_len
+    state["stop"] = offset
+
+
+def _chain_is_valid(buf, pos, fmt):
+    endian = fmt.endian
+    size = len(buf)
+    last_sec = None
+    for _ in range(RESYNC_CHAIN):
+        if pos == size:
+            # Reaching the end of the file exactly means every header chained
+            return True
+        if fmt.kind == "pcap":
+            if pos + PCAP_RECORD_HEADER_LEN > size:
+                return False
+            sec, sub, caplen, wirelen = struct.unpack_from(endian + 'IIII', buf, pos)
+            if sub >= (1000000000 if fmt.nano else 1000000):
+                return False
+            # Runs of zero bytes would otherwise chain as empty records
+            if not caplen or caplen > max(fmt.snaplen, MAX_RECORD_LEN) or caplen > wirelen:
+                return False
+            if last_sec is not None and abs(sec - last_sec) > RESYNC_MAX_GAP:
+                return False
+            last_sec = sec
+            pos += PCAP_RECORD_HEADER_LEN + caplen
+        else:
+            if pos + 8 > size:
+                return False
+            block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+            if block_type not in PCAPNG_KNOWN_BLOCKS or block_len < 12 or block_len % 4:
+                return False
+            if pos + block_len > size:
+                return False
+            if struct.unpack_from(endian + 'I', buf, pos + block_len - 4)[0] != block_len:
+                return False
+            pos += block_len
+    return True
@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from .signatures import PATTERN_FIELDS, SignatureMatcher
+
+# The protocol rules are defined in a JSON file (protocol_rules.json next to
+# this module by default):
+# {
+#   "default": {"name": "Other", "class_id": 4},
+#   "rules": [
+#     {"name": "HTTP", "class_id": 0, "ports": [80, "8000-8080"], "priority": 10},
+#     {"name": "ICMP", "class_id": 4, "layer": "ICMP", "priority": 0},
+#     ...
+#   ]
+# }
+# A rule matches when sport or dport is one of its ports (single ports or
+# "low-high" ranges), or when the packet carries its layer. With payload
+# inspection on (see signatures.PayloadInspector), a rule can also match
+# flows by payload: "domains" are matched against the TLS SNI and the HTTP
+# Host, "content_types" against the HTTP Content-Type, as substrings:
+#     {"name": "HLS", "class_id": 1, "content_types": ["mpegurl"], "priority": 5}
+# The matching rule with the lowest priority wins, rules with the same
+# priority are checked in file order. Other keys ("classes", "description")
+# are ignored.
+# Class IDs:
+# 0: Class A (Web browsing)
+# 1: Class B (Streaming)
+# 2: Class C (File Transfer)
+# 3: Class D (Messaging)
+# 4: Class E (System / Other)
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'protocol_rules.json')
+
+# Layers the packet decoders report
+LAYERS = ("ICMP", "STP")
+NUM_CLASSES = 5
+# Seconds between two checks of the rules file for changes
+RELOAD_INTERVAL = 2.0
+
+# Default to System/Other or just unknown
+DEFAULT_PROTOCOL = ("Other", 4)
+
+
+def _parse_ports(name, ports):
+    """Returns the list of (low, high) ranges of a rule's ports."""
+    ranges = []
+    for port in ports:
+        if isinstance(port, str) and '-' in port:
+            low, _, high = port.partition('-')
+            low, high = int(low), int(high)
+        else:
+            low = high = int(port)
+        if not 0 <= low <= high <= 65535:
+            raise ValueError(f"Rule {name}: invalid port {port!r}")
+        ranges.append((low, high))
+    return ranges
+
+
+def _parse_class(name, class_id):
+    if not isinstance(class_id, int) or not 0 <= class_id < NUM_CLASSES:
+        raise ValueError(f"Rule {name}: class_id must be an integer from 0 to {NUM_CLASSES - 1}")
+    return class_id
+
+
+def parse_rules(config):
+    """
+    Validates a rules config (the parsed JSON) and returns (rules, default),
+    rules being (name, class_id, port ranges, layer, patterns) tuples in
+    priority order, patterns mapping "domains"/"content_types" to lists of bytes.
+    Raises ValueError on an invalid config.
+    """
+    if not isinstance(config, dict) or not isinstance(config.get('rules'), list):
+        raise ValueError("The rules config must be an object with a 'rules' list")
+    entries = []
+    payload_names = set()
+    for index, entry in enumerate(config['rules']):
+        if not isinstance(entry, dict) or 'name' not in entry:
+            raise ValueError(f"Rule {index}: every rule needs a name")
+        name = str(entry['name'])
+        layer = entry.get('layer')
+        if layer is not None and layer not in LAYERS:
+            raise ValueError(f"Rule {name}: unknown layer {layer!r}, expected one of {LAYERS}")
+        ports = _parse_ports(name, entry.get('ports', []))
+        patterns = {}
+        for kind in PATTERN_FIELDS:
+            values = entry.get(kind, [])
+            if not isinstance(values, list) or not all(isinstance(value, str) and value for value in values):
+                raise ValueError(f"Rule {name}: {kind} must be a list of non-empty strings")
+            if values:
+                patterns[kind] = [value.lower().encode() for value in values]
+        if patterns:
+            # The name is the layer of the flows it matches, see PortRuleTable
+            if name in LAYERS or name in payload_names:
+                raise ValueError(f"Rule {name}: payload rules need a unique name, not a layer name")
+            payload_names.add(name)
+        if not ports and layer is None and not patterns:
+            raise ValueError(f"Rule {name}: a rule needs ports, a layer or payload patterns")
+        priority = entry.get('priority', 0)
+        if not isinstance(priority, (int, float)):
+            raise ValueError(f"Rule {name}: priority must be a number")
+        entries.append((priority, index, (name, _parse_class(name, entry.get('class_id')), ports, layer, patterns)))
+    # The rank table stores ids as uint16, no_match included
+    if len(entries) >= 65535:
+        raise ValueError("Too many rules")
+
+    default = config.get('default', {})
+    name = str(default.get('name', DEFAULT_PROTOCOL[0]))
+    default = (name, _parse_class(name, default.get('class_id', DEFAULT_PROTOCOL[1])))
+    # Stable on file order for equal priorities
+    entries.sort(key=lambda entry: entry[:2])
+    return [rule for _, _, rule in entries], default
+
+
+def load_rules(path):
+    """Reads and compiles a rules file. Raises OSError or ValueError."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    rules, default = parse_rules(json.loads(data))
+    return PortRuleTable(rules, default, version=hashlib.sha256(data).hexdigest())
+
+
+class PortRuleTable:
+    """
+    The protocol rules compiled into a dense 65536-entry array.
+
+    Every rule's protocol id is its position in the priority order, and
+    the rank of a port is the id of the first rule listing it. The
+    matching rule for a packet is then just
+    min(rank[sport], rank[dport], rank of its layer), which works the same
+    for one packet or for whole numpy arrays of ports, and costs the same
+    whatever the number of rules and ports.
+
+    Rules with payload patterns are compiled into self.signatures (a
+    SignatureMatcher, None without such rules) and their name is their
+    layer: a PayloadInspector gives the packets of a matching flow that
+    layer, so signatures go through the same priority lookup.
+
+    A table is never modified once built, reloading the rules builds a new
+    one (see RuleSet). version identifies the rules it was built from.
+    """
+
+    def __init__(self, rules, default=DEFAULT_PROTOCOL, version=None):
+        self.version = version
+        self.protocols = [(name, class_id) for name, class_id, _, _, _ in rules] + [default]
+        self.names = [name for name, _ in self.protocols]
+        self.class_ids = np.array([class_id for _, class_id in self.protocols], dtype=np.uint8)
+        # Protocol id used when no rule matches
+        self.no_match = len(rules)
+
+        self.rank = np.full(65536, self.no_match, dtype=np.uint16)
+        self.layer_ranks = {}
+        # rule id -> {"domains"/"content_types": [bytes]} of the payload rules
+        self.payload_patterns = {}
+        patterns = []
+        # Walk in reverse so the highest priority rule for a port is written last
+        for rule_id in range(len(rules) - 1, -1, -1):
+            name, _, ports, layer, rule_patterns = rules[rule_id]
+            for low, high in ports:
+                self.rank[low:high + 1] = rule_id
+            if layer is not None:
+                self.layer_ranks[layer] = rule_id
+            if rule_patterns:
+                self.layer_ranks[name] = rule_id
+                self.payload_patterns[rule_id] = rule_patterns
+                for kind, values in rule_patterns.items():
+                    patterns.extend((value, PATTERN_FIELDS[kind], rule_id) for value in values)
+        self.signatures = SignatureMatcher(patterns) if patterns else None
+
+        # Plain list for the per-packet path, numpy scalar indexing is slower
+        self._rank = self.rank.tolist()
+
+    def __getstate__(self):
+        # Sent to the worker processes, the list is rebuilt there
+        state = self.__dict__.copy()
+        del state['_rank']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rank = self.rank.tolist()
+
+    def layer_rank(self, layer):
+        """Rank of a layer name ("ICMP", "STP", a payload rule), no_match if no rule uses it."""
+        if layer is None:
+            return self.no_match
+        return self.layer_ranks.get(layer, self.no_match)
+
+    def lookup_id(self, sport, dport, layer=None):
+        """Protocol id of a single packet."""
+        rank = self._rank
+        protocol_id = min(rank[sport], rank[dport])
+        if layer is not None:
+            protocol_id = min(protocol_id, self.layer_ranks.get(layer, self.no_match))
+        return protocol_id
+
+    def lookup(self, sport, dport, layer=None):
+        """Returns (ProtocolName, ClassID) of a single packet."""
+        return self.protocols[self.lookup_id(sport, dport, layer)]
+
+    def classify(self, sports, dports, layer_ranks=None):
+        """
+        Vectorized lookup over arrays of ports.
+        layer_ranks holds layer_rank() of every packet (or None if no packet has a layer).
+        Returns the array of protocol ids; self.class_ids[ids] gives the classes.
+        """
+        protocol_ids = np.minimum(self.rank[sports], self.rank[dports])
+        if layer_ranks is not None:
+            np.minimum(protocol_ids, layer_ranks, out=protocol_ids)
+        return protocol_ids
+
+    def count(self, protocol_ids):
+        """Number of packets per protocol id."""
+        return np.bincount(protocol_ids, minlength=len(self.protocols))
+
+    def summarize(self, protocol_counts):
+        """
+        Turns per-protocol-id counts into the protocol_counts and
+        class_counts dicts returned with the features.
+        """
+        protocol_stats = {}
+        count_map = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
+        for protocol_id, count in enumerate(protocol_counts):
+            if count:
+                name = self.names[protocol_id]
+                # Several rules may share a protocol name
+                protocol_stats[name] = protocol_stats.get(name, 0) + int(count)
+                count_map[int(self.class_ids[protocol_id])] += int(count)
+        return protocol_stats, count_map
+
+
+class RuleSet:
+    """
+    The compiled rules of a rules file, recompiled when the file changes.
+
+    get() checks the file's mtime and size at most every `interval`
+    seconds and swaps in a new PortRuleTable when they changed, so the
+    rules can be edited without restarting the server. A file that fails
+    to load keeps the previous table (the first load raises instead).
+    Callers hold on to the table they got for a whole pass over a capture,
+    so a reload never mixes two rule sets in one result.
+    """
+
+    def __init__(self, path, interval=RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stamp = self._stamp()
+        self.table = load_rules(path)
+        self.checked = time.monotonic()
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self):
+        """Returns the current PortRuleTable, reloading it if the file changed."""
+        if time.monotonic() - self.checked >= self.interval:
+            self.reload()
+        return self.table
+
+    def reload(self, force=False):
+        """Recompiles the rules if the file changed (always with force). Returns True if it did."""
+        with self.lock:
+            self.checked = time.monotonic()
+            try:
+                stamp = self._stamp()
+                if stamp == self.stamp and not force:
+                    return False
+                table = load_rules(self.path)
+            except (OSError, ValueError) as e:
+                print(f"Error reloading protocol rules from {self.path}: {e}")
+                return False
+            self.stamp = stamp
+            # Only the reference is swapped, readers see the old or the new table
+            self.table = table
+            return True
+
+
+_rule_set = None
+
+
+def configure_rules(path=DEFAULT_RULES_FILE, interval=RELOAD_INTERVAL):
+    """Loads the rules file used by get_rules(), called once at startup."""
+    global _rule_set
+    _rule_set = RuleSet(path, interval)
+    return _rule_set.table
+
+
+def get_rules():
+    """Current PortRuleTable, from the default rules file if configure_rules() wasn't called."""
+    if _rule_set is None:
+        configure_rules()
+    return _rule_set.get()
+
+
+def reload_rules():
+    """Recompiles the rules file now. Returns True if it loaded."""
+    if _rule_set is None:
+        configure_rules()
+        return True
+    return _rule_set.reload(force=True)
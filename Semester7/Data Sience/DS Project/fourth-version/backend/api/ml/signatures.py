@@ -0,0 +1,254 @@
+from array import array
+from collections import OrderedDict, deque
+
+from .flows import DEFAULT_MAX_FLOWS
+from .packet_decoder import payload_bounds
+
+# Payload bytes inspected per flow (both directions) when inspection is on
+DEFAULT_INSPECT_BYTES = 1024
+
+# Fields the signatures are matched against, in the order of SignatureMatcher.match()
+FIELDS = ("sni", "host", "content_type")
+# What each kind of pattern of a rule is matched against
+PATTERN_FIELDS = {
+    'domains': ("sni", "host"),
+    'content_types': ("content_type",),
+}
+
+HTTP_METHODS = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ', b'PATCH ', b'CONNECT ')
+TLS_HANDSHAKE = 0x16
+# First payload bytes that can start a TLS handshake or an HTTP head,
+# anything else is skipped without looking further
+FIELD_START_BYTES = frozenset([TLS_HANDSHAKE] + [start[0] for start in HTTP_METHODS + (b'HTTP/',)])
+TLS_CLIENT_HELLO = 1
+TLS_EXT_SERVER_NAME = 0
+
+
+class SignatureMatcher:
+    """
+    Aho-Corasick automaton over the payload patterns of the protocol rules,
+    compiled into a DFA: one array lookup per input byte, whatever the
+    number of patterns, and no failure links to follow while matching.
+
+    Bytes are mapped to classes (one per byte value used by the patterns,
+    case folded, plus one for everything else) so the transition table is
+    states * classes entries rather than states * 256. Every state knows,
+    per field, the best (lowest) rank among the patterns ending there, so
+    a match costs nothing more than the walk.
+    """
+
+    def __init__(self, patterns):
+        # patterns: [(pattern bytes, field names, rank)]
+        self.size = len(patterns)
+        self.classes = bytearray(256)
+        alphabet = sorted({byte for pattern, _, _ in patterns for byte in pattern.lower()})
+        for index, byte in enumerate(alphabet, 1):
+            self.classes[byte] = index
+            self.classes[bytes([byte]).upper()[0]] = index
+        n_classes = len(alphabet) + 1
+        self.n_classes = n_classes
+
+        # Trie
+        goto = [{}]
+        outputs = [None]
+        for pattern, fields, rank in patterns:
+            state = 0
+            for byte in pattern.lower():
+                cls = self.classes[byte]
+                if cls not in goto[state]:
+                    goto.append({})
+                    outputs.append(None)
+                    goto[state][cls] = len(goto) - 1
+                state = goto[state][cls]
+            outputs[state] = _best_ranks(outputs[state], fields, rank)
+
+        # Breadth-first: failure links, inherited outputs and the full transition table
+        delta = array('i', bytes(4 * len(goto) * n_classes))
+        fail = [0] * len(goto)
+        queue = deque()
+        for cls, child in goto[0].items():
+            delta[cls] = child
+            queue.append(child)
+        while queue:
+            state = queue.popleft()
+            if outputs[fail[state]] is not None:
+                outputs[state] = _merge_ranks(outputs[state], outputs[fail[state]])
+            base = state * n_classes
+            fail_base = fail[state] * n_classes
+            for cls in range(n_classes):
+                child = goto[state].get(cls)
+                if child is None:
+                    delta[base + cls] = delta[fail_base + cls]
+                else:
+                    fail[child] = delta[fail_base + cls]
+                    delta[base + cls] = child
+                    queue.append(child)
+        self.delta = delta
+        self.outputs = outputs
+
+    def match(self, values):
+        """
+        Best (lowest) rank of the patterns found in values, a tuple of
+        bytes (or None) in FIELDS order, None if nothing matches.
+        """
+        delta, classes, outputs, n_classes = self.delta, self.classes, self.outputs, self.n_classes
+        best = None
+        for field, value in enumerate(values):
+            if not value:
+                continue
+            state = 0
+            for byte in value:
+                state = delta[state * n_classes + classes[byte]]
+                found = outputs[state]
+                if found is not None and found[field] is not None:
+                    if best is None or found[field] < best:
+                        best = found[field]
+        return best
+
+
+def _best_ranks(ranks, fields, rank):
+    ranks = list(ranks) if ranks is not None else [None] * len(FIELDS)
+    for field in fields:
+        index = FIELDS.index(field)
+        if ranks[index] is None or rank < ranks[index]:
+            ranks[index] = rank
+    return tuple(ranks)
+
+
+def _merge_ranks(ranks, inherited):
+    if ranks is None:
+        return inherited
+    return tuple(a if b is None or (a is not None and a <= b) else b for a, b in zip(ranks, inherited))
+
+
+def tls_server_name(payload):
+    """Server name of a TLS ClientHello record, None if absent or cut short."""
+    if len(payload) < 43 or payload[0] != TLS_HANDSHAKE or payload[1] != 3 or payload[5] != TLS_CLIENT_HELLO:
+        return None
+    # Record header (5), handshake header (4), version (2), random (32)
+    pos = 43
+    try:
+        pos += 1 + payload[pos]  # session id
+        pos += 2 + (payload[pos] << 8 | payload[pos + 1])  # cipher suites
+        pos += 1 + payload[pos]  # compression methods
+        end = min(len(payload), pos + 2 + (payload[pos] << 8 | payload[pos + 1]))
+        pos += 2
+        while pos + 4 <= end:
+            ext_type = payload[pos] << 8 | payload[pos + 1]
+            ext_len = payload[pos + 2] << 8 | payload[pos + 3]
+            pos += 4
+            if ext_type == TLS_EXT_SERVER_NAME:
+                # List length (2), name type (1), name length (2), name
+                name_len = payload[pos + 3] << 8 | payload[pos + 4]
+                name = payload[pos + 5:pos + 5 + name_len]
+                return name if len(name) == name_len and payload[pos + 2] == 0 else None
+            pos += ext_len
+    except IndexError:
+        pass
+    return None
+
+
+def http_headers(payload):
+    """(Host, Content-Type) of an HTTP request or response head, None for missing ones."""
+    if not (payload.startswith(HTTP_METHODS) or payload.startswith(b'HTTP/1.')):
+        return None, None
+    head = payload.split(b'\r\n\r\n', 1)[0].lower()
+    return _header(head, b'\r\nhost:'), _header(head, b'\r\ncontent-type:')
+
+
+def _header(head, name):
+    start = head.find(name)
+    if start < 0:
+        return None
+    start += len(name)
+    end = head.find(b'\r\n', start)
+    return head[start:end if end >= 0 else len(head)].strip()
+
+
+def payload_fields(payload):
+    """
+    The FIELDS values (TLS SNI, HTTP Host, HTTP Content-Type) found in a
+    payload, None if there are none.
+    """
+    if payload[0] == TLS_HANDSHAKE:
+        server_name = tls_server_name(payload)
+        return (server_name, None, None) if server_name else None
+    host, content_type = http_headers(payload)
+    return (None, host, content_type) if host or content_type else None
+
+
+class PayloadInspector:
+    """
+    Per-flow payload inspection for the payload signatures of a PortRuleTable.
+
+    Only the first max_bytes of payload of every flow (both directions) are
+    looked at, so the extra cost per packet is bounded: once a flow has
+    matched, or used up its budget, its packets cost one dict lookup.
+    Packets of a flow that matched get the matching rule's name as their
+    layer (see PortRuleTable.layer_ranks), so the usual priority lookup
+    decides between the signature and the ports. Packets seen before the
+    match keep their port classification. Flow state is capped at max_flows,
+    the least recently seen flow is forgotten first.
+    """
+
+    def __init__(self, rules, max_bytes=DEFAULT_INSPECT_BYTES, max_flows=DEFAULT_MAX_FLOWS):
+        self.matcher = rules.signatures
+        self.names = rules.names
+        self.max_bytes = max_bytes
+        self.max_flows = max_flows
+        # flow key -> [payload bytes inspected, layer or None]
+        self.flows = OrderedDict()
+        self.inspected_packets = 0
+
+    def inspect_record(self, data, linktype, sport, dport, proto, src, dst):
+        """Layer of a raw record given its decoded flow, None if no signature matched."""
+        state = self._state(sport, dport, proto, src, dst)
+        inspected = state[0]
+        if inspected >= self.max_bytes or state[1] is not None:
+            return state[1]
+        bounds = payload_bounds(data, linktype)
+        if bounds is None:
+            return None
+        start, end = bounds
+        if start >= end:
+            return None
+        if end - start > self.max_bytes - inspected:
+            end = start + self.max_bytes - inspected
+        if data[start] not in FIELD_START_BYTES:
+            state[0] = inspected + end - start
+            return None
+        return self._inspect(state, bytes(data[start:end]))
+
+    def inspect_payload(self, payload, sport, dport, proto, src, dst):
+        """Same as inspect_record() given the payload bytes (e.g. from a scapy packet)."""
+        state = self._state(sport, dport, proto, src, dst)
+        if state[1] is not None or state[0] >= self.max_bytes or not payload:
+            return state[1]
+        payload = payload[:self.max_bytes - state[0]]
+        if payload[0] not in FIELD_START_BYTES:
+            state[0] += len(payload)
+            return None
+        return self._inspect(state, payload)
+
+    def _state(self, sport, dport, proto, src, dst):
+        flows = self.flows
+        # Same key as flows.flow_key(), inlined on this per-packet path
+        key = (src, dst, sport, dport, proto) if (src, sport) <= (dst, dport) else (dst, src, dport, sport, proto)
+        state = flows.get(key)
+        if state is None:
+            if len(flows) >= self.max_flows:
+                flows.popitem(last=False)
+            state = flows[key] = [0, None]
+        else:
+            flows.move_to_end(key)
+        return state
+
+    def _inspect(self, state, payload):
+        state[0] += len(payload)
+        self.inspected_packets += 1
+        fields = payload_fields(payload)
+        if fields is not None:
+            rank = self.matcher.match(fields)
+            if rank is not None:
+                state[1] = self.names[rank]
+        return state[1]
@@ -0,0 +1,244 @@
+import hashlib
+import math
+import socket
+from array import array
+
+import numpy as np
+
+from .flows import format_address
+
+# Count-Min size: an estimate exceeds the true count by more than
+# e / WIDTH of the total with probability at most e^-DEPTH
+DEFAULT_WIDTH = 1 << 14
+DEFAULT_DEPTH = 4
+# Candidate keys kept per top-k summary, more than are reported so that
+# keys close to the cut don't fall out too easily
+DEFAULT_CAPACITY = 64
+DEFAULT_TOP = 10
+# Packets buffered before the sketches are updated in one vectorized step
+FLUSH_SIZE = 65536
+
+# Fixed so that sketches built in different processes can be merged
+SKETCH_SEED = 0x5EED
+# IPv4 keys are the addresses as integers. IPv6 addresses are hashed to
+# 63 bits and tagged, so they never collide with IPv4 keys.
+IPV4_KEYS = 1 << 32
+IPV6_TAG = 1 << 63
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch over uint64 keys with multiply-shift hashing.
+    Estimates never undercount. Memory is depth * width int64 counters
+    whatever the number of distinct keys.
+    """
+
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, seed=SKETCH_SEED):
+        if width & (width - 1):
+            raise ValueError("width must be a power of two")
+        self.width = width
+        self.depth = depth
+        rng = np.random.default_rng(seed)
+        # One random odd multiplier per row, the top bits of key * multiplier are the column
+        self.multipliers = rng.integers(0, 2 ** 64, size=depth, dtype=np.uint64) | np.uint64(1)
+        self.shift = np.uint64(64 - (width.bit_length() - 1))
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, keys):
+        return (keys[None, :] * self.multipliers[:, None]) >> self.shift
+
+    def add(self, keys, counts):
+        """Adds counts (int array) to distinct keys (uint64 array)."""
+        columns = self._columns(keys)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(columns[row], weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(counts.sum())
+
+    def estimate(self, keys):
+        columns = self._columns(keys)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def merge(self, other):
+        self.table += other.table
+        self.total += other.total
+        return self
+
+    @property
+    def error_bound(self):
+        """Largest overestimate of any count, with probability 1 - e^-depth."""
+        return math.e / self.width * self.total
+
+
+class HeavyHitters:
+    """
+    Top-k keys of a stream in fixed memory: a CountMinSketch plus a
+    SpaceSaving-style summary of `capacity` candidate keys.
+
+    As in SpaceSaving, the candidate with the smallest counter is the one
+    replaced when a new key comes in, but here a new key only gets in if
+    its sketch estimate beats that counter, and counters are the sketch
+    estimates. That lets a whole batch be ranked at once in numpy, and
+    a reported count is at most error_bound above the true one.
+    """
+
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, capacity=DEFAULT_CAPACITY):
+        self.sketch = CountMinSketch(width, depth)
+        self.capacity = capacity
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        # key -> display label, only for the candidates
+        self.labels = {}
+
+    def add(self, keys, label=None):
+        """
+        Counts one occurrence per entry of keys (uint64 array). label(index)
+        returns the display label of keys[index], it is only called for keys
+        that become candidates.
+        """
+        if not len(keys):
+            return
+        unique, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        self.sketch.add(unique, counts)
+        new = ~np.isin(unique, self.keys)
+        self._rank(np.concatenate([self.keys, unique[new]]))
+        if label is not None:
+            index = dict(zip(unique[new].tolist(), first[new].tolist()))
+            for key in self.keys.tolist():
+                if key not in self.labels and key in index:
+                    self.labels[key] = label(index[key])
+
+    def _rank(self, candidates):
+        estimates = self.sketch.estimate(candidates)
+        if len(candidates) > self.capacity:
+            keep = np.argpartition(-estimates, self.capacity - 1)[:self.capacity]
+            candidates, estimates = candidates[keep], estimates[keep]
+        self.keys, self.counts = candidates, estimates
+        kept = set(candidates.tolist())
+        self.labels = {key: value for key, value in self.labels.items() if key in kept}
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        labels = dict(other.labels)
+        labels.update(self.labels)
+        self.labels = labels
+        self._rank(np.union1d(self.keys, other.keys))
+        return self
+
+    def top(self, n=DEFAULT_TOP):
+        """[(label, count)] of the n heaviest keys, heaviest first."""
+        order = np.argsort(-self.counts, kind='stable')[:n]
+        keys = self.keys[order].tolist()
+        return [(self.labels.get(key, key), int(count)) for key, count in zip(keys, self.counts[order].tolist())]
+
+
+def address_key(address):
+    """uint64 key of a packed IPv4/IPv6 address."""
+    if len(address) == 4:
+        return int.from_bytes(address, 'big')
+    return IPV6_TAG | (int.from_bytes(hashlib.blake2b(address, digest_size=8).digest(), 'big') >> 1)
+
+
+def _conversation_keys(a, b):
+    # Direction-independent: the pair is ordered before mixing
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    return lo * np.uint64(0x9E3779B97F4A7C15) ^ (hi + np.uint64(0x632BE59BD9B4E019))
+
+
+class TalkerSketch:
+    """
+    Top hosts, ports and conversations of a capture in fixed memory, one
+    HeavyHitters each (about 1.5 MB with the default sizes, however many
+    distinct keys the capture has).
+
+    A packet counts once for each of its two hosts and two ports and once
+    for its conversation (host pair, either direction). Non-IP packets only
+    count for their ports, if any. Packets are buffered and the sketches
+    updated FLUSH_SIZE packets at a time.
+    """
+
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, capacity=DEFAULT_CAPACITY):
+        self.hosts = HeavyHitters(width, depth, capacity)
+        self.ports = HeavyHitters(width, depth, capacity)
+        self.conversations = HeavyHitters(width, depth, capacity)
+        self._src, self._dst, self._ports = array('Q'), array('Q'), array('Q')
+        # IPv6 addresses of the buffered packets, to label the keys that make
+        # it to the top (IPv4 keys are the addresses themselves)
+        self._ipv6 = {}
+
+    def add(self, src, dst, sport, dport):
+        """Adds one packet, src/dst being packed addresses (b'' if not IP)."""
+        if len(src) == 4:
+            self._src.append(int.from_bytes(src, 'big'))
+            self._dst.append(int.from_bytes(dst, 'big'))
+        elif src:
+            src_key = address_key(src)
+            dst_key = address_key(dst)
+            self._src.append(src_key)
+            self._dst.append(dst_key)
+            self._ipv6[src_key] = src
+            self._ipv6[dst_key] = dst
+        if sport:
+            self._ports.append(sport)
+        if dport:
+            self._ports.append(dport)
+        if len(self._ports) >= FLUSH_SIZE or len(self._src) >= FLUSH_SIZE:
+            self.flush()
+
+    def add_keys(self, src, dst, ports, ipv6):
+        """
+        Adds a batch of packets already turned into keys (see address_key()):
+        uint64 arrays of the src and dst keys of the IP packets and of their
+        non-zero ports, and the {IPv6 key: packed address} of the batch.
+        """
+        self._src.frombytes(np.asarray(src, dtype=np.uint64).tobytes())
+        self._dst.frombytes(np.asarray(dst, dtype=np.uint64).tobytes())
+        self._ports.frombytes(np.asarray(ports, dtype=np.uint64).tobytes())
+        self._ipv6.update(ipv6)
+        if len(self._ports) >= FLUSH_SIZE or len(self._src) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        src = np.frombuffer(self._src, dtype=np.uint64).copy()
+        dst = np.frombuffer(self._dst, dtype=np.uint64).copy()
+        ports = np.frombuffer(self._ports, dtype=np.uint64).copy()
+        ipv6 = self._ipv6
+        hosts = np.concatenate([src, dst])
+
+        def address_label(key):
+            if key < IPV4_KEYS:
+                return socket.inet_ntoa(key.to_bytes(4, 'big'))
+            return format_address(ipv6[key])
+
+        def conversation_label(i):
+            pair = sorted((address_label(int(src[i])), address_label(int(dst[i]))))
+            return f"{pair[0]} <-> {pair[1]}"
+
+        self.hosts.add(hosts, lambda i: address_label(int(hosts[i])))
+        self.ports.add(ports, lambda i: int(ports[i]))
+        self.conversations.add(_conversation_keys(src, dst), conversation_label)
+
+        del self._src[:], self._dst[:], self._ports[:]
+        self._ipv6 = {}
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.hosts.merge(other.hosts)
+        self.ports.merge(other.ports)
+        self.conversations.merge(other.conversations)
+        return self
+
+    def report(self, n=DEFAULT_TOP):
+        """Top n of each kind, with the largest possible overcount of each list."""
+        self.flush()
+        return {
+            'hosts': [{'address': label, 'packets': count} for label, count in self.hosts.top(n)],
+            'ports': [{'port': label, 'packets': count} for label, count in self.ports.top(n)],
+            'conversations': [{'hosts': label, 'packets': count} for label, count in self.conversations.top(n)],
+            'error_bound': {
+                'hosts': self.hosts.sketch.error_bound,
+                'ports': self.ports.sketch.error_bound,
+                'conversations': self.conversations.sketch.error_bound,
+            },
+        }
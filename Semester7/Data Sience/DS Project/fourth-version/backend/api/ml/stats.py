@@ -0,0 +1,122 @@
+import math
+from statistics import NormalDist
+
+import numpy as np
+
+
+def normal_quantile(confidence):
+    """z such that [-z, z] holds `confidence` of a standard normal (1.96 for 0.95)."""
+    return NormalDist().inv_cdf(0.5 + confidence / 2)
+
+
+def finite_population_factor(n, population):
+    """
+    Shrinks the standard error of a sample of n out of `population` items
+    without replacement: 0 when everything was sampled, ~1 for small samples.
+    """
+    if population is None or population <= 1:
+        return 1.0
+    return math.sqrt(max(0.0, (population - n) / (population - 1)))
+
+
+def proportion_interval(successes, n, z, population=None):
+    """
+    Wilson score interval of a proportion estimated from a sample of n.
+    The finite population correction is applied through the effective
+    sample size, so the interval closes on the estimate as n nears population.
+    """
+    if not n:
+        return (0.0, 1.0)
+    p = successes / n
+    fpc = finite_population_factor(n, population)
+    if fpc == 0:
+        return (p, p)
+    n_eff = n / (fpc * fpc)
+    z2 = z * z
+    center = (p + z2 / (2 * n_eff)) / (1 + z2 / n_eff)
+    half = z * math.sqrt(p * (1 - p) / n_eff + z2 / (4 * n_eff * n_eff)) / (1 + z2 / n_eff)
+    return (max(0.0, center - half), min(1.0, center + half))
+
+
+class RunningStats:
+    """
+    Count, mean, std, min and max of a stream of packet sizes in O(1) memory.
+
+    Sizes are integers, so instead of Welford's floating point update the
+    running sum and sum of squares are kept as exact Python ints. That is
+    the same single pass, but without rounding error, and two partial
+    results merge exactly (needed when a capture is split across workers).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        self.min = None
+        self.max = None
+
+    def push(self, size):
+        """Adds a single size."""
+        self.count += 1
+        self.total += size
+        self.total_sq += size * size
+        if self.min is None or size < self.min:
+            self.min = size
+        if self.max is None or size > self.max:
+            self.max = size
+
+    def push_many(self, sizes):
+        """Adds a numpy array (or buffer) of sizes."""
+        sizes = np.asarray(sizes, dtype=np.int64)
+        if not sizes.size:
+            return
+        self.count += int(sizes.size)
+        self.total += int(sizes.sum())
+        self.total_sq += int(np.dot(sizes, sizes))
+        batch_min, batch_max = int(sizes.min()), int(sizes.max())
+        self.min = batch_min if self.min is None else min(self.min, batch_min)
+        self.max = batch_max if self.max is None else max(self.max, batch_max)
+
+    def merge(self, other):
+        """Adds the sizes seen by another RunningStats."""
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    @property
+    def variance(self):
+        """Population variance (ddof=0, like np.var)."""
+        if not self.count:
+            return 0
+        return (self.count * self.total_sq - self.total * self.total) / (self.count * self.count)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance) if self.count else 0
+
+    def mean_interval(self, z, population=None):
+        """Normal approximation interval of the population mean, from this sample."""
+        if self.count < 2:
+            return (self.mean, self.mean)
+        half = z * self.std / math.sqrt(self.count - 1) * finite_population_factor(self.count, population)
+        return (self.mean - half, self.mean + half)
+
+    def std_interval(self, z, population=None):
+        """
+        Large sample interval of the population standard deviation, using
+        the standard error std / sqrt(2 (n - 1)).
+        """
+        if self.count < 2:
+            return (self.std, self.std)
+        half = z * self.std / math.sqrt(2 * (self.count - 1)) * finite_population_factor(self.count, population)
+        return (max(0.0, self.std - half), self.std + half)
@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+
+from django.db import models
+
+
+class TrafficWindow(models.Model):
+    """One time window of analysed traffic, with its features and the models' verdict."""
+    # Where the window comes from: SHA-256 of an uploaded capture, or
+    # "live:<interface>" / "replay:<file>" for the ingest command
+    source = models.CharField(max_length=64, db_index=True)
+    start_time = models.DateTimeField(db_index=True)
+    end_time = models.DateTimeField()
+    packet_count = models.IntegerField()
+    byte_count = models.BigIntegerField()
+    # Null for windows recorded before they were kept
+    std_packet_size = models.FloatField(null=True)
+    min_packet_size = models.IntegerField(null=True)
+    max_packet_size = models.IntegerField(null=True)
+
+    # Packets per class
+    class_a = models.IntegerField(default=0)
+    class_b = models.IntegerField(default=0)
+    class_c = models.IntegerField(default=0)
+    class_d = models.IntegerField(default=0)
+    class_e = models.IntegerField(default=0)
+
+    # Null when the model timed out or failed (degraded prediction)
+    cnn_class = models.IntegerField(null=True)
+    xgboost_class = models.IntegerField(null=True)
+    is_anomaly = models.BooleanField(default=False)
+    anomaly_score = models.FloatField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['start_time']
+
+    @classmethod
+    def from_features(cls, source, features, predictions):
+        """Builds (without saving) the row of a window features dict and its PacketClassifier.predict() result."""
+        class_counts = features['class_counts']
+        return cls(
+            source=source,
+            start_time=datetime.fromtimestamp(features['window_start'], tz=timezone.utc),
+            end_time=datetime.fromtimestamp(features['window_end'], tz=timezone.utc),
+            packet_count=features['packet_count'],
+            byte_count=features['byte_count'],
+            std_packet_size=features['std_packet_size'],
+            min_packet_size=features['min_packet_size'],
+            max_packet_size=features['max_packet_size'],
+            class_a=class_counts[0],
+            class_b=class_counts[1],
+            class_c=class_counts[2],
+            class_d=class_counts[3],
+            class_e=class_counts[4],
+            cnn_class=predictions['cnn']['class'],
+            xgboost_class=predictions['xgboost']['class'],
+            is_anomaly=bool(predictions['isolation_forest']['is_anomaly']),
+            anomaly_score=predictions['isolation_forest']['score'],
+        )
+
+    @classmethod
+    def recent_features(cls, count):
+        """
+        Model features dicts (see api.ml.models.FEATURE_NAMES) of the
+        latest `count` recorded windows, oldest first.
+        """
+        windows = cls.objects.exclude(std_packet_size=None).order_by('-id')[:count]
+        return [window.model_features() for window in reversed(windows)]
+
+    def model_features(self):
+        """The model features of the window, as computed when it was recorded."""
+        counts = [self.class_a, self.class_b, self.class_c, self.class_d, self.class_e]
+        return {
+            'avg_packet_size': self.byte_count / self.packet_count,
+            'std_packet_size': self.std_packet_size,
+            'min_packet_size': self.min_packet_size,
+            'max_packet_size': self.max_packet_size,
+            'packet_count': self.packet_count,
+            'ratio_A': counts[0] / self.packet_count,
+            'ratio_B': counts[1] / self.packet_count,
+            'ratio_C': counts[2] / self.packet_count,
+            'ratio_D': counts[3] / self.packet_count,
+            'ratio_E': counts[4] / self.packet_count,
+        }
+
+    def __str__(self):
+        return f"{self.source[:12]} {self.start_time:%Y-%m-%d %H:%M:%S} ({self.packet_count} packets)"
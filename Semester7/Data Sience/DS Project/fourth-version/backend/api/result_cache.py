@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are serialized
+    fcntl = None
+
+# File in the cache directory holding the bytes written since the last scan
+USAGE_FILE = 'usage'
+# An eviction frees a bit more than needed, so the next puts don't rescan right away
+EVICT_FRACTION = 0.9
+
+
+class ResultCache:
+    """
+    On-disk cache of upload results, keyed by the content hash of the capture.
+
+    Entries are small JSON files in a subdirectory named after the model
+    version, so results of older models are never served. Directories of
+    other versions are left alone, processes still serving those models
+    keep using them.
+
+    Every process sharing the directory adds the size of the entries it
+    writes to a usage counter (a file, updated under an exclusive lock).
+    When the counter goes over max_bytes the directories of every version
+    are scanned and the least recently used entries (by file mtime,
+    refreshed on every hit by any process) are removed, so the entries on
+    disk stay within max_bytes however many processes write them.
+    """
+
+    def __init__(self, directory, max_bytes, version):
+        self.max_bytes = max_bytes
+        self.version = str(version)
+        self.root = directory
+        self.directory = os.path.join(directory, self.version)
+        self.usage_path = os.path.join(directory, USAGE_FILE)
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """Returns the cached result for key (a hex digest), or None."""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            # Marks the entry as recently used, for every process
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """Stores a JSON-serializable result and evicts entries over max_bytes."""
+        data = json.dumps(result).encode()
+        if len(data) > self.max_bytes:
+            return
+        path = self.path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            # Readers never see a partially written entry
+            os.replace(tmp_path, path)
+            self.add_usage(len(data))
+        except OSError as e:
+            print(f"Error writing result cache: {e}")
+
+    def add_usage(self, size):
+        """
+        Adds size to the usage counter, scanning and evicting when it goes
+        over max_bytes. An overwritten entry is counted twice, which only
+        brings the next scan forward.
+        """
+        with self.lock, open(self.usage_path, 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                usage = int(f.read() or 0)
+            except ValueError:
+                # Unreadable counter, rescan
+                usage = self.max_bytes
+            usage += size
+            if usage > self.max_bytes:
+                usage = self.evict(int(self.max_bytes * EVICT_FRACTION))
+            f.seek(0)
+            f.truncate()
+            f.write(str(usage))
+
+    def scan(self):
+        """Returns [(mtime, path, size)] of the entries of every version."""
+        found = []
+        for version in os.listdir(self.root):
+            version_dir = os.path.join(self.root, version)
+            if not os.path.isdir(version_dir):
+                continue
+            for name in os.listdir(version_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(version_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime_ns, path, st.st_size))
+        return found
+
+    def evict(self, target):
+        """Removes the least recently used entries until at most target bytes remain, returns the bytes left."""
+        found = sorted(self.scan())
+        total = sum(size for _, _, size in found)
+        for _, path, size in found:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total -= size
+        return total
@@ -0,0 +1,69 @@
+import threading
+
+from django.conf import settings
+
+from .ml.batching import MicroBatcher
+from .ml.incremental import ArtifactWatcher, IncrementalTrainer
+from .ml.models import feature_matrix, load_calibration, load_classifier, model_timeouts
+from .ml.protocol_rules import configure_rules
+from .models import TrafficWindow
+from .result_cache import ResultCache
+
+
+def recent_traffic(count):
+    # Windows recorded by every process (uploads, ingest), kept across restarts
+    return feature_matrix(TrafficWindow.recent_features(count))
+
+
+class Serving:
+    """
+    What the views serve with: the models, the batcher in front of them,
+    the result cache of their version and the threads keeping them up to
+    date. Built once per server process by get_serving().
+    """
+
+    def __init__(self):
+        # Protocol rules compiled once, then reloaded whenever the file changes
+        configure_rules(settings.PROTOCOL_RULES_FILE)
+        # Trained models loaded once from their artifacts (trained and saved on the very first start)
+        self.classifier = load_classifier(settings.MODEL_ARTIFACTS_DIR, settings.MODEL_BACKEND,
+                                          model_timeouts(settings.MODEL_TIMEOUTS_MS), settings.PARALLEL_MODELS,
+                                          load_calibration(settings.MODEL_CALIBRATION_FILE))
+        # Every prediction goes through it, so concurrent uploads share model calls
+        self.predictor = MicroBatcher(self.classifier, settings.PREDICTION_BATCH_SIZE,
+                                      settings.PREDICTION_BATCH_DELAY_MS / 1000)
+        self.result_cache = self.open_cache()
+        # Labelled captures posted to /api/label/ update the models in the background, and
+        # IsolationForest is refitted on the latest recorded traffic as it comes in; the
+        # updates are published as the current artifacts
+        self.trainer = IncrementalTrainer(self.classifier, settings.MODEL_ARTIFACTS_DIR,
+                                          window_source=recent_traffic, window_rows=settings.ANOMALY_WINDOW_ROWS,
+                                          refit_rows=settings.ANOMALY_REFIT_ROWS, on_update=self.models_updated)
+        # Artifacts published by other processes (other server workers, train_models,
+        # update_models) are picked up by the next requests
+        self.watcher = ArtifactWatcher(self.classifier, settings.MODEL_ARTIFACTS_DIR, settings.MODEL_RELOAD_INTERVAL,
+                                       on_update=self.models_updated)
+
+    def open_cache(self):
+        return ResultCache(settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_MAX_BYTES, self.classifier.version)
+
+    def models_updated(self, classifier):
+        # Results of the previous models are stale
+        self.result_cache = self.open_cache()
+
+
+_serving = None
+_serving_lock = threading.Lock()
+
+
+def get_serving():
+    """
+    The Serving of this process, built by the first call. wsgi.py and
+    asgi.py call it when the server starts; management commands never
+    do, so they don't load (or train) the models as a side effect.
+    """
+    global _serving
+    with _serving_lock:
+        if _serving is None:
+            _serving = Serving()
+        return _serving
@@ -0,0 +1,612 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+import numpy as np
+import scapy.all as scapy
+from django.test import SimpleTestCase
+
+from .ml import feature_extractor, models, packet_table
+from .ml.benchmark import PARITY_TOLERANCE, QUANTIZED_MIN_AGREEMENT, QUANTIZED_TOLERANCE, compare_backends
+from .ml.feature_extractor import FeatureExtractor
+from .ml.incremental import ArtifactWatcher, IncrementalTrainer
+from .ml.live import LiveIngestor, ReplaySource
+from .ml.stats import RunningStats
+from .result_cache import ResultCache
+
+COUNT_FIELDS = ('protocol_counts', 'class_counts')
+
+
+def ether():
+    # Explicit addresses, so scapy doesn't try to resolve them
+    return scapy.Ether(src="02:00:00:00:00:01", dst="02:00:00:00:00:02")
+
+
+def mixed_packets(count=2000, seed=1):
+    """
+    Packets covering what the raw-header decoder handles itself and what it
+    hands to scapy: VLAN, IPv6 (with extension headers), fragments, ICMP
+    errors, GRE / IP-in-IP / UDP tunnels, truncated headers, ARP and STP.
+    """
+    rng = random.Random(seed)
+    ports = [80, 443, 8443, 1935, 20, 21, 990, 22, 69, 5222, 5223, 53, 123, 67, 68, 12345]
+    kinds = [
+        lambda sp, dp: ether() / scapy.IP(dst="1.1.1.1") / scapy.TCP(sport=dp, dport=sp) / scapy.Raw(b'w' * 40),
+        lambda sp, dp: ether() / scapy.IP(dst="8.8.8.8") / scapy.UDP(sport=sp, dport=dp) / scapy.Raw(b'q' * 20),
+        lambda sp, dp: ether() / scapy.IP() / scapy.ICMP(),
+        lambda sp, dp: ether() / scapy.IP() / scapy.ICMP(type=3) / scapy.IP() / scapy.TCP(sport=80, dport=5),
+        lambda sp, dp: ether() / scapy.Dot1Q(vlan=5) / scapy.IP() / scapy.UDP(sport=sp, dport=dp),
+        lambda sp, dp: ether() / scapy.Dot1AD(vlan=7) / scapy.Dot1Q(vlan=5) / scapy.IP() / scapy.TCP(sport=sp),
+        lambda sp, dp: ether() / scapy.IPv6() / scapy.TCP(sport=sp, dport=dp) / scapy.Raw(b'x' * 30),
+        lambda sp, dp: ether() / scapy.IPv6() / scapy.IPv6ExtHdrHopByHop() / scapy.UDP(sport=sp, dport=dp),
+        lambda sp, dp: ether() / scapy.IPv6() / scapy.ICMPv6EchoRequest(),
+        lambda sp, dp: ether() / scapy.IP(flags=0, frag=10) / scapy.Raw(b'z' * 30),
+        lambda sp, dp: ether() / scapy.IP(flags='MF') / scapy.UDP(sport=sp, dport=dp) / scapy.Raw(b'f' * 30),
+        lambda sp, dp: ether() / scapy.IP() / scapy.GRE() / scapy.IP() / scapy.TCP(sport=sp, dport=dp),
+        lambda sp, dp: ether() / scapy.IP() / scapy.IP() / scapy.UDP(sport=sp, dport=dp),
+        lambda sp, dp: ether() / scapy.IP() / scapy.UDP(sport=dp, dport=4789) / scapy.VXLAN()
+                       / ether() / scapy.IP() / scapy.TCP(sport=sp),
+        lambda sp, dp: ether() / scapy.IP() / scapy.UDP(sport=1701, dport=1701) / scapy.Raw(b'\x00' * 12),
+        lambda sp, dp: scapy.Ether(bytes(ether() / scapy.IP() / scapy.TCP(sport=sp))[:40]),
+        lambda sp, dp: ether() / scapy.ARP(),
+        lambda sp, dp: scapy.Dot3(dst="01:80:c2:00:00:00") / scapy.LLC() / scapy.STP(),
+    ]
+    packets = []
+    timestamp = 1000.0
+    for _ in range(count):
+        timestamp += rng.random() * 0.01
+        packet = rng.choice(kinds)(rng.choice(ports), rng.randint(1024, 65535))
+        packet.time = timestamp
+        packets.append(packet)
+    return packets
+
+
+class DecoderParityTests(SimpleTestCase):
+    """The raw-header decoder (streaming) and scapy give the same counts."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        packets = mixed_packets()
+        cls.captures = [os.path.join(cls.directory.name, 'mixed.pcap'),
+                        os.path.join(cls.directory.name, 'mixed.pcapng')]
+        scapy.wrpcap(cls.captures[0], packets)
+        scapy.wrpcapng(cls.captures[1], packets)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def extract(self, path, streaming):
+        extractor = FeatureExtractor(path, streaming=streaming)
+        self.assertTrue(extractor.load_packets())
+        return extractor.extract_features()
+
+    def test_identical_counts(self):
+        for path in self.captures:
+            with self.subTest(capture=os.path.basename(path)):
+                decoded = self.extract(path, streaming=True)
+                dissected = self.extract(path, streaming=False)
+                for field in COUNT_FIELDS:
+                    self.assertEqual(decoded[field], dissected[field])
+                self.assertEqual(decoded['packet_count'], dissected['packet_count'])
+
+    def test_identical_headers(self):
+        # Record by record, which is what flows and talkers are built from
+        for path in self.captures:
+            with self.subTest(capture=os.path.basename(path)):
+                decoded = list(FeatureExtractor(path, streaming=True).iter_headers())
+                dissected = list(FeatureExtractor(path).iter_headers())
+                self.assertEqual(decoded, dissected)
+
+
+def baseline_features(path):
+    """The features as computed before the single pass: every packet loaded, then numpy over the sizes."""
+    extractor = FeatureExtractor(path)
+    packets = list(extractor.iter_packets())
+    packet_sizes = [len(p) for p in packets]
+    count_map = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0}
+    protocol_stats = Counter()
+    for p in packets:
+        proto, class_id = extractor.identify_protocol(p)
+        count_map[class_id] += 1
+        protocol_stats[proto] += 1
+    features = {
+        'avg_packet_size': np.mean(packet_sizes),
+        'std_packet_size': np.std(packet_sizes),
+        'min_packet_size': np.min(packet_sizes),
+        'max_packet_size': np.max(packet_sizes),
+        'packet_count': len(packets),
+        'protocol_counts': dict(protocol_stats),
+        'class_counts': count_map,
+    }
+    for class_id, letter in enumerate("ABCDE"):
+        features['ratio_' + letter] = count_map[class_id] / len(packets)
+    return features
+
+
+class RunningStatsTests(SimpleTestCase):
+    """The single pass gives the statistics numpy gives over the whole list of sizes."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.capture = os.path.join(cls.directory.name, 'stats.pcap')
+        scapy.wrpcap(cls.capture, mixed_packets(count=3000, seed=5))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def test_same_features_as_baseline(self):
+        expected = baseline_features(self.capture)
+        for streaming in (False, True):
+            with self.subTest(streaming=streaming):
+                extractor = FeatureExtractor(self.capture, streaming=streaming)
+                self.assertTrue(extractor.load_packets())
+                features = extractor.extract_features()
+                self.assertEqual(features.keys(), expected.keys())
+                for field in ('avg_packet_size', 'std_packet_size'):
+                    self.assertAlmostEqual(features[field], expected[field], places=9)
+                for field in expected.keys() - {'avg_packet_size', 'std_packet_size'}:
+                    self.assertEqual(features[field], expected[field], field)
+
+    def test_merged_chunks_match_numpy(self):
+        sizes = np.random.default_rng(0).integers(40, 65536, size=100000)
+        merged = RunningStats()
+        for chunk in np.array_split(sizes, 7):
+            part = RunningStats()
+            part.push_many(chunk[:-1])
+            part.push(int(chunk[-1]))
+            merged.merge(part)
+        self.assertEqual((merged.count, merged.min, merged.max), (len(sizes), sizes.min(), sizes.max()))
+        self.assertAlmostEqual(merged.mean, np.mean(sizes), places=9)
+        self.assertAlmostEqual(merged.std, np.std(sizes), places=9)
+
+
+class ParallelExtractionTests(SimpleTestCase):
+    """Captures split across the process pool give the single-process features."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        packets = mixed_packets(count=4000, seed=2)
+        cls.captures = [os.path.join(cls.directory.name, 'chunked.pcap'),
+                        os.path.join(cls.directory.name, 'chunked.pcapng')]
+        scapy.wrpcap(cls.captures[0], packets)
+        scapy.wrpcapng(cls.captures[1], packets)
+
+    @classmethod
+    def tearDownClass(cls):
+        feature_extractor.shutdown_pools()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        # Every capture is split, into workers * CHUNKS_PER_WORKER ranges
+        patcher = mock.patch.object(feature_extractor, 'PARALLEL_MIN_BYTES', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def extractor(self, path, workers):
+        extractor = FeatureExtractor(path, streaming=True, workers=workers)
+        self.assertTrue(extractor.load_packets())
+        self.assertEqual(extractor.use_pool(), workers > 1)
+        return extractor
+
+    def test_identical_features(self):
+        for path in self.captures:
+            with self.subTest(capture=os.path.basename(path)):
+                parallel = self.extractor(path, workers=2).extract_features()
+                single = self.extractor(path, workers=1).extract_features()
+                self.assertEqual(parallel.keys(), single.keys())
+                for field in single:
+                    self.assertEqual(parallel[field], single[field], field)
+
+    def test_identical_windows(self):
+        # Short windows, so that windows straddle the chunk boundaries
+        for path in self.captures:
+            with self.subTest(capture=os.path.basename(path)):
+                parallel = list(self.extractor(path, workers=2).iter_window_features(window=1.0))
+                single = list(self.extractor(path, workers=1).iter_window_features(window=1.0))
+                self.assertGreater(len(single), 1)
+                self.assertEqual(parallel, single)
+
+
+class PacketTableTests(SimpleTestCase):
+    """Features computed from an exported packet table are those of the capture."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.capture = os.path.join(cls.directory.name, 'table.pcapng')
+        scapy.wrpcapng(cls.capture, mixed_packets(count=3000, seed=4))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def extractor(self, table=None):
+        extractor = FeatureExtractor(self.capture, streaming=True, talkers=True, table=table)
+        self.assertTrue(extractor.load_packets())
+        self.assertEqual(extractor.table is not None, table is not None)
+        return extractor
+
+    def outputs(self, table=None):
+        extractor = self.extractor(table)
+        features = extractor.extract_features()
+        features['top_talkers'] = extractor.talkers.report()
+        return {
+            'features': features,
+            'windows': list(self.extractor(table).iter_window_features(window=1.0)),
+            'flows': self.extractor(table).extract_flow_features(),
+        }
+
+    def test_identical_features(self):
+        parsed = self.outputs()
+        for fmt in ('npy', 'parquet'):
+            with self.subTest(format=fmt):
+                if fmt == 'parquet' and packet_table.pyarrow is None:
+                    self.skipTest("needs pyarrow")
+                path = os.path.join(self.directory.name, 'table.' + fmt)
+                FeatureExtractor(self.capture, streaming=True).export_table(path, fmt)
+                from_table = self.outputs(path)
+                for name, value in parsed.items():
+                    self.assertEqual(from_table[name], value, name)
+
+
+class ResultCacheTests(SimpleTestCase):
+    """Caches of several processes (and model versions) share one size bound."""
+
+    MAX_BYTES = 4096
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def disk_bytes(self):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.directory) for name in names if name.endswith('.json'))
+
+    def test_shared_directory_stays_bounded(self):
+        caches = [ResultCache(self.directory, self.MAX_BYTES, 3), ResultCache(self.directory, self.MAX_BYTES, 3),
+                  ResultCache(self.directory, self.MAX_BYTES, 2)]
+        for i in range(300):
+            caches[i % len(caches)].put('%064x' % i, {'result': 'x' * 100, 'i': i})
+            self.assertLessEqual(self.disk_bytes(), self.MAX_BYTES)
+        self.assertGreater(self.disk_bytes(), self.MAX_BYTES // 2)
+        # The newest entries were kept, whichever cache wrote them
+        for i in (297, 298, 299):
+            self.assertEqual(caches[i % len(caches)].get('%064x' % i)['i'], i)
+
+    def test_hits_in_other_process_are_recent(self):
+        first = ResultCache(self.directory, self.MAX_BYTES, 3)
+        second = ResultCache(self.directory, self.MAX_BYTES, 3)
+        first.put('%064x' % 0, {'result': 'x' * 100})
+        for i in range(1, 20):
+            first.put('%064x' % i, {'result': 'x' * 100})
+            # Entry 0 is only ever read by the other cache
+            self.assertIsNotNone(second.get('%064x' % 0))
+        for i in range(20, 200):
+            first.put('%064x' % i, {'result': 'x' * 100})
+            self.assertIsNotNone(second.get('%064x' % 0))
+        self.assertIsNone(first.get('%064x' % 1))
+        self.assertLessEqual(self.disk_bytes(), self.MAX_BYTES)
+
+
+class StubClassifier:
+    """Records the features it is asked to predict."""
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, features):
+        self.calls.append(features)
+        return {'window': len(self.calls)}
+
+
+class ReplayTests(SimpleTestCase):
+    """Replaying a capture gives the windows of the file, one prediction each."""
+
+    WINDOW = 1.0
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.capture = os.path.join(cls.directory.name, 'replay.pcap')
+        cls.packet_count = 600
+        scapy.wrpcap(cls.capture, mixed_packets(count=cls.packet_count, seed=3))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def replay(self, rate=None):
+        classifier = StubClassifier()
+        windows = []
+        ingestor = LiveIngestor(ReplaySource(self.capture, rate=rate), classifier,
+                                on_window=lambda features, predictions: windows.append((features, predictions)),
+                                window=self.WINDOW)
+        return ingestor.run(), classifier, windows
+
+    def test_lossless_replay(self):
+        stats, classifier, windows = self.replay()
+        expected = list(FeatureExtractor(self.capture, streaming=True).iter_window_features(self.WINDOW))
+        self.assertGreater(len(expected), 1)
+        self.assertEqual((stats['received'], stats['processed'], stats['dropped']),
+                         (self.packet_count, self.packet_count, 0))
+        self.assertEqual(stats['windows'], len(expected))
+        # One prediction per closed window, on that window's features
+        self.assertEqual(classifier.calls, expected)
+        self.assertEqual([features for features, _ in windows], expected)
+        self.assertEqual([predictions for _, predictions in windows],
+                         [{'window': i + 1} for i in range(len(expected))])
+
+    def test_rate_limited_replay(self):
+        rate = 3000
+        stats, classifier, _ = self.replay(rate=rate)
+        self.assertGreaterEqual(stats['elapsed'], 0.9 * (self.packet_count - 1) / rate)
+        self.assertEqual((stats['received'], stats['processed'], stats['dropped']),
+                         (self.packet_count, self.packet_count, 0))
+        self.assertEqual(len(classifier.calls), stats['windows'])
+
+
+class StubForest:
+    def decision_function(self, X):
+        return np.ones(len(X))
+
+
+class RunModelsTests(SimpleTestCase):
+    """A slow or failing model is degraded without holding up or losing the others."""
+
+    TIMEOUT = 0.2
+
+    def setUp(self):
+        # The numpy backend needs no torch; the models are stubs anyway
+        self.classifier = models.PacketClassifier('numpy', {name: self.TIMEOUT for name in models.DEGRADED_RESULTS})
+        self.classifier.cnn_probabilities = lambda X: np.full((len(X), 5), 0.2)
+        self.classifier.xgboost_classes = lambda X: np.zeros(len(X), dtype=np.int64)
+        self.classifier.iso_forest = StubForest()
+        self.X = np.zeros((3, 10), dtype=np.float32)
+
+    def run_models(self):
+        started = time.monotonic()
+        outputs, degraded = self.classifier.run_models(self.X)
+        return outputs, degraded, time.monotonic() - started
+
+    def test_hanging_model_times_out_then_is_busy(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def hang(X):
+            calls.append(len(X))
+            release.wait(10)
+            return np.zeros(len(X), dtype=np.int64)
+
+        self.classifier.xgboost_classes = hang
+        outputs, degraded, elapsed = self.run_models()
+        self.assertEqual(degraded, {'xgboost': 'timeout'})
+        self.assertLess(elapsed, self.TIMEOUT + 0.5)
+        self.assertEqual(sorted(outputs), ['cnn', 'isolation_forest'])
+
+        # Not called again while the late call runs
+        outputs, degraded, elapsed = self.run_models()
+        self.assertEqual(degraded, {'xgboost': 'busy'})
+        self.assertLess(elapsed, self.TIMEOUT)
+        self.assertEqual(sorted(outputs), ['cnn', 'isolation_forest'])
+        np.testing.assert_array_equal(outputs['isolation_forest'], np.ones(3))
+        self.assertEqual(len(calls), 1)
+
+        release.set()
+        deadline = time.monotonic() + 5
+        while self.classifier._overdue['xgboost'].running() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        outputs, degraded, _ = self.run_models()
+        self.assertEqual(degraded, {})
+        self.assertEqual(sorted(outputs), ['cnn', 'isolation_forest', 'xgboost'])
+        self.assertEqual(len(calls), 2)
+
+    def test_failing_model_is_degraded(self):
+        def fail(X):
+            raise RuntimeError("broken model")
+
+        self.classifier.cnn_probabilities = fail
+        for parallel in (True, False):
+            with self.subTest(parallel=parallel):
+                self.classifier.parallel = parallel
+                outputs, degraded, elapsed = self.run_models()
+                self.assertEqual(degraded, {'cnn': 'error'})
+                self.assertLess(elapsed, self.TIMEOUT)
+                np.testing.assert_array_equal(outputs['xgboost'], np.zeros(3))
+                np.testing.assert_array_equal(outputs['isolation_forest'], np.ones(3))
+
+    def test_degraded_models_in_predictions(self):
+        def fail(X):
+            raise RuntimeError("broken model")
+
+        self.classifier.cnn_probabilities = fail
+        self.classifier.is_trained = True
+        result = self.classifier.predict_batch(self.X)[0]
+        self.assertEqual(result['cnn'], dict(models.DEGRADED_RESULTS['cnn'], degraded='error'))
+        self.assertEqual(result['xgboost'], {'class': 0})
+        self.assertEqual(result['isolation_forest'], {'is_anomaly': False, 'score': 1.0})
+
+
+@unittest.skipIf(models.torch is None, "needs torch")
+class BackendParityTests(SimpleTestCase):
+    """Compiled and numpy inference backends give the eager models' outputs."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.classifier = models.PacketClassifier()
+        cls.classifier.train_dummy(n_samples=2000, epochs=2, threads=1, seed=0)
+
+    def compare(self, backends):
+        parity = compare_backends(self.classifier, backends, batch_sizes=[1, 64], repeat=1)['parity']
+        self.assertEqual([entry['backend'] for entry in parity], list(backends))
+        return parity
+
+    def test_compiled_backends_match_eager(self):
+        backends = ['torchscript', 'numpy']
+        if models.onnxruntime is not None:
+            backends.append('onnx')
+        for entry in self.compare(backends):
+            with self.subTest(backend=entry['backend']):
+                self.assertLessEqual(entry['max_probability_difference'], PARITY_TOLERANCE)
+                self.assertEqual(entry['xgboost_class_mismatches'], 0)
+                self.assertTrue(entry['ok'])
+
+    @unittest.skipIf(models.torch is not None and models.torch.backends.quantized.engine == 'none',
+                     "no quantized engine")
+    def test_int8_agrees_with_float32(self):
+        entry, = self.compare(['int8'])
+        self.assertLessEqual(entry['max_probability_difference'], QUANTIZED_TOLERANCE)
+        self.assertGreaterEqual(entry['cnn_agreement'], QUANTIZED_MIN_AGREEMENT)
+        self.assertTrue(entry['ok'])
+
+    def test_cnn_learns(self):
+        # The quantized backend is only checked meaningfully against a CNN that does better than chance
+        X, y = models.synthetic_dataset(2000, seed=1)
+        accuracy = (self.classifier.cnn_probabilities(X).argmax(axis=1) == y).mean()
+        self.assertGreater(accuracy, 0.9)
+
+
+@unittest.skipIf(models.torch is None, "needs torch")
+class IncrementalUpdateTests(SimpleTestCase):
+    """Updates are trained aside, published as builds and picked up by other classifiers."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.trained = models.PacketClassifier()
+        cls.trained.train_dummy(n_samples=2000, epochs=2, threads=1, seed=0)
+        cls.X, cls.y = models.synthetic_dataset(500, seed=2)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def serving(self):
+        classifier = self.trained.clone()
+        classifier.save(self.directory)
+        return classifier
+
+    def trainer(self, classifier, **kwargs):
+        trainer = IncrementalTrainer(classifier, threads=1, **kwargs)
+        self.addCleanup(trainer.close)
+        return trainer
+
+    def test_update_is_adopted_and_published(self):
+        classifier = self.serving()
+        version, before = classifier.version, classifier.cnn_probabilities(self.X)
+        updated = []
+        trainer = self.trainer(classifier, directory=self.directory, on_update=updated.append)
+        trainer.submit(self.X, np.zeros(len(self.X), dtype=np.int64))
+        self.assertTrue(trainer.flush(120))
+        self.assertIsNone(trainer.last_error)
+        self.assertEqual((trainer.updates, trainer.rows), (1, len(self.X)))
+        self.assertNotEqual(classifier.version, version)
+        self.assertEqual(classifier.version, models.artifacts_version(self.directory))
+        self.assertFalse(np.allclose(classifier.cnn_probabilities(self.X), before))
+        self.assertEqual(updated, [classifier])
+
+    def test_failed_update_changes_nothing(self):
+        classifier = self.serving()
+        version, build = classifier.version, models.current_build(self.directory)
+        before = classifier.predict_batch(self.X)
+        trainer = self.trainer(classifier, directory=self.directory)
+        with mock.patch.object(models.PacketClassifier, 'update', side_effect=RuntimeError("boom")):
+            trainer.submit(self.X, self.y)
+            self.assertTrue(trainer.flush(120))
+        self.assertEqual(trainer.last_error, "boom")
+        self.assertEqual(trainer.updates, 0)
+        self.assertEqual(classifier.version, version)
+        self.assertEqual(models.current_build(self.directory), build)
+        self.assertEqual(classifier.predict_batch(self.X), before)
+
+    def test_first_save_stays_current(self):
+        first = self.serving()
+        build = models.current_build(self.directory)
+        second = self.trained.clone()
+        second.fit_isolation_forest(self.X, threads=1, seed=1)
+        second.save(self.directory)
+        self.assertEqual(models.current_build(self.directory), build)
+        self.assertEqual(models.artifacts_version(self.directory), first.version)
+        self.assertNotEqual(second.version, first.version)
+
+    def test_racing_saves_keep_one_build(self):
+        savers = [self.trained.clone() for _ in range(4)]
+        for seed, saver in enumerate(savers):
+            saver.fit_isolation_forest(self.X, threads=1, seed=seed)
+        barrier = threading.Barrier(len(savers))
+
+        def save(saver):
+            barrier.wait()
+            saver.save(self.directory)
+
+        threads = [threading.Thread(target=save, args=(saver,)) for saver in savers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        current = models.artifacts_version(self.directory)
+        # Only the saver whose build went current took its version
+        self.assertEqual(sum(saver.version == current for saver in savers), 1)
+        loaded = models.PacketClassifier()
+        loaded.load(self.directory)
+        self.assertEqual(loaded.version, current)
+
+    def test_watcher_picks_up_published_build(self):
+        classifier = self.serving()
+        reloaded = []
+        watcher = ArtifactWatcher(classifier, self.directory, interval=0, on_update=reloaded.append)
+        self.assertFalse(watcher.check())
+
+        publisher = classifier.clone()
+        publisher.update(self.X, np.zeros(len(self.X), dtype=np.int64), threads=1, seed=0)
+        publisher.save(self.directory, replace=True)
+        self.assertFalse(ArtifactWatcher(classifier, self.directory, interval=60).check())
+        self.assertTrue(watcher.check())
+        self.assertEqual(classifier.version, publisher.version)
+        np.testing.assert_allclose(classifier.cnn_probabilities(self.X), publisher.cnn_probabilities(self.X))
+        self.assertEqual(classifier.predict_batch(self.X), publisher.predict_batch(self.X))
+        self.assertEqual((watcher.reloads, reloaded), (1, [classifier]))
+        self.assertFalse(watcher.check())
+
+    def test_isolation_forest_refit_after_recorded_rows(self):
+        classifier = self.trained.clone()
+        forest, version = classifier.iso_forest, classifier.version
+        requested = []
+
+        def window_source(count):
+            requested.append(count)
+            return self.X
+
+        trainer = self.trainer(classifier, window_source=window_source, window_rows=400, refit_rows=100)
+        trainer.traffic_recorded(60)
+        self.assertTrue(trainer.flush(60))
+        self.assertEqual((trainer.refits, requested), (0, []))
+        trainer.traffic_recorded(60)
+        self.assertTrue(trainer.flush(60))
+        self.assertEqual((trainer.refits, trainer.updates, requested), (1, 0, [400]))
+        self.assertIsNot(classifier.iso_forest, forest)
+        self.assertEqual(classifier.iso_forest.n_features_in_, classifier.input_dim)
+        self.assertNotEqual(classifier.version, version)
@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import FileUploadView, StatsView
+from .views import FileUploadView, LabelView, StatsView
 
 urlpatterns = [
     path('upload/', FileUploadView.as_view(), name='file-upload'),
     path('stats/', StatsView.as_view(), name='stats'),
+    path('label/', LabelView.as_view(), name='label'),
 ]
@@ -2,45 +2,220 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework import status
+import hashlib
 import os
 from django.conf import settings
-from .ml.feature_extractor import FeatureExtractor
-from .ml.models import PacketClassifier
+from django.db.models import Sum
+from django.utils import timezone
+from .ml.feature_extractor import CaptureAggregate, FeatureExtractor
+from .ml.models import feature_matrix
+from .ml.protocol_rules import get_rules
+from .models import TrafficWindow
+from .serving import get_serving
+
+# Windows written per INSERT
+WINDOW_INSERT_BATCH = 500
+# Windows shown in the dashboard activity feed
+RECENT_WINDOWS = 20
+CLASS_FIELDS = [
+    ('class_a', "Class A (Web)"),
+    ('class_b', "Class B (Streaming)"),
+    ('class_c', "Class C (File Transfer)"),
+    ('class_d', "Class D (Messaging)"),
+    ('class_e', "Class E (System)"),
+]
+
+
+def record_windows(windows, source):
+    """
+    Scores every window features dict with the models and stores it for
+    StatsView. Windows are consumed as they are produced, then scored and
+    written in batches, so the series is never held in memory.
+    """
+    # A capture analysed again replaces its previous windows
+    TrafficWindow.objects.filter(source=source).delete()
+    batch = []
+    for window in windows:
+        batch.append(window)
+        if len(batch) == WINDOW_INSERT_BATCH:
+            save_windows(batch, source)
+            batch = []
+    if batch:
+        save_windows(batch, source)
+
+
+def save_windows(windows, source):
+    serving = get_serving()
+    predictions = serving.predictor.predict_batch(windows)
+    TrafficWindow.objects.bulk_create([
+        TrafficWindow.from_features(source, window, prediction)
+        for window, prediction in zip(windows, predictions)
+    ])
+    serving.trainer.traffic_recorded(len(windows))
+
+
+def format_predictions(predictions):
+    """
+    Response form of a predict() result, with readable class names. Models
+    that timed out or failed say so; they are also returned as a dict
+    model -> reason.
+    """
+    classifier = get_serving().classifier
+    result = {
+        "cnn": {
+            "class_id": predictions['cnn']['class'],
+            "class_name": classifier.get_class_name(predictions['cnn']['class']),
+            "confidence": predictions['cnn']['confidence']
+        },
+        "xgboost": {
+            "class_id": predictions['xgboost']['class'],
+            "class_name": classifier.get_class_name(predictions['xgboost']['class'])
+        },
+        "isolation_forest": predictions['isolation_forest']
+    }
+    degraded = {name: prediction['degraded'] for name, prediction in predictions.items() if 'degraded' in prediction}
+    for name, reason in degraded.items():
+        result[name]['degraded'] = reason
+    return result, degraded
+
+
+def iter_scored(features_list):
+    """Yields (features, prediction) for every features dict, scored WINDOW_INSERT_BATCH at a time."""
+    predictor = get_serving().predictor
+    batch = []
+    for features in features_list:
+        batch.append(features)
+        if len(batch) == WINDOW_INSERT_BATCH:
+            yield from zip(batch, predictor.predict_batch(batch))
+            batch = []
+    if batch:
+        yield from zip(batch, predictor.predict_batch(batch))
+
+
+def classify_flows(flows, limit):
+    """
+    Scores every flow features dict (see FeatureExtractor.iter_flow_features())
+    with the models as the flows close. Returns the mode=flows result, which
+    lists the first `limit` flows, and the models degraded for any flow.
+    """
+    listed = []
+    flow_count = 0
+    anomalies = 0
+    # Flows per XGBoost class, over every flow
+    distribution = {}
+    degraded = {}
+    for features, prediction in iter_scored(flows):
+        predictions, flow_degraded = format_predictions(prediction)
+        degraded.update(flow_degraded)
+        flow_count += 1
+        name = predictions['xgboost']['class_name']
+        distribution[name] = distribution.get(name, 0) + 1
+        if predictions['isolation_forest']['is_anomaly']:
+            anomalies += 1
+        if len(listed) < limit:
+            listed.append({
+                "flow": features['flow'],
+                "packet_count": features['packet_count'],
+                "predictions": predictions,
+            })
+    return {
+        "mode": "flows",
+        "flow_count": flow_count,
+        "anomalous_flows": anomalies,
+        "class_distribution": distribution,
+        "flows": listed,
+        "truncated": flow_count > len(listed),
+    }, degraded
 
-# Initialize models once (or lazy load)
-classifier = PacketClassifier()
 
 class FileUploadView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
     def post(self, request, *args, **kwargs):
+        serving = get_serving()
+        serving.watcher.check()
         file_obj = request.data.get('file')
         if not file_obj:
             return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Save file temporarily
+        # Optional triage mode: classify every Nth packet (sample_every=N)
+        # or a uniform sample of K packets (reservoir=K) instead of all of them
+        sampling = {}
+        for name in ('sample_every', 'reservoir'):
+            value = request.data.get(name)
+            if value:
+                try:
+                    sampling[name] = int(value)
+                except ValueError:
+                    sampling[name] = 0
+                if sampling[name] < 1:
+                    return Response({"error": f"{name} must be a positive integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(sampling) > 1:
+            return Response({"error": "Use either sample_every or reservoir"}, status=status.HTTP_400_BAD_REQUEST)
+        # mode=flows classifies every flow of the capture instead of the capture as a whole
+        mode = request.data.get('mode') or 'capture'
+        if mode not in ('capture', 'flows'):
+            return Response({"error": "mode must be capture or flows"}, status=status.HTTP_400_BAD_REQUEST)
+        if mode == 'flows' and sampling:
+            return Response({"error": "Sampling only applies to mode=capture"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Save file temporarily. Compressed captures (gzip, zstd, xz, bz2) are
+        # kept compressed, the extractor decompresses them on the fly.
         upload_dir = os.path.join(settings.BASE_DIR, 'uploads')
         os.makedirs(upload_dir, exist_ok=True)
         file_path = os.path.join(upload_dir, file_obj.name)
         
+        # The content hash is computed on the way, it is the result cache key
+        digest = hashlib.sha256()
         with open(file_path, 'wb+') as destination:
             for chunk in file_obj.chunks():
                 destination.write(chunk)
+                digest.update(chunk)
+        cache_key = digest.hexdigest()
+        # Sampled results are cached apart from the full ones, and results
+        # are only reused while the protocol rules stay the same
+        rules = get_rules()
+        result_key = (cache_key + ''.join(f"-{name}{value}" for name, value in sampling.items())
+                      + f"-r{rules.version[:16]}-p{settings.PAYLOAD_INSPECT_BYTES}")
+        if mode == 'flows':
+            result_key += f"-flows{settings.FLOW_TABLE_SIZE}-l{settings.FLOW_RESULTS_LIMIT}"
+
+        # The models may be updated while this request runs, its result goes
+        # with the version it started with
+        cache = serving.result_cache
+        cached = cache.get(result_key)
+        if cached is not None:
+            try:
+                os.remove(file_path)
+            except:
+                pass
+            return Response(cached, status=status.HTTP_200_OK)
+
+        if mode == 'flows':
+            return self.post_flows(file_path, rules, result_key, cache)
 
         # Process file
-        extractor = FeatureExtractor(file_path)
+        extractor = FeatureExtractor(file_path, streaming=True, workers=settings.FEATURE_EXTRACTION_WORKERS,
+                                     talkers=True, rules=rules, inspect_bytes=settings.PAYLOAD_INSPECT_BYTES)
+        features = None
         if extractor.load_packets():
-            features = extractor.extract_features()
-        else:
+            if sampling:
+                features = extractor.extract_sampled_features(
+                    every=sampling.get('sample_every'), reservoir=sampling.get('reservoir'))
+            else:
+                # A single pass gives the window series and the totals of the whole capture
+                total = CaptureAggregate(rules)
+                record_windows(extractor.iter_window_features(settings.FEATURE_WINDOW_SECONDS, total), cache_key)
+                features = total.to_features()
+            if features:
+                # Top hosts, ports and conversations, counted during the same pass
+                features['top_talkers'] = extractor.talkers.report()
+        if not features:
             # Fallback for demo if pcap is invalid or empty
             features = extractor.get_dummy_features()
 
         # Predict
-        predictions = classifier.predict(features)
-        
-        # Get readable class names
-        cnn_class = classifier.get_class_name(predictions['cnn']['class'])
-        xgb_class = classifier.get_class_name(predictions['xgboost']['class'])
+        predictions, degraded = format_predictions(serving.predictor.predict(features))
 
         # Cleanup
         try:
@@ -48,31 +223,104 @@ class FileUploadView(APIView):
         except:
             pass
 
-        return Response({
+        result = {
             "features": features, # Contains protocol_counts, class_counts, etc.
-            "predictions": {
-                "cnn": {
-                    "class_id": predictions['cnn']['class'],
-                    "class_name": cnn_class,
-                    "confidence": predictions['cnn']['confidence']
-                },
-                "xgboost": {
-                    "class_id": predictions['xgboost']['class'],
-                    "class_name": xgb_class
-                },
-                "isolation_forest": predictions['isolation_forest']
-            },
+            "predictions": predictions,
             # Explicitly expose stats for convenience if frontend needs them at root level
             "statistics": {
                 "protocol_counts": features.get('protocol_counts', {}),
-                "class_counts": features.get('class_counts', {})
-            }
-        }, status=status.HTTP_200_OK)
+                "class_counts": features.get('class_counts', {}),
+                "top_talkers": features.get('top_talkers', {})
+            },
+            # Share of the packets that were classified (1.0 unless sampling was asked for)
+            "sampling": features.get('sampling', {"mode": "full", "rate": 1.0})
+        }
+        # Results with models that timed out or failed aren't cached
+        if not degraded:
+            cache.put(result_key, result)
+
+        return Response(result, status=status.HTTP_200_OK)
+
+    def post_flows(self, file_path, rules, result_key, cache):
+        """Classifies every flow of the uploaded capture (mode=flows)."""
+        try:
+            extractor = FeatureExtractor(file_path, streaming=True, rules=rules,
+                                         inspect_bytes=settings.PAYLOAD_INSPECT_BYTES)
+            if not extractor.load_packets():
+                return Response({"error": "Could not read the capture"}, status=status.HTTP_400_BAD_REQUEST)
+            result, degraded = classify_flows(extractor.iter_flow_features(max_flows=settings.FLOW_TABLE_SIZE),
+                                              settings.FLOW_RESULTS_LIMIT)
+        finally:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        if not degraded:
+            cache.put(result_key, result)
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class LabelView(APIView):
+    """
+    Labelled capture for incremental training: the features of every
+    window of the capture are queued with the class given as `label`,
+    and the models are updated in the background (202 Accepted).
+    """
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request, *args, **kwargs):
+        serving = get_serving()
+        serving.watcher.check()
+        classifier, trainer = serving.classifier, serving.trainer
+        file_obj = request.data.get('file')
+        if not file_obj:
+            return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            label = int(request.data.get('label', ''))
+        except ValueError:
+            label = -1
+        if not 0 <= label < classifier.num_classes:
+            return Response({"error": f"label must be a class id from 0 to {classifier.num_classes - 1}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        upload_dir = os.path.join(settings.BASE_DIR, 'uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+        file_path = os.path.join(upload_dir, file_obj.name)
+        with open(file_path, 'wb+') as destination:
+            for chunk in file_obj.chunks():
+                destination.write(chunk)
+
+        try:
+            extractor = FeatureExtractor(file_path, streaming=True, workers=settings.FEATURE_EXTRACTION_WORKERS,
+                                         rules=get_rules(), inspect_bytes=settings.PAYLOAD_INSPECT_BYTES)
+            windows = []
+            if extractor.load_packets():
+                windows = list(extractor.iter_window_features(settings.FEATURE_WINDOW_SECONDS))
+        finally:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        if not windows:
+            return Response({"error": "No packets found in the capture"}, status=status.HTTP_400_BAD_REQUEST)
+
+        trainer.submit(feature_matrix(windows), [label] * len(windows))
+        return Response({
+            "rows": len(windows),
+            "pending": trainer.pending,
+            "updates": trainer.updates,
+            "model_version": classifier.version,
+        }, status=status.HTTP_202_ACCEPTED)
+
 
 class StatsView(APIView):
     def get(self, request):
-        # Return dummy stats for the dashboard
-        # These should match the 5 classes we defined
+        # Latest recorded windows, oldest first
+        recent = list(TrafficWindow.objects.order_by('-id')[:RECENT_WINDOWS])[::-1]
+        # Share of packets per class (percent) over every recorded window
+        totals = TrafficWindow.objects.aggregate(**{field: Sum(field) for field, _ in CLASS_FIELDS})
+        all_packets = sum(value or 0 for value in totals.values())
+
         return Response({
             "model_accuracies": {
                 "cnn": 0.95,
@@ -80,15 +328,15 @@ class StatsView(APIView):
                 "isolation_forest": 0.90
             },
             "class_distribution": {
-                "Class A (Web)": 45,
-                "Class B (Streaming)": 20,
-                "Class C (File Transfer)": 15,
-                "Class D (Messaging)": 10,
-                "Class E (System)": 10
+                label: round(100 * (totals[field] or 0) / all_packets, 1) if all_packets else 0
+                for field, label in CLASS_FIELDS
             },
             "recent_activity": [
-                 {"time": "10:00", "packets": 1200, "attack_detected": False},
-                 {"time": "10:05", "packets": 1500, "attack_detected": False},
-                 {"time": "10:10", "packets": 800, "attack_detected": True},
+                {
+                    "time": timezone.localtime(window.start_time).strftime("%H:%M:%S"),
+                    "packets": window.packet_count,
+                    "attack_detected": window.is_anomaly,
+                }
+                for window in recent
             ]
         })
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -127,3 +128,67 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Packet capture analysis
+
+# Processes used to extract features from large uploaded captures (1 = in the request thread)
+FEATURE_EXTRACTION_WORKERS = int(os.environ.get('FEATURE_EXTRACTION_WORKERS', os.cpu_count() or 1))
+
+# Seconds of capture time per window of the feature series shown by /api/stats/
+FEATURE_WINDOW_SECONDS = float(os.environ.get('FEATURE_WINDOW_SECONDS', 5))
+
+# Results of already analysed captures, keyed by the SHA-256 of the upload.
+# The size bound covers every server process sharing the directory
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', str(BASE_DIR / 'cache' / 'results'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Trained models (CNN, XGBoost, IsolationForest) saved per model version and
+# loaded at startup, see `manage.py train_models`
+MODEL_ARTIFACTS_DIR = os.environ.get('MODEL_ARTIFACTS_DIR', str(BASE_DIR / 'artifacts'))
+# IsolationForest is refitted on the latest ANOMALY_WINDOW_ROWS recorded windows (of
+# every process) whenever the models are updated from /api/label/, and on its own every
+# ANOMALY_REFIT_ROWS windows recorded by a server process (0 = only with updates)
+ANOMALY_WINDOW_ROWS = int(os.environ.get('ANOMALY_WINDOW_ROWS', 10000))
+ANOMALY_REFIT_ROWS = int(os.environ.get('ANOMALY_REFIT_ROWS', 10000))
+# Seconds between two checks for models published by another process (an update
+# from /api/label/ in another worker, update_models, train_models --force)
+MODEL_RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', 5))
+
+# How the CNN and XGBoost are run: eager, torchscript, onnx (needs onnx and
+# onnxruntime), numpy (the only one that works without torch installed, for
+# serving processes) or int8 (quantized CNN), see `manage.py benchmark_models`
+MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'eager')
+# With MODEL_BACKEND=int8, the CNN is quantized at startup and calibrated on these
+# stored feature rows (.npy float32 array, n x 10), or on synthetic rows if empty
+MODEL_CALIBRATION_FILE = os.environ.get('MODEL_CALIBRATION_FILE', '')
+
+# The 3 models of a prediction run at the same time (PARALLEL_MODELS=0 runs them one
+# after another). A model still running after its timeout, or failing, is returned
+# as degraded instead of holding up the response, and is skipped (degraded as busy)
+# until that late call returns. MODEL_TIMEOUT_MS applies to each
+# model, CNN_TIMEOUT_MS, XGBOOST_TIMEOUT_MS and ISOLATION_FOREST_TIMEOUT_MS override
+# it; 0 = no limit.
+PARALLEL_MODELS = os.environ.get('PARALLEL_MODELS', '1') != '0'
+MODEL_TIMEOUTS_MS = {
+    name: float(os.environ.get(f'{name.upper()}_TIMEOUT_MS', os.environ.get('MODEL_TIMEOUT_MS', 0)))
+    for name in ('cnn', 'xgboost', 'isolation_forest')
+}
+
+# Predictions of concurrent requests are scored together, in batches of up to
+# PREDICTION_BATCH_SIZE vectors that wait at most PREDICTION_BATCH_DELAY_MS for each other
+PREDICTION_BATCH_SIZE = int(os.environ.get('PREDICTION_BATCH_SIZE', 256))
+PREDICTION_BATCH_DELAY_MS = float(os.environ.get('PREDICTION_BATCH_DELAY_MS', 2))
+
+# Protocol to class rules (ports, layers, class id, priority), reloaded when the file changes
+PROTOCOL_RULES_FILE = os.environ.get('PROTOCOL_RULES_FILE', str(BASE_DIR / 'api' / 'ml' / 'protocol_rules.json'))
+
+# Payload bytes inspected per flow for the payload signatures of the rules (TLS SNI,
+# HTTP Host/Content-Type), e.g. 1024. 0 classifies by ports and layers only.
+PAYLOAD_INSPECT_BYTES = int(os.environ.get('PAYLOAD_INSPECT_BYTES', 0))
+
+# Uploads with mode=flows classify every flow of the capture: FLOW_TABLE_SIZE flows are
+# tracked at once (the least recently seen is closed early past that), and the first
+# FLOW_RESULTS_LIMIT classified flows are listed in the response
+FLOW_TABLE_SIZE = int(os.environ.get('FLOW_TABLE_SIZE', 65536))
+FLOW_RESULTS_LIMIT = int(os.environ.get('FLOW_RESULTS_LIMIT', 1000))
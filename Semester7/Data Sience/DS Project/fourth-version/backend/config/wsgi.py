@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Loads the protocol rules and the model artifacts when the server starts
+# rather than on the first request
+from api.serving import get_serving  # noqa: E402
+
+get_serving()